@@ -101,6 +101,14 @@ class Database(C3Object):
         example, commit any temporary data to IndexStores"""
         raise(NotImplementedError)
 
+    def commit_parallelIndexing(self, session):
+        """Finalize indexing carried out by several processes.
+
+        Perform tasks after each process has indexed Records and called
+        commit_indexing. For example, merge their temporary data into
+        IndexStores"""
+        raise NotImplementedError
+
     def reindex(self, session):
         """Reindex all Records registered with the database."""
         raise NotImplementedError
@@ -115,10 +123,12 @@ class Database(C3Object):
         """
         raise NotImplementedError
 
-    def search(self, session, query):
+    def search(self, session, query, topK=0):
         """Search the database, return a ResultSet.
 
         Given a CQL query, execute the query and return a ResultSet object.
+        If topK is given, only the first topK items of a relevance ranked
+        ResultSet are guaranteed to be in rank order.
         """
         raise NotImplementedError
 
@@ -174,6 +184,14 @@ class Index(C3Object):
         """
         raise NotImplementedError
 
+    def commit_parallelIndexing(self, session):
+        """Finalize indexing carried out by several processes.
+
+        Perform tasks after each process has indexed Records and called
+        commit_indexing. By default, as commit_indexing.
+        """
+        self.commit_indexing(session)
+
     def index_record(self, session, rec):
         """Index and return a Record.
 
@@ -709,6 +727,10 @@ class IndexStore(C3Object):
         """Fetch and return a list of term frequency tuples."""
         raise NotImplementedError
 
+    def fetch_indexStamp(self, session, index):
+        """Fetch and return a value that changes when the Index is changed."""
+        raise NotImplementedError
+
     def construct_resultSetItem(self, session, recId,
                                 recStoreId, nOccs, rsiType=None):
         """Create and return a ResultSetItem.
@@ -929,11 +951,21 @@ class ResultSet(object):
         """Return an iterable of ``nRecs`` Records starting at ``start``."""
         raise NotImplementedError
 
-    def order(self, session, spec,
-              ascending=None, missing=None, case=None, accents=None):
+    def order(self, session, spec, ascending=None, missing=None,
+              case=None, accents=None, topK=0):
         """Re-order in-place based on the given spec and arguments."""
         raise NotImplementedError
 
+    def order_multiple(self, session, specs):
+        """Re-order in-place based on a sequence of sort specifications.
+
+        Each item of ``specs`` is a tuple of arguments for ``order``, the
+        first being the most significant.
+        """
+        # Stable sort, so order by the least significant spec first
+        for spec in reversed(specs):
+            self.order(session, *spec)
+
     def serialize(self, session):
         """Return a string serialization of the ResultSet."""
         raise NotImplementedError
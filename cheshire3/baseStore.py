@@ -7,6 +7,8 @@ import bsddb as bdb
 import datetime
 import dateutil.tz
 import shutil
+import atexit
+import threading
 
 from urllib import quote, unquote
 from urlparse import urlsplit
@@ -24,6 +26,83 @@ from cheshire3.baseObjects import Session
 from cheshire3.utils import gen_uuid
 
 
+# Shared BerkeleyDB environments, keyed by directory
+bdbEnvironments = {}
+bdbEnvironmentsLock = threading.Lock()
+
+
+def get_bdbEnvironment(session, directory, cacheSize):
+    """Return the shared BerkeleyDB environment for directory.
+
+    The environment is created, with a page cache of cacheSize bytes, the
+    first time that it is requested and then shared by all stores using the
+    directory until the process exits. Database handles opened in it with
+    the DB_THREAD flag may be used by multiple threads.
+    """
+    directory = os.path.abspath(directory)
+    with bdbEnvironmentsLock:
+        try:
+            return bdbEnvironments[directory]
+        except KeyError:
+            pass
+        env = bdb.db.DBEnv()
+        env.set_cachesize(cacheSize >> 30, cacheSize & ((1 << 30) - 1))
+        env.open(directory,
+                 bdb.db.DB_CREATE | bdb.db.DB_INIT_MPOOL |
+                 bdb.db.DB_PRIVATE | bdb.db.DB_THREAD)
+        bdbEnvironments[directory] = env
+        return env
+
+
+def close_bdbEnvironments():
+    """Close all shared BerkeleyDB environments, and their databases."""
+    with bdbEnvironmentsLock:
+        for env in bdbEnvironments.itervalues():
+            env.close()
+        bdbEnvironments.clear()
+
+
+atexit.register(close_bdbEnvironments)
+
+
+class BdbEnvironmentMixin(object):
+    """Mix-in to create and open BerkeleyDB database handles.
+
+    Handles are created in the environment shared by stores with the same
+    defaultPath when the dbCacheSize setting is given.
+    """
+
+    _possiblePaths = {}
+    _possibleDefaults = {}
+    _possibleSettings = {
+        'dbCacheSize': {
+            'docs': ("Size in bytes of a BerkeleyDB page cache to share "
+                     "between the databases of all stores with the same "
+                     "defaultPath. Default 0 (each database has its own "
+                     "cache)"),
+            'type': int
+        }
+    }
+
+    def _newDb(self, session):
+        # Return an unopened database handle, in the shared environment if
+        # there is one
+        cacheSize = self.get_setting(session, 'dbCacheSize', 0)
+        if cacheSize:
+            dfp = self.get_path(session, 'defaultPath')
+            return bdb.db.DB(get_bdbEnvironment(session, dfp, cacheSize))
+        return bdb.db.DB()
+
+    def _get_openFlags(self, session):
+        # Return flags with which to open databases for use. Handles are kept
+        # open and shared by threads searching concurrently, with or without
+        # an environment, so they must be free-threaded
+        flags = bdb.db.DB_THREAD
+        if session.environment == "apache":
+            flags |= bdb.db.DB_NOMMAP
+        return flags
+
+
 class DeletedObject(object):
     id = ""
     time = ""
@@ -521,6 +600,7 @@ class SwitchingBdbConnection(object):
             self.basePath = os.path.join(dfp, basename)
 
         self.cxns = {}
+        self.cxnLock = threading.Lock()
         self.createArgs = {}
         self.openArgs = {}
         self.preOpenFlags = 0
@@ -664,10 +744,15 @@ class SwitchingBdbConnection(object):
         return ['0']
 
     def _open(self, b):
-        if b in self.cxns and self.cxns[b] is not None:
-            return self.cxns[b]
-        else:
-            cxn = bdb.db.DB()
+        cxn = self.cxns.get(b, None)
+        if cxn is not None:
+            return cxn
+        with self.cxnLock:
+            cxn = self.cxns.get(b, None)
+            if cxn is not None:
+                # Opened by another thread
+                return cxn
+            cxn = self.store._newDb(self.session)
             if self.preOpenFlags:
                 cxn.set_flags(self.preOpenFlags)
             dbp = self.basePath + "_" + b
@@ -675,7 +760,7 @@ class SwitchingBdbConnection(object):
             if (not os.path.exists(dbp)):
                 cxn.open(dbp, **self.store.createArgs[self.basePath])
                 cxn.close()
-                cxn = bdb.db.DB()
+                cxn = self.store._newDb(self.session)
 
             cxn.open(dbp, **self.openArgs)
             self.cxns[b] = cxn
@@ -727,9 +812,11 @@ class SwitchingBdbConnection(object):
         return None
 
     def close(self):
-        for (k, c) in self.cxns.iteritems():
-            c.close()
-            self.cxns[k] = None
+        with self.cxnLock:
+            for (k, c) in self.cxns.iteritems():
+                if c is not None:
+                    c.close()
+                self.cxns[k] = None
         return None
 
     def set_flags(self, f):
@@ -852,12 +939,18 @@ class SwitchingBdbCursor(object):
             return x
 
 
-class BdbStore(SimpleStore):
-    """Berkeley DB based storage """
+class BdbStore(SimpleStore, BdbEnvironmentMixin):
+    """Berkeley DB based storage.
+
+    Database handles are opened when first needed, with DB_THREAD, and kept
+    open. Opening and closing handles is serialized by a lock, so records may
+    be fetched by several threads at once.
+    """
     cxns = {}
 
     def __init__(self, session, config, parent):
         self.cxns = {}
+        self.cxnLock = threading.RLock()
         self.createArgs = {}
         SimpleStore.__init__(self, session, config, parent)
         self.switchingClass = SwitchingBdbConnection
@@ -870,7 +963,7 @@ class BdbStore(SimpleStore):
         if self.switching:
             cxn = self.switchingClass(session, self, dbp)
         else:
-            cxn = bdb.db.DB()
+            cxn = self._newDb(session)
         cxn.set_flags(bdb.db.DB_RECNUM)
         try:
             cxn.open(dbp, dbtype=bdb.db.DB_BTREE,
@@ -894,7 +987,7 @@ class BdbStore(SimpleStore):
             # We don't exist, try and instantiate new database
             self._create(session, dbp)
         else:
-            cxn = bdb.db.DB()
+            cxn = self._newDb(session)
             try:
                 cxn.open(dbp)
                 cxn.close()
@@ -904,7 +997,13 @@ class BdbStore(SimpleStore):
 
     def _openDb(self, session, dbType):
         cxn = self.cxns.get(dbType, None)
-        if cxn is None:
+        if cxn is not None:
+            return cxn
+        with self.cxnLock:
+            cxn = self.cxns.get(dbType, None)
+            if cxn is not None:
+                # Opened by another thread
+                return cxn
             dbp = self.get_path(session, dbType + 'Path')
             if dbp is None:
                 self._initDb(session, dbType)
@@ -928,30 +1027,26 @@ class BdbStore(SimpleStore):
             else:
                 # Trying to store something we don't care about
                 return None
-        else:
-            return cxn
 
     def _open(self, session, dbp):
         if self.switching:
             cxn = self.switchingClass(session, self, dbp)
         else:
-            cxn = bdb.db.DB()
+            cxn = self._newDb(session)
         cxn.set_flags(bdb.db.DB_RECNUM)
-        if session.environment == "apache":
-            cxn.open(dbp, flags=bdb.db.DB_NOMMAP)
-        else:
-            cxn.open(dbp)
+        cxn.open(dbp, flags=self._get_openFlags(session))
         return cxn
 
     def _closeDb(self, session, dbType):
-        cxn = self.cxns.get(dbType, None)
-        if cxn is not None:
-            try:
-                cxn.close()
-            except:
-                # silently fail, as we're closing anyway
-                pass
-            self.cxns[dbType] = None
+        with self.cxnLock:
+            cxn = self.cxns.get(dbType, None)
+            if cxn is not None:
+                try:
+                    cxn.close()
+                except:
+                    # silently fail, as we're closing anyway
+                    pass
+                self.cxns[dbType] = None
 
     def _remove(self, session, dbp):
         try:
@@ -3,6 +3,10 @@
 import sys
 import os
 
+from lxml import etree
+
+from cheshire3.baseObjects import Record
+from cheshire3.dynamic import makeObjectFromDom
 from cheshire3.server import SimpleServer
 from cheshire3.session import Session
 from cheshire3.exceptions import (
@@ -45,6 +49,8 @@ Please provide a different database identifier using the --database option.
 """.format(dbid)
         server.log_critical(session, msg)
         return 2
+    if args.jobs > 1:
+        return load_parallel(session, db, args)
     else:
         # Allow for multiple data arguments
         docFac = db.get_object(session, 'defaultDocumentFactory')
@@ -67,6 +73,91 @@ Please provide a different database identifier using the --database option.
             wf.process(session, docFac)
 
 
+def load_parallel(session, db, args):
+    """Load data into db, indexing in args.jobs processes.
+
+    Records are parsed and stored in this process, as RecordStores allocate
+    identifiers and must have a single writer. Each stored Record is then
+    indexed by one of args.jobs Tasks into its own temporary files, which
+    are merged when all have committed.
+    """
+    session.database = db.id
+    # Start the Tasks before any data is opened so that they do not share
+    # file handles with this process
+    tmConfig = etree.XML(
+        '<subConfig type="taskManager" id="loadTaskManager">'
+        '<objectType>cheshire3.parallel.mpTaskManager.ProcessTaskManager'
+        '</objectType>'
+        '<options><setting type="nTasks">{0}</setting></options>'
+        '</subConfig>'.format(args.jobs)
+    )
+    tm = makeObjectFromDom(session, tmConfig, db)
+    try:
+        recStore = db.get_path(session, 'recordStore')
+        docFac = db.get_object(session, 'defaultDocumentFactory')
+        storeWf = db.get_object(session, 'buildStoreSingleWorkflow')
+        indexWf = db.get_object(session, 'indexRecordWorkflow')
+        recIds = []
+        recStore.begin_storing(session)
+        for dataArg in args.data:
+            try:
+                docFac.load(session,
+                            dataArg,
+                            args.cache,
+                            args.format,
+                            args.tagname,
+                            args.codec
+                            )
+            except MissingDependencyException as e:
+                server.log_critical(session, e.reason)
+                missingDependencies = e.dependencies
+                raise MissingDependencyException('cheshire3-load script',
+                                                 missingDependencies
+                                                 )
+            for doc in docFac:
+                rec = storeWf.process(session, doc)
+                if isinstance(rec, Record) and rec.id is not None:
+                    recIds.append(rec.id)
+                    if not len(recIds) % 1000:
+                        server.log_info(session,
+                                        "Stored {0} records"
+                                        "".format(len(recIds))
+                                        )
+        recStore.commit_storing(session)
+        db.commit_metadata(session)
+        server.log_info(session,
+                        "Stored {0} records, indexing with {1} tasks"
+                        "".format(len(recIds), args.jobs)
+                        )
+        tm.call_all_wait(session, db, 'begin_indexing')
+        # Collect results in slices to report progress
+        step = max(1000, len(recIds) // 20)
+        failed = 0
+        for start in range(0, len(recIds), step):
+            results = tm.call_each(session, indexWf, 'process',
+                                   recIds[start:start + step])
+            for result in results:
+                if isinstance(result, list):
+                    # Formatted traceback
+                    failed += 1
+                    server.log_error(session, ''.join(result))
+            server.log_info(session,
+                            "Indexed {0} of {1} records"
+                            "".format(min(start + step, len(recIds)),
+                                      len(recIds))
+                            )
+        tm.call_all_wait(session, db, 'commit_indexing')
+        server.log_info(session, "Merging indexes")
+        db.commit_parallelIndexing(session)
+        if failed:
+            server.log_error(session,
+                             "{0} records not indexed".format(failed))
+            return 3
+        return 0
+    finally:
+        tm.shutdown(session)
+
+
 argparser = Cheshire3ArgumentParser(conflict_handler='resolve',
                                     description=__doc__.splitlines()[0]
                                     )
@@ -78,6 +169,13 @@ argparser.add_argument('-d', '--database', type=str,
 argparser.add_argument('data', type=str, action='store', nargs='+',
                        help="data to load into the Cheshire3 database."
                        )
+argparser.add_argument('-j', '--jobs', type=int,
+                       action='store', dest='jobs',
+                       default=1, metavar='JOBS',
+                       help=("number of processes to index records in. "
+                             "Records are stored by a single process, then "
+                             "indexed in parallel and the indexes merged.")
+                       )
 argparser.add_argument('-l', '--cache-level', type=int,
                        action='store', dest='cache',
                        default=0, metavar='CACHE',
@@ -114,7 +114,9 @@ Please provide a different database identifier using the --database option.
     else:
         qFac = db.get_object(session, 'defaultQueryFactory')
         query = qFac.get_query(session, args.query, format=args.format)
-        resultSet = db.search(session, query)
+        # Only the records to be displayed need be in rank order
+        resultSet = db.search(session, query,
+                              topK=args.startRec - 1 + args.maxRecs)
         return _format_resultSet(resultSet,
                                  maximumRecords=args.maxRecs,
                                  startRecord=args.startRec)
@@ -3,6 +3,10 @@ import sys
 import os
 import re
 import time
+import copy
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from lxml import etree
 try:
@@ -64,6 +68,29 @@ class SimpleDatabase(SummaryObject, Database):
                      "introspective web search interface."),
             'type': int,
             'options': "0|1"
+        },
+        'queryCacheSize': {
+            'docs': ("Maximum number of ResultSets to keep in memory for "
+                     "repeated searches. The least recently used are "
+                     "discarded first. Default 0 (no caching)"),
+            'type': int
+        },
+        'queryCacheItems': {
+            'docs': ("Maximum total number of items in the ResultSets kept "
+                     "for repeated searches. Default 0 (no limit)"),
+            'type': int
+        },
+        'queryCacheTTL': {
+            'docs': ("Number of seconds for which a ResultSet is kept for "
+                     "repeated searches. Default 0 (until its indexes are "
+                     "changed)"),
+            'type': int
+        },
+        'searchThreads': {
+            'docs': ("Number of threads in which to search the clauses of a "
+                     "boolean query, and the terms of a clause, "
+                     "concurrently. Default 0 (search one after another)"),
+            'type': int
         }
     }
 
@@ -88,6 +115,8 @@ class SimpleDatabase(SummaryObject, Database):
     indexConfigs = {}
     protocolMapConfigs = {}
     records = {}
+    queryCache = {}
+    searchPool = None
 
     def __init__(self, session, config, parent):
         self.indexes = CaselessDictionary()
@@ -95,6 +124,13 @@ class SimpleDatabase(SummaryObject, Database):
         self.indexConfigs = CaselessDictionary()
         self.protocolMapConfigs = CaselessDictionary()
         self.records = {}
+        # Query key -> [ResultSet, topK, time created, time last used,
+        #               stamps of indexes]
+        self.queryCache = {}
+        self.queryCacheLock = threading.Lock()
+        self.searchPool = None
+        self.searchPoolLock = threading.Lock()
+        self.searchLocal = threading.local()
         Database.__init__(self, session, config, parent)
         SummaryObject.__init__(self, session, config, parent)
         if not session.database:
@@ -167,6 +203,7 @@ class SimpleDatabase(SummaryObject, Database):
     def index_record(self, session, rec):
         if not self.indexes:
             self._cacheIndexes(session)
+        self.queryCache = {}
         for idx in self.indexes.itervalues():
             if not idx.get_setting(session, 'noIndexDefault', 0):
                 idx.index_record(session, rec)
@@ -185,6 +222,7 @@ class SimpleDatabase(SummaryObject, Database):
     def unindex_record(self, session, rec):
         if not self.indexes:
             self._cacheIndexes(session)
+        self.queryCache = {}
         for idx in self.indexes.itervalues():
             if not idx.get_setting(session, 'noUnindexDefault', 0):
                 idx.delete_record(session, rec)
@@ -200,6 +238,15 @@ class SimpleDatabase(SummaryObject, Database):
     def commit_indexing(self, session):
         for idx in self.indexes.itervalues():
             idx.commit_indexing(session)
+        self.queryCache = {}
+        return None
+
+    def commit_parallelIndexing(self, session):
+        if not self.indexes:
+            self._cacheIndexes(session)
+        for idx in self.indexes.itervalues():
+            idx.commit_parallelIndexing(session)
+        self.queryCache = {}
         return None
 
     def clear_indexes(self, session):
@@ -207,10 +254,117 @@ class SimpleDatabase(SummaryObject, Database):
             self._cacheIndexes(session)
         for idx in self.indexes.itervalues():
             idx.clear(session)
+        self.queryCache = {}
         return None
 
-    def _search(self, session, query):
+    def _fetch_indexStamps(self, session):
+        # Return stamps of all indexes, which change when any index is
+        # changed, including by another process
+        if not self.indexes:
+            self._cacheIndexes(session)
+        stamps = []
+        for id in sorted(self.indexes.keys()):
+            idx = self.indexes[id]
+            try:
+                indexStore = idx.get_path(session, 'indexStore')
+                stamps.append(indexStore.fetch_indexStamp(session, idx))
+            except (AttributeError, NotImplementedError):
+                # Changes cannot be detected, rely on queryCacheTTL
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _fetch_cachedResultSet(self, session, key, topK=0, stamps=None):
+        """Return a copy of the cached ResultSet for key, or None.
+
+        Entries cached when indexes had different stamps are discarded.
+        """
+        with self.queryCacheLock:
+            try:
+                entry = self.queryCache[key]
+            except KeyError:
+                return None
+            (rs, cachedTopK, created, used, cachedStamps) = entry
+            now = time.time()
+            ttl = self.get_setting(session, 'queryCacheTTL', 0)
+            if cachedStamps != stamps or (ttl and now - created > ttl):
+                del self.queryCache[key]
+                return None
+            if cachedTopK and not 0 < topK <= cachedTopK:
+                # Not ordered far enough
+                return None
+            entry[3] = now
+            return copy.copy(rs)
+
+    def _cache_resultSet(self, session, key, rs, topK=0, stamps=None):
+        """Keep a copy of ResultSet rs for repeated searches with key.
+
+        stamps are those of the indexes before rs was searched for.
+        """
+        with self.queryCacheLock:
+            maxItems = self.get_setting(session, 'queryCacheItems', 0)
+            if maxItems and len(rs) > maxItems:
+                return
+            now = time.time()
+            self.queryCache[key] = [copy.copy(rs), topK, now, now, stamps]
+            # Discard least recently used until within limits
+            maxSize = self.get_setting(session, 'queryCacheSize', 0)
+            while True:
+                entries = self.queryCache.values()
+                if (
+                    len(entries) <= maxSize and
+                    (not maxItems or
+                     sum([len(e[0]) for e in entries]) <= maxItems)
+                ):
+                    break
+                lru = min(self.queryCache.iteritems(), key=lambda x: x[1][3])
+                del self.queryCache[lru[0]]
+
+    def _get_searchPool(self, session):
+        """Return a pool of threads in which to search, or None.
+
+        Return None if searchThreads is not set, or if called from one of
+        the threads of the pool, as waiting there for other work in the same
+        pool could deadlock.
+        """
+        if getattr(self.searchLocal, 'inPool', False):
+            return None
+        nThreads = self.get_setting(session, 'searchThreads', 0)
+        if nThreads < 1:
+            return None
+        if self.searchPool is None:
+            with self.searchPoolLock:
+                if self.searchPool is None:
+                    self.searchPool = ThreadPool(nThreads)
+        return self.searchPool
+
+    def map_search(self, session, function, args):
+        """Return list of function(arg) for args, concurrently if possible.
+
+        Calls are made in the threads of the search pool when searchThreads
+        is set and there is more than one arg, otherwise one after another.
+        """
+        pool = self._get_searchPool(session)
+        if pool is None or len(args) < 2:
+            return [function(a) for a in args]
+
+        def pooled(arg):
+            self.searchLocal.inPool = True
+            return function(arg)
+
+        return pool.map(pooled, args)
+
+    def _searchClauses(self, query):
+        # Return list of the searchClauses (leaves) of query, left to right
         if not hasattr(query, 'leftOperand'):
+            return [query]
+        return (self._searchClauses(query.leftOperand) +
+                self._searchClauses(query.rightOperand))
+
+    def _search(self, session, query, clauseResults=None):
+        if clauseResults is not None and id(query) in clauseResults:
+            # Already searched, concurrently with other clauses
+            return clauseResults[id(query)]
+        elif not hasattr(query, 'leftOperand'):
             # Check resultset
             rsid = query.getResultSetId()
             if (rsid):
@@ -241,27 +395,31 @@ class SimpleDatabase(SummaryObject, Database):
                     raise ObjectDoesNotExistException(query.index.toCQL())
 
         else:
-            # get the indexStore
-            left = self._search(session, query.leftOperand)
-            right = self._search(session, query.rightOperand)
+            if clauseResults is None and self._get_searchPool(session):
+                # Search all clauses concurrently, then combine in turn
+                clauses = self._searchClauses(query)
+                rsList = self.map_search(
+                    session,
+                    lambda clause: self._search(session, clause),
+                    clauses
+                )
+                clauseResults = dict(zip([id(c) for c in clauses], rsList))
+            left = self._search(session, query.leftOperand, clauseResults)
+            right = self._search(session, query.rightOperand, clauseResults)
             if left.__class__ == right.__class__:
                 new = left.__class__(session, [], recordStore=left.recordStore)
-            elif left.__class__ == BitmapResultSet:
-                # Want to switch the left/right,
-                # but rset assumes list[0] is same type
-                new = right.__class__(session, [],
-                                      recordStore=right.recordStore)
+            elif BitmapResultSet in [left.__class__, right.__class__]:
+                if left.__class__ == BitmapResultSet:
+                    (bitmap, other) = (left, right)
+                else:
+                    (bitmap, other) = (right, left)
                 if query.boolean.value == 'prox':
                     # bitmaps can't do prox, so just raise
-                    msg = "Cannot use Prox with %s" % left.index.toCQL()
+                    msg = "Cannot use Prox with %s" % bitmap.index.id
                     raise QueryException(msg, 18)
-                elif query.boolean.value == 'not':
-                    # can't reorder without changing query
-                    return new.combine(session, [left, right], query, self)
-                else:
-                    return new.combine(session, [right, left], query, self)
-            elif right.__class__ == BitmapResultSet:
-                new = left.__class__(session, [], recordStore=left.recordStore)
+                # Items of other are filtered by or merged with the bitmap
+                new = other.__class__(session, [],
+                                      recordStore=other.recordStore)
             else:
                 new = SimpleResultSet(session, [])
             rs = new.combine(session, [left, right], query, self)
@@ -272,7 +430,18 @@ class SimpleDatabase(SummaryObject, Database):
             rs.query = trip
             return rs
 
-    def search(self, session, query):
+    def search(self, session, query, topK=0):
+        start = time.time()
+        cacheKey = None
+        if self.get_setting(session, 'queryCacheSize', 0):
+            # Key on the query before searching, which may modify it
+            cacheKey = (query.toCQL(), getattr(session.user, 'id', None))
+            stamps = self._fetch_indexStamps(session)
+            rs = self._fetch_cachedResultSet(session, cacheKey, topK, stamps)
+            if rs is not None:
+                query.resultSet = rs
+                rs.queryTime = time.time() - start
+                return rs
         # Check for optimized indexStore based search (eg SQL translation)
         storeList = self.get_path(session, 'indexStoreList')
         if not storeList:
@@ -288,7 +457,6 @@ class SimpleDatabase(SummaryObject, Database):
         # FIXME: Should respect multiple index stores somehow?
         idxStore = self.get_object(session, storeList[0])
         # Check if there's an indexStore specific search function
-        start = time.time()
         if hasattr(idxStore, 'search'):
             rs = idxStore.search(session, query, self)
         else:
@@ -296,92 +464,106 @@ class SimpleDatabase(SummaryObject, Database):
         # Now do top level stuff, like sort
         if rs.relevancy:
             rs.scale_weights()
-            rs.order(session, "weight")
+            rs.order(session, "weight", topK=topK)
         else:
             # CQL 1.2 sort definition
-            # URI: info:srw/cql-context-set/1/sort-v1.0
             try:
                 sk = query.sortKeys
             except AttributeError:
                 # pre CQL 1.2
                 query.resultSet = rs
                 rs.queryTime = time.time() - start
+                if cacheKey is not None:
+                    self._cache_resultSet(session, cacheKey, rs,
+                                          topK if rs.relevancy else 0,
+                                          stamps)
                 return rs
 
-            sk.reverse()  # stable sort = keys in reverse order
-            pm = self.get_path(session, 'protocolMap')
-            if not pm:
-                self._cacheProtocolMaps(session)
-                pm = self.protocolMaps.get('http://www.loc.gov/zing/srw/')
-                self.paths['protocolMap'] = pm
-            exact = cql.Relation('exact')
-            term = cql.Term('')
-            for idx in sk:
-                # resolve index
-                sc = cql.SearchClause(idx, exact, term)
-
-                index = pm.resolveIndex(session, sc)
-                # and find params from modifiers
-                if idx['ascending']:
-                    ascending = True
-                elif idx['descending']:
-                    ascending = False
-                elif hasattr(pm, 'defaultSortDirection'):
-                    ascending = pm.defaultSortDirection[:3].lower() == 'asc'
-                else:
-                    ascending = True
-
-                if idx['missingomit']:
-                    miss = 0
-                elif idx['missinghigh']:
-                    miss = 1
-                elif idx['missinglow']:
-                    miss = -1
-                elif idx['missingfail']:
+            self._sort_resultSet(session, rs, sk)
+        query.resultSet = rs
+        rs.queryTime = time.time() - start
+        if cacheKey is not None:
+            self._cache_resultSet(session, cacheKey, rs,
+                                  topK if rs.relevancy else 0,
+                                  stamps)
+        return rs
+
+    def _sort_resultSet(self, session, rs, sortKeys):
+        # Order rs by CQL 1.2 sortKeys
+        # URI: info:srw/cql-context-set/1/sort-v1.0
+        if not sortKeys:
+            return
+        pm = self.get_path(session, 'protocolMap')
+        if not pm:
+            self._cacheProtocolMaps(session)
+            pm = self.protocolMaps.get('http://www.loc.gov/zing/srw/')
+            self.paths['protocolMap'] = pm
+        exact = cql.Relation('exact')
+        term = cql.Term('')
+        specs = []
+        for idx in sortKeys:
+            # resolve index
+            sc = cql.SearchClause(idx, exact, term)
+
+            index = pm.resolveIndex(session, sc)
+            # and find params from modifiers
+            if idx['ascending']:
+                ascending = True
+            elif idx['descending']:
+                ascending = False
+            elif hasattr(pm, 'defaultSortDirection'):
+                ascending = pm.defaultSortDirection[:3].lower() == 'asc'
+            else:
+                ascending = True
+
+            if idx['missingomit']:
+                miss = 0
+            elif idx['missinghigh']:
+                miss = 1
+            elif idx['missinglow']:
+                miss = -1
+            elif idx['missingfail']:
+                miss = cql.Diagnostic()
+            elif idx['missingvalue']:
+                miss = idx['missingvalue'].value
+            elif hasattr(pm, 'defaultSortMissing'):
+                m = pm.defaultSortMissing
+                vals = ['low', 'omit', 'high']
+                if m in vals:
+                    miss = int(vals.index(m)) - 1
+                elif m == 'fail':
                     miss = cql.Diagnostic()
-                elif idx['missingvalue']:
-                    miss = idx['missingvalue'].value
-                elif hasattr(pm, 'defaultSortMissing'):
-                    m = pm.defaultSortMissing
-                    vals = ['low', 'omit', 'high']
-                    if m in vals:
-                        miss = int(vals.index(m)) - 1
-                    elif m == 'fail':
-                        miss = cql.Diagnostic()
-                    else:
-                        miss = m
                 else:
-                    miss = [-1, 1][int(ascending)]
-
-                if idx['respectcase']:
+                    miss = m
+            else:
+                miss = [-1, 1][int(ascending)]
+
+            if idx['respectcase']:
+                case = 1
+            elif idx['ignorecase']:
+                case = 0
+            elif hasattr(pm, 'defaultSortCase'):
+                if pm.defaultSortCase.lower() in ['1', 'true']:
                     case = 1
-                elif idx['ignorecase']:
-                    case = 0
-                elif hasattr(pm, 'defaultSortCase'):
-                    if pm.defaultSortCase.lower() in ['1', 'true']:
-                        case = 1
-                    else:
-                        case = 0
                 else:
-                    case = None
-
-                if idx['respectaccents']:
+                    case = 0
+            else:
+                case = None
+
+            if idx['respectaccents']:
+                accents = 1
+            elif idx['ignoreaccents']:
+                accents = 0
+            elif hasattr(pm, 'defaultSortAccents'):
+                if pm.defaultSortAccents.lower() in ['1', 'true']:
                     accents = 1
-                elif idx['ignoreaccents']:
-                    accents = 0
-                elif hasattr(pm, 'defaultSortAccents'):
-                    if pm.defaultSortAccents.lower() in ['1', 'true']:
-                        accents = 1
-                    else:
-                        accents = 0
                 else:
-                    accents = None
-                # Now, finally, order resultSet
-                rs.order(session, index, ascending=ascending,
-                         missing=miss, case=case, accents=accents)
-        query.resultSet = rs
-        rs.queryTime = time.time() - start
-        return rs
+                    accents = 0
+            else:
+                accents = None
+            specs.append((index, ascending, miss, case, accents))
+        # Sort on all keys at once
+        rs.order_multiple(session, specs)
 
     def scan(self, session, clause, nTerms=25, direction=">="):
         if (hasattr(clause, 'leftOperand')):
@@ -399,7 +581,18 @@ class SimpleDatabase(SummaryObject, Database):
 
 
 class OptimisingDatabase(SimpleDatabase):
-    """ Experimental query optimising database """
+    """Database that plans boolean queries before searching them.
+
+    Before searching, multi-term clauses are rewritten into triples, and the
+    number of records matching each clause is estimated from the summaries of
+    its terms in the index. Chains of 'and' are reordered rarest operand
+    first, with 'not' operands moved to the end, and subtrees that can match
+    no records are not searched at all. Use explain to see the plan for a
+    query.
+    """
+
+    # Estimate for clauses whose number of matches cannot be estimated
+    unknownResultCount = sys.maxint
 
     def __init__(self, session, config, parent):
         SimpleDatabase.__init__(self, session, config, parent)
@@ -414,7 +607,7 @@ class OptimisingDatabase(SimpleDatabase):
                 nbool = " or "
             elif (query.relation.value == "=" and not
                   query.term.value.isnumeric() and
-                  query.term.value.index(' ') > -1):
+                  query.term.value.find(' ') > -1):
                 nbool = " prox "
             else:
                 # Can't rewrite
@@ -440,68 +633,220 @@ class OptimisingDatabase(SimpleDatabase):
                 query.rightOperand = n
             return None
 
-    def _attachResultCount(self, session, query):
-        if not (hasattr(query, 'leftOperand')):
-            # If have masking chrs, assign positive number
-            if self.maskRe.search(query.term.value):
-                query.resultCount = 100
+    def _estimateResultCount(self, session, clause):
+        # Return upper bound of the number of records matching clause, from
+        # the summaries of its terms
+        unknown = self.unknownResultCount
+        rel = clause.relation
+        if (
+            clause.getResultSetId() or
+            self.maskRe.search(clause.term.value) or
+            rel.value not in ['any', 'all', '=', 'exact', 'window'] or
+            not (rel.prefix == 'cql' or
+                 rel.prefixURI == 'info:srw/cql-context-set/1/cql-v1.1')
+        ):
+            return unknown
+        pm = self.get_path(session, 'protocolMap')
+        if not pm:
+            self._cacheProtocolMaps(session)
+            pm = self.protocolMaps.get('http://www.loc.gov/zing/srw/')
+            self.paths['protocolMap'] = pm
+        idx = pm.resolveIndex(session, clause)
+        if idx is None or not hasattr(idx, 'sources'):
+            return unknown
+        p = idx.permissionHandlers.get('info:srw/operation/2/search', None)
+        if p and not (session.user and p.hasPermission(session,
+                                                       session.user)):
+            # Do not reveal statistics of a restricted index, searching it
+            # will raise PermissionException
+            return unknown
+        # Process term as Index.search will
+        res = {}
+        for src in idx.sources.get(rel.toCQL(),
+                                   idx.sources.get(rel.value,
+                                                   idx.sources[u'data'])):
+            res.update(src[1].process(session, [[clause.term.value]]))
+        counts = []
+        for k in res:
+            if k[:1] == '^':
+                k = k[1:]
+            if not k:
+                return unknown
+            try:
+                data = idx.fetch_term(session, k, summary=True)
+            except (NotImplementedError, AttributeError):
+                return unknown
+            if data:
+                counts.append(data[1])
             else:
-                pm = self.get_path(session, 'protocolMap')
-                if not pm:
-                    self._cacheProtocolMaps(session)
-                    pm = self.protocolMaps.get('http://www.loc.gov/zing/srw/')
-                    self.paths['protocolMap'] = pm
-                idx = pm.resolveIndex(session, query)
-                # terms should be atomic now.
-                scandata = idx.scan(session, query, 1)
-                if scandata[0][0] != query.term.value:
-                    # No matches
-                    query.resultCount = 0
-                else:
-                    query.resultCount = scandata[0][1][1]
+                counts.append(0)
+        if not counts:
+            return unknown
+        elif rel.value == 'any':
+            return sum(counts)
         else:
-            leftResultCount = query.leftOperand.resultCount
-            rightResultCount = query.rightOperand.resultCount
-            self._attachResultCount(session, query.leftOperand)
-            if (
-                query.boolean.value in ['and', 'prox'] and
-                leftResultCount == 0
-            ):
-                query.resultCount = 0
-                return
-
-            self._attachResultCount(session, query.rightOperand)
-            if query.boolean.value in ['and', 'prox']:
-                query.resultCount = min(leftResultCount, rightResultCount)
-                if (
-                    query.boolean.value == "and" and
-                    rightResultCount < leftResultCount
-                ):
-                    # Can't reorder prox
-                    temp = query.leftOperand
-                    query.leftOperand = query.rightOperand
-                    query.rightOperand = temp
-                    del temp
-            elif query.boolean.value == 'or':
-                query.resultCount = leftResultCount + rightResultCount
-                if rightResultCount > leftResultCount:
-                    temp = query.leftOperand
-                    query.leftOperand = query.rightOperand
-                    query.rightOperand = temp
-                    del temp
+            # All terms must match
+            return min(counts)
+
+    def _flattenAnd(self, query, operands, negated):
+        # Collect operands of a chain of 'and' triples into operands, moving
+        # the right operands of 'not' triples within it into negated
+        if (
+            hasattr(query, 'leftOperand') and
+            query.boolean.value in ['and', 'not'] and
+            not query.boolean.modifiers
+        ):
+            for o in [query.leftOperand, query.rightOperand]:
+                if hasattr(o, 'leftOperand') and o.prefixes:
+                    # Prefixes must stay where they are in the tree
+                    break
             else:
-                # Can't really predict not and can't reorder. just take LHS
-                query.resultCount = leftResultCount
-        return None
-
-    def _search(self, session, query):
+                self._flattenAnd(query.leftOperand, operands, negated)
+                if query.boolean.value == 'and':
+                    self._flattenAnd(query.rightOperand, operands, negated)
+                else:
+                    negated.append(query.rightOperand)
+                return
+        operands.append(query)
+
+    def _makeTriple(self, left, boolean, right, resultCount):
+        trip = cql.Triple()
+        trip.leftOperand = left
+        trip.boolean = cql.Boolean(boolean, [])
+        trip.rightOperand = right
+        trip.resultCount = resultCount
+        left.parent = trip
+        right.parent = trip
+        trip.boolean.parent = trip
+        return trip
+
+    def _planQuery(self, session, query):
+        # Attach estimated resultCount to query and its operands, reorder,
+        # and return the root of the planned query
+        unknown = self.unknownResultCount
+        if not hasattr(query, 'leftOperand'):
+            query.resultCount = self._estimateResultCount(session, query)
+            return query
+        operands = []
+        negated = []
+        self._flattenAnd(query, operands, negated)
+        if len(operands) + len(negated) > 1:
+            # Chain of 'and': estimate until an operand matches nothing
+            planned = []
+            for o in operands:
+                planned.append(self._planQuery(session, o))
+                if planned[-1].resultCount == 0:
+                    query.resultCount = 0
+                    return query
+            # Rarest first, as combine is fastest with smallest sets first
+            planned.sort(key=lambda o: o.resultCount)
+            resultCount = planned[0].resultCount
+            plan = planned.pop(0)
+            for o in planned:
+                plan = self._makeTriple(plan, 'and', o, resultCount)
+            # Then remove records matching negated operands
+            for o in negated:
+                o = self._planQuery(session, o)
+                if o.resultCount != 0:
+                    plan = self._makeTriple(plan, 'not', o, resultCount)
+            prefixes = dict(query.prefixes)
+            prefixes.update(plan.prefixes)
+            plan.prefixes = prefixes
+            plan.parent = query.parent
+            plan.config = query.config
+            return plan
+        # Other triples
+        left = self._planQuery(session, query.leftOperand)
+        query.leftOperand = left
+        left.parent = query
+        if (
+            query.boolean.value in ['and', 'prox', 'not'] and
+            left.resultCount == 0
+        ):
+            query.resultCount = 0
+            return query
+        right = self._planQuery(session, query.rightOperand)
+        query.rightOperand = right
+        right.parent = query
+        if query.boolean.value in ['and', 'prox']:
+            query.resultCount = min(left.resultCount, right.resultCount)
+        elif query.boolean.value == 'or':
+            query.resultCount = min(left.resultCount + right.resultCount,
+                                    unknown)
+        else:
+            query.resultCount = left.resultCount
+        return query
+
+    def plan_query(self, session, query):
+        """Plan query for searching, and return the planned query.
+
+        Rewrite multi-term clauses into triples, attach the estimated number
+        of matching records to each part as resultCount, and reorder chains
+        of 'and'. The returned query may share parts with query, which
+        should not be used afterwards.
+        """
+        if (
+            (not hasattr(query, 'leftOperand')) and
+            query.relation.value == "any"
+        ):
+            # Don't try to rewrite, futile.
+            pass
+        else:
+            n = self._rewriteQuery(session, query)
+            if n:
+                n.sortKeys = query.sortKeys
+                query = n
+        plan = self._planQuery(session, query)
+        plan.sortKeys = query.sortKeys
+        return plan
+
+    def explain(self, session, query):
+        """Return a description of the plan by which query would be searched.
+
+        Return a string with a line for each clause and boolean of the
+        planned query, indented by depth, with the estimated number of
+        matching records. Parts that can match no records are not searched.
+        query itself is not modified.
+        """
+        plan = self.plan_query(session, cql.parse(query.toCQL()))
+        lines = []
+        self._explainLines(plan, 0, lines)
+        return '\n'.join(lines)
+
+    def _explainLines(self, query, depth, lines):
+        if query.resultCount == self.unknownResultCount:
+            estimate = "?"
+        else:
+            estimate = str(query.resultCount)
+        if hasattr(query, 'leftOperand'):
+            desc = query.boolean.toCQL()
+        else:
+            desc = query.toCQL()
         if query.resultCount == 0:
+            lines.append("%s%s (estimate 0, not searched)" % ("  " * depth,
+                                                              desc))
+            return
+        lines.append("%s%s (estimate %s)" % ("  " * depth, desc, estimate))
+        if hasattr(query, 'leftOperand'):
+            self._explainLines(query.leftOperand, depth + 1, lines)
+            self._explainLines(query.rightOperand, depth + 1, lines)
+
+    def _searchClauses(self, query):
+        # Return list of the searchClauses of query that may match records
+        if getattr(query, 'resultCount', None) == 0:
+            return []
+        return SimpleDatabase._searchClauses(self, query)
+
+    def _search(self, session, query, clauseResults=None):
+        if getattr(query, 'resultCount', None) == 0:
             # No matches in this full subtree
-            return SimpleResultSet([])
+            rs = SimpleResultSet(session, [])
+            rs.query = query
+            return rs
         else:
-            return SimpleDatabase._search(self, session, query)
+            return SimpleDatabase._search(self, session, query, clauseResults)
 
-    def search(self, session, query):
+    def search(self, session, query, topK=0):
         # Check for optimized indexStore based search (eg SQL translation)
         storeList = self.get_path(session, 'indexStoreList')
         if not storeList:
@@ -519,108 +864,23 @@ class OptimisingDatabase(SimpleDatabase):
         if hasattr(idxStore, 'search'):
             return idxStore.search(session, query, self)
         else:
-            if (
-                (not hasattr(query, 'leftOperand')) and
-                query.relation.value == "any"
-            ):
-                # Don't try to rewrite, futile.
-                pass
-            else:
-                n = self._rewriteQuery(session, query)
-                if n:
-                    query = n
-            if not hasattr(query, 'leftOperand'):
-                # Single term or any in single clause
-                query.resultCount = 1
-                rs = self._search(session, query)
-            else:
-                # Triples... walk and look for ANDs that have a 0 length rs
-                # Attach resultsets with counts
-                self._attachResultCount(session, query)
-                if query.resultCount == 0:
-                    # no matches
-                    return SimpleResultSet([])
-                else:
-                    rs = self._search(session, query)
+            query = self.plan_query(session, query)
+            if query.resultCount == 0:
+                # No matches
+                rs = SimpleResultSet(session, [])
+                rs.query = query
+                query.resultSet = rs
+                return rs
+            rs = self._search(session, query)
 
         # now do top level stuff, like sort
 
         if rs.relevancy:
             rs.scale_weights()
-            rs.order(session, "weight")
+            rs.order(session, "weight", topK=topK)
         elif query.sortKeys:
             # CQL 1.2 sort definition
-            # URI: info:srw/cql-context-set/1/sort-v1.0
-
-            sk = query.sortKeys
-            sk.reverse()  # stable sort = keys in reverse order
-            pm = self.get_path(session, 'protocolMap')
-            if not pm:
-                self._cacheProtocolMaps(session)
-                pm = self.protocolMaps.get('http://www.loc.gov/zing/srw/')
-                self.paths['protocolMap'] = pm
-            for idx in sk:
-                # resolve index
-                index = pm.resolveIndex(session, query)
-                # and find params from modifiers
-                if idx['ascending']:
-                    ascending = True
-                elif idx['descending']:
-                    ascending = False
-                elif hasattr(pm, 'defaultSortDirection'):
-                    ascending = pm.defaultSortDirection[:3].lower() == 'asc'
-                else:
-                    ascending = True
-
-                if idx['missingomit']:
-                    miss = 0
-                elif idx['missinghigh']:
-                    miss = 1
-                elif idx['missinglow']:
-                    miss = -1
-                elif idx['missingfail']:
-                    miss = cql.Diagnostic()
-                elif idx['missingvalue']:
-                    miss = idx['missingvalue'].value
-                elif hasattr(pm, 'defaultSortMissing'):
-                    m = pm.defaultSortMissing
-                    vals = ['low', 'omit', 'high']
-                    if m in vals:
-                        miss = int(vals.index(m)) - 1
-                    elif m == 'fail':
-                        miss = cql.Diagnostic()
-                    else:
-                        miss = m
-                else:
-                    miss = [-1, 1][int(ascending)]
-
-                if idx['respectcase']:
-                    case = 1
-                elif idx['ignorecase']:
-                    case = 0
-                elif hasattr(pm, 'defaultSortCase'):
-                    if pm.defaultSortCase.lower() in ['1', 'true']:
-                        case = 1
-                    else:
-                        case = 0
-                else:
-                    case = None
-
-                if idx['respectaccents']:
-                    accents = 1
-                elif idx['ignoreaccents']:
-                    accents = 0
-                elif hasattr(pm, 'defaultSortAccents'):
-                    if pm.defaultSortAccents.lower() in ['1', 'true']:
-                        accents = 1
-                    else:
-                        accents = 0
-                else:
-                    accents = None
-
-                # now, finally, order resultSet
-                rs.order(session, idx, ascending=asc,
-                         missing=miss, case=case, accents=accents)
+            self._sort_resultSet(session, rs, query.sortKeys)
 
         query.resultSet = rs
         return rs
@@ -47,8 +47,9 @@ class SimpleExtractor(Extractor):
         extraSpaceElems = self.get_setting(session, 'extraSpaceElements', '')
         self.extraSpaceElems = extraSpaceElems.split()
         self.strip = self.get_setting(session, 'stripWhitespace', 0)
-        self.cachedRoot = None
-        self.cachedElems = {}
+        # (root, element -> line number) of last tree, replaced whole so
+        # that threads extracting from different trees do not interfere
+        self.cachedElems = (None, {})
 
     def _mergeHash(self, a, b):
         if not a:
@@ -120,21 +121,20 @@ class SimpleExtractor(Extractor):
 
         if self.get_setting(session, 'reversable', 0):
             root = tree.getroot()
-            if root == self.cachedRoot:
-                lno = self.cachedElems[node]
-            else:
+            (cachedRoot, elems) = self.cachedElems
+            if root != cachedRoot:
                 lno = 0
-                self.cachedRoot = root
-                self.cachedElems = {}
+                elems = {}
                 try:
                     walker = tree.getiterator()
                 except AttributeError:
                     # lxml 1.3 or later
                     walker = tree.iter()
                 for n in walker:
-                    self.cachedElems[n] = lno
+                    elems[n] = lno
                     lno += 1
-                lno = self.cachedElems[node]
+                self.cachedElems = (root, elems)
+            lno = elems[node]
         else:
             lno = abs(hash(tree.getpath(node)))
         return lno
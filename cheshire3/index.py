@@ -2,10 +2,17 @@
 
 import os
 import re
+import sys
 import math
 import struct
+import operator
 import codecs
 import gzip
+import heapq
+import threading
+
+from array import array
+from itertools import izip, imap, islice
 
 try:
     import cStringIO as StringIO
@@ -21,6 +28,10 @@ from cheshire3.utils import (
     elementType,
     flattenTexts,
     vectorSimilarity,
+    packVarInts,
+    unpackVarInts,
+    zigzagEncode,
+    zigzagDecode,
     SimpleBitfield
 )
 from cheshire3.exceptions import (
@@ -111,6 +122,8 @@ class SimpleIndex(Index):
     currentPath = []
     storeOrig = 0
     canExtractSection = 1
+    canExtractColumns = 1
+    hasSkipTable = 0
 
     indexingTerm = ""
     indexingData = []
@@ -247,6 +260,19 @@ class SimpleIndex(Index):
                      "of records, occurrences or both"),
             'options': 'rec|occ|rec occ|occ rec'
         },
+        'termGrams': {
+            'docs': ("Length of k-grams in a dictionary of terms to store to "
+                     "resolve masked terms (e.g. *foo*, f?o*bar) without "
+                     "scanning the index. 0 (default) to store none"),
+            'type': int
+        },
+        'facetCacheSize': {
+            'docs': ("Number of lists of facets to keep in memory for "
+                     "repeated requests for the facets of the same query. "
+                     "The least recently used are discarded first. Default "
+                     "0 (no caching)"),
+            'type': int
+        },
         'longSize': {
             "docs": ("Size of a long integer in this index's underlying data "
                      "structure (eg to migrate between 32 and 64 bit "
@@ -393,6 +419,12 @@ class SimpleIndex(Index):
         self.caretRe = re.compile(r'(?<!\\)\^')
         self.qmarkRe = re.compile(r'(?<!\\)\?')
         self.astxRe = re.compile(r'(?<!\\)\*')
+        self.wildcardRe = re.compile(r'(?<!\\)[*?]')
+        self.escapeRe = re.compile(r'\\(.)')
+        # Facet key -> [index metadata, facets, last used]
+        self.facetCache = {}
+        self.facetCacheLock = threading.Lock()
+        self.facetCacheClock = 0
 
         Index.__init__(self, session, config, parent)
 
@@ -444,6 +476,14 @@ class SimpleIndex(Index):
             term = term[:-1]
         return term + '$'
 
+    def _wildcard_fragments(self, term):
+        # Return (literal fragments, starts term, ends term) for masked term
+        if (len(term) > 1) and (term[-1] == '^') and (term[-2] != '\\'):
+            term = term[:-1]
+        pieces = self.wildcardRe.split(term)
+        fragments = [self.escapeRe.sub(r'\1', x) for x in pieces if x]
+        return (fragments, bool(pieces[0]), bool(pieces[-1]))
+
     def _processRecord(self, session, record, source):
         (xpath, process, preprocess) = source
         if preprocess:
@@ -487,6 +527,7 @@ class SimpleIndex(Index):
         else:
             sortVal = ''
 
+        self.facetCache = {}
         for src in self.sources[u'data']:
             processed = self._processRecord(session, rec, src)
             if sortVal:
@@ -509,6 +550,7 @@ class SimpleIndex(Index):
                 raise PermissionException("Permission required to remove from "
                                           "index %s" % self.id)
         istore = self.get_path(session, 'indexStore')
+        self.facetCache = {}
 
         if self.get_setting(session, 'vectors', 0):
             # use vectors to unindex instead of reprocessing
@@ -561,11 +603,43 @@ class SimpleIndex(Index):
             stores.append(istore)
         for s in stores:
             s.commit_indexing(session, self)
+        self.facetCache = {}
 
     def commit_parallelIndexing(self, session):
         istore = self.get_path(session, 'indexStore')
         istore.commit_parallelIndexing(session, self)
 
+    def _merge_resultSets(self, session, resultSets):
+        # Union of the resultSets of terms expanded from a single term
+        base = self.resultSetClass(session, [], recordStore=self.recordStore)
+        base.recordStoreSizes = self.recordStoreSizes
+        base.index = self
+        return base.merge(session, resultSets)
+
+    def _prefetch_terms(self, session, store, keys, db):
+        # Return dict of data for unmasked terms of keys, fetched from store
+        # concurrently when db has threads in which to search
+        if (
+            len(keys) < 2 or
+            not hasattr(db, 'map_search') or
+            not db.get_setting(session, 'searchThreads', 0)
+        ):
+            return {}
+        terms = []
+        for k in keys:
+            if k[0] == '^':
+                k = k[1:]
+            if k and self._locate_firstMask(k) == -1:
+                terms.append(k)
+        if self.canExtractColumns and hasattr(store, 'fetch_packedTerm'):
+            fetch = store.fetch_packedTerm
+        else:
+            fetch = store.fetch_term
+        data = db.map_search(session,
+                             lambda term: fetch(session, self, term),
+                             terms)
+        return dict(zip(terms, data))
+
     def search(self, session, clause, db):
         # Final destination. Process Term.
         p = self.permissionHandlers.get('info:srw/operation/2/search', None)
@@ -626,32 +700,40 @@ class SimpleIndex(Index):
                 rel.prefixURI == 'info:srw/cql-context-set/1/cql-v1.1'
             )
         ):
+            fetched = self._prefetch_terms(session, store, res.keys(), db)
             for k, qHash in res.iteritems():
                 if k[0] == '^':
                     k = k[1:]
                 firstMask = self._locate_firstMask(k)
                 while (firstMask > 0) and (k[firstMask - 1] == '\\'):
                     firstMask = self._locate_firstMask(k, firstMask + 1)
-                # TODO: slow regex e.g. if first char is *
                 if (firstMask > -1):
-                    startK = k[:firstMask]
-                    try:
-                        nextK = startK[:-1] + unichr(ord(startK[-1]) + 1)
-                    except IndexError:
-                        # Left truncation, all terms from the index
-                        # TODO: we should check if there's a inversion of
-                        # index keys
-                        termList = store.fetch_termList(session, self,
-                                                        startK, 0, '>=')
-                    else:
-                        termList = store.fetch_termList(session, self,
-                                                        startK, 0, '>=',
-                                                        end=nextK)
+                    termList = None
+                    if (
+                        (firstMask < len(k) - 1 or k[firstMask] != '*') and
+                        self.get_setting(session, 'termGrams', 0) and
+                        hasattr(store, 'fetch_gramTermList')
+                    ):
+                        # Candidate terms from k-gram dictionary
+                        (frags, start, end) = self._wildcard_fragments(k)
+                        termList = store.fetch_gramTermList(session, self,
+                                                            frags, start, end)
+                    if termList is None:
+                        startK = k[:firstMask]
+                        try:
+                            nextK = startK[:-1] + unichr(ord(startK[-1]) + 1)
+                        except IndexError:
+                            # Left truncation, all terms from the index
+                            termList = store.fetch_termList(session, self,
+                                                            startK, 0, '>=')
+                        else:
+                            termList = store.fetch_termList(session, self,
+                                                            startK, 0, '>=',
+                                                            end=nextK)
                     if len(k) > 1:
                         # Filter terms by regex
-                        # FIXME: need to do something cleverer than this if
-                        # first character is masked. This implementation will
-                        # be incredibly slow for these cases...
+                        # NB: without termGrams, this will be incredibly slow
+                        # if the first character is masked
                         if (
                             (firstMask < len(k) - 1) or
                             (k[firstMask] in ['?', '^'])
@@ -678,8 +760,17 @@ class SimpleIndex(Index):
                             construct_resultSet(session, t[1], qHash)
                             for t in termList
                         ]
-                        maskBase = maskBase.combine(session, maskResultSets,
-                                                    maskClause, db)
+                        if rel.modifiers:
+                            maskBase = maskBase.combine(session,
+                                                        maskResultSets,
+                                                        maskClause, db)
+                        else:
+                            # Keep positions for proximity
+                            maskBase = maskBase.merge(
+                                session,
+                                maskResultSets,
+                                rel.value in ['=', 'adj', 'window']
+                            )
                         maskBase.queryTerm = qHash['text']
                         try:
                             maskBase.queryPositions = qHash['positions']
@@ -689,8 +780,22 @@ class SimpleIndex(Index):
                         pass
                     else:
                         matches.append(maskBase)
+                elif (
+                    self.canExtractColumns and
+                    hasattr(store, 'fetch_packedTerm')
+                ):
+                    # Copy postings straight into ResultSet columns
+                    try:
+                        data = fetched[k]
+                    except KeyError:
+                        data = store.fetch_packedTerm(session, self, k)
+                    s = self.construct_packedResultSet(session, data, qHash)
+                    matches.append(s)
                 else:
-                    term = store.fetch_term(session, self, k)
+                    try:
+                        term = fetched[k]
+                    except KeyError:
+                        term = store.fetch_term(session, self, k)
                     s = construct_resultSet(session, term, qHash)
                     matches.append(s)
         elif (clause.relation.value in ['>=', '>', '<', '<=']):
@@ -703,6 +808,8 @@ class SimpleIndex(Index):
                                                 0, clause.relation.value)
                 for t in termList:
                     matches.append(construct_resultSet(session, t[1]))
+                if len(matches) > 1 and not rel.modifiers:
+                    matches = [self._merge_resultSets(session, matches)]
         elif (clause.relation.value == "within"):
             if (len(res) != 2):
                 raise QueryException('%s "%s"' % (clause.relation.toCQL(),
@@ -713,6 +820,8 @@ class SimpleIndex(Index):
                                                 end=res.keys()[1])
                 matches.extend([construct_resultSet(session, t[1])
                                 for t in termList])
+                if len(matches) > 1 and not rel.modifiers:
+                    matches = [self._merge_resultSets(session, matches)]
         else:
             raise QueryException('%s "%s"' % (clause.relation.toCQL(),
                                               clause.term.value),
@@ -781,7 +890,148 @@ class SimpleIndex(Index):
         Return a list of (term, termdata) tuples from this index which occur
         within the records in resultSet. Terms are returned in descending
         frequency (number of records) order.
+
+        Records are counted by intersecting the postings of each term in
+        the index with resultSet, unless the index stores vectors and
+        resultSet is small compared to the index, in which case the vector
+        of each record is fetched instead. Facets of ResultSets from a query
+        are cached if the facetCacheSize setting is given.
         """
+        key = None
+        query = getattr(resultSet, 'query', None)
+        if query is not None and self.get_setting(session,
+                                                  'facetCacheSize', 0):
+            key = (query.toCQL(), len(resultSet), nTerms,
+                   getattr(session.user, 'id', None))
+            metadata = self.fetch_metadata(session)
+            with self.facetCacheLock:
+                entry = self.facetCache.get(key)
+                if entry is not None and entry[0] == metadata:
+                    self.facetCacheClock += 1
+                    entry[2] = self.facetCacheClock
+                    return list(entry[1])
+
+        docs = None
+        if self.get_setting(session, 'vectors', 0):
+            metadata = self.fetch_metadata(session)
+            # Fetching a vector costs far more than checking a posting
+            if metadata and len(resultSet) * 16 >= metadata['nRecs']:
+                docs = self._facet_docs(session, resultSet)
+        else:
+            docs = self._facet_docs(session, resultSet)
+
+        if docs is None:
+            terms = self._facet_vectorCounts(session, resultSet, nTerms)
+        else:
+            terms = self._facet_postingCounts(session, docs, nTerms)
+
+        if key is not None:
+            with self.facetCacheLock:
+                self.facetCacheClock += 1
+                self.facetCache[key] = [metadata, terms,
+                                        self.facetCacheClock]
+                maxSize = self.get_setting(session, 'facetCacheSize', 0)
+                while len(self.facetCache) > maxSize:
+                    lru = min(self.facetCache.iteritems(),
+                              key=lambda x: x[1][2])
+                    del self.facetCache[lru[0]]
+            terms = list(terms)
+        return terms
+
+    def _facet_docs(self, session, resultSet):
+        """Return dict of recordStore -> set of record ids in resultSet.
+
+        Return None if the records have no numeric identifiers with which to
+        look them up in postings.
+        """
+        storeHash = getattr(self.indexStore, 'storeHash', {})
+        docs = {}
+        columns = getattr(resultSet, '_columns', None)
+        if columns is not None:
+            (recIds, storeIds) = columns[:2]
+            stores = set(storeIds)
+            if len(stores) == 1:
+                storeId = stores.pop()
+                docs[storeHash.get(storeId, storeId)] = set(recIds)
+            else:
+                for (recId, storeId) in izip(recIds, storeIds):
+                    store = storeHash.get(storeId, storeId)
+                    docs.setdefault(store, set()).add(recId)
+            return docs
+        for r in resultSet:
+            docid = getattr(r, 'numericId', None)
+            if docid is None:
+                docid = r.id
+            if isinstance(docid, basestring) and docid.isdigit():
+                docid = long(docid)
+            elif type(docid) not in [int, long]:
+                return None
+            store = storeHash.get(r.recordStore, r.recordStore)
+            docs.setdefault(store, set()).add(docid)
+        return docs
+
+    def _facet_postingCounts(self, session, docs, nTerms=0):
+        # Count the records of docs in the postings of each term
+        storeHash = getattr(self.indexStore, 'storeHash', {})
+        packed = self.canExtractColumns
+        counts = []
+        for (term, data) in self.indexStore.fetch_packedTermList(session,
+                                                                 self):
+            if packed:
+                postings = array('i')
+                postings.fromstring(data)
+                if sys.byteorder == 'big':
+                    postings.byteswap()
+                termId = postings[0]
+                postings = izip(postings[3::3], postings[4::3],
+                                postings[5::3])
+            else:
+                rs = self.construct_resultSet(session,
+                                              self.deserialize_term(session,
+                                                                    data,
+                                                                    prox=0))
+                termId = rs.termid
+                columns = getattr(rs, '_columns', None)
+                if columns is not None:
+                    postings = izip(*columns)
+                elif hasattr(rs, 'bitfield'):
+                    # Bitmap of record ids, occurrences are not kept
+                    postings = [(recId, rs.recordStore, 1)
+                                for recId
+                                in rs.bitfield.trueItems()]
+                else:
+                    postings = []
+                    for x in rs:
+                        if x.numericId is not None:
+                            postings.append((x.numericId, x.recordStore,
+                                             x.occurences))
+                        else:
+                            postings.append((x.id, x.recordStore,
+                                             x.occurences))
+            nRecs = 0
+            nOccs = 0
+            currStore = None
+            recs = ()
+            for (recId, store, occs) in postings:
+                if store != currStore:
+                    currStore = store
+                    recs = docs.get(storeHash.get(store, store), ())
+                if recId in recs:
+                    nRecs += 1
+                    nOccs += occs
+            if nRecs:
+                counts.append((-nRecs, termId, term, nOccs))
+        # Descending number of records, then termId
+        if nTerms:
+            counts = heapq.nsmallest(nTerms, counts)
+        else:
+            counts.sort()
+        return [(term.decode('utf-8'), (termId, -nRecs, nOccs))
+                for (nRecs, termId, term, nOccs)
+                in counts]
+
+    def _facet_vectorCounts(self, session, resultSet, nTerms=0):
+        # Count terms in the vector of each record in resultSet
         termFreqs = {}
         recordFreqs = {}
         for r in resultSet:
@@ -802,10 +1052,11 @@ class SimpleIndex(Index):
         sortList = [(1.0 / v, k)
                     for k, v
                     in recordFreqs.iteritems()]
-        sortList.sort()
-        tids = [x[1] for x in sortList]
         if nTerms:
-            tids = tids[:min(len(tids), nTerms)]
+            sortList = heapq.nsmallest(nTerms, sortList)
+        else:
+            sortList.sort()
+        tids = [x[1] for x in sortList]
         terms = []
         for termId in tids:
             term = self.fetch_termById(session, termId)
@@ -989,50 +1240,54 @@ class SimpleIndex(Index):
         op          := replace | add | delete
         nRecs       := total records in newData
         nOccs       := total occurrences in newdata
+
+        Postings in currentData are expected to be in (docid, storeid) order,
+        as stored by IndexStores. The merge locates each item of newData by
+        binary search and copies the intervening postings in slices, so it
+        does not rescan currentData for every item.
         """
         (termid, oldTotalRecs, oldTotalOccs) = currentData[0:3]
-        currentData = list(currentData[3:])
+        currentData = currentData[3:]
+        newPostings = [newData[x:x + 3] for x in range(0, len(newData), 3)]
+        newPostings.sort()
+
+        merged = []
+        start = 0
+        end = len(currentData) / 3
+        for posting in newPostings:
+            key = (posting[0], posting[1])
+            # Find first remaining current posting not less than key
+            lo = start
+            hi = end
+            while lo < hi:
+                mid = (lo + hi) / 2
+                if (currentData[mid * 3], currentData[mid * 3 + 1]) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            merged.extend(currentData[start * 3:lo * 3])
+            start = lo
+            found = (lo < end and
+                     currentData[lo * 3] == key[0] and
+                     currentData[lo * 3 + 1] == key[1])
+            if op != 'add' and found:
+                # Drop current posting
+                start = lo + 1
+            if op != 'delete':
+                merged.extend(posting)
+        merged.extend(currentData[start * 3:])
 
         if op == 'add':
-            currentData.extend(newData)
             if nRecs:
                 trecs = oldTotalRecs + nRecs
                 toccs = oldTotalOccs + nOccs
             else:
                 trecs = oldTotalRecs + len(newData) / 3
                 toccs = oldTotalOccs + sum(newData[2::3])
-        elif op == 'replace':
-            for n in range(0, len(newData), 3):
-                docid = newData[n]
-                storeid = newData[n + 1]
-                replaced = 0
-                for x in range(3, len(currentData), 3):
-                    if (
-                        currentData[x] == docid and
-                        currentData[x + 1] == storeid
-                    ):
-                        currentData[x + 2] = newData[n + 2]
-                        replaced = 1
-                        break
-                if not replaced:
-                    currentData.extend([docid, storeid, newData[n + 2]])
-            trecs = len(currentData) / 3
-            toccs = sum(currentData[2::3])
-        elif op == 'delete':
-            for n in range(0, len(newData), 3):
-                docid = newData[n]
-                storeid = newData[n + 1]
-                for x in range(0, len(currentData), 3):
-                    if (
-                        currentData[x] == docid and
-                        currentData[x + 1] == storeid
-                    ):
-                        del currentData[x:(x + 3)]
-                        break
-            trecs = len(currentData) / 3
-            toccs = sum(currentData[2::3])
-        merged = [termid, trecs, toccs] + currentData
-        return merged
+        else:
+            trecs = len(merged) / 3
+            toccs = sum(merged[2::3])
+        return [termid, trecs, toccs] + merged
 
     def construct_resultSet(self, session, terms, queryHash={}):
         """Create and return a ResultSet.
@@ -1042,25 +1297,28 @@ class SimpleIndex(Index):
         """
         # in: unpacked
         # out: resultSet
-        l = len(terms)
-        ci = self.indexStore.construct_resultSetItem
         s = self.resultSetClass(session, [])
-#        rsilist = []
-#        for t in range(3,len(terms),3):
-#            item = ci(session, terms[t], terms[t+1], terms[t+2])
-#            item.resultSet = s
-#            rsilist.append(item)
-#
-#        s.fromList(rsilist)
-        # Filter out duplicates
-        rsis = {}
-        for t in range(3, len(terms), 3):
-            if terms[t] not in rsis:
-                item = ci(session, terms[t], terms[t + 1], terms[t + 2])
-                item.resultSet = s
-                rsis[item.id] = (t, item)
-        # Keep them in order
-        s.fromList([r[1] for r in sorted(rsis.values())])
+        # Columns of record ids, store ids and occurrences; ResultSetItems
+        # are only constructed as they are accessed
+        if isinstance(terms, array):
+            (recIds, storeIds, occs) = (terms[3::3], terms[4::3], terms[5::3])
+        else:
+            recIds = array('l', terms[3::3])
+            storeIds = array('l', terms[4::3])
+            occs = array('l', terms[5::3])
+        # Postings are in docid order, so any duplicates are adjacent
+        if any(imap(operator.eq, recIds, islice(recIds, 1, None))):
+            # Filter out duplicates, keeping them in order
+            keep = [0]
+            for x in xrange(1, len(recIds)):
+                if (recIds[x] != recIds[x - 1] or
+                        storeIds[x] != storeIds[x - 1]):
+                    keep.append(x)
+            recIds = array('l', [recIds[x] for x in keep])
+            storeIds = array('l', [storeIds[x] for x in keep])
+            occs = array('l', [occs[x] for x in keep])
+        s.fromColumns(session, recIds, storeIds, occs,
+                      self.indexStore.construct_resultSetItem)
         s.index = self
         if queryHash:
             s.queryTerm = queryHash['text']
@@ -1074,6 +1332,20 @@ class SimpleIndex(Index):
             s.totalOccs = 0
         return s
 
+    def construct_packedResultSet(self, session, data, queryHash={}):
+        """Create and return a ResultSet from serialized term data.
+
+        Only possible when canExtractColumns is true. Postings are copied
+        straight from data into the columns of the ResultSet, without
+        deserializing each one.
+        """
+        terms = array('i')
+        if data:
+            terms.fromstring(data)
+            if sys.byteorder == 'big':
+                terms.byteswap()
+        return self.construct_resultSet(session, terms, queryHash)
+
     # pass-throughs to indexStore
 
     def construct_resultSetItem(self, session, term,
@@ -1084,6 +1356,7 @@ class SimpleIndex(Index):
 
     def clear(self, session):
         self.indexStore.clear_index(session, self)
+        self.facetCache = {}
 
     def store_terms(self, session, data, rec):
         self.indexStore.store_terms(session, self, data, rec)
@@ -1119,6 +1392,13 @@ class SimpleIndex(Index):
     def fetch_sortValue(self, session, rec, ascending=True):
         return self.indexStore.fetch_sortValue(session, self, rec, ascending)
 
+    def fetch_sortKeys(self, session, recordStore):
+        try:
+            fetch = self.indexStore.fetch_sortKeys
+        except AttributeError:
+            return None
+        return fetch(session, self, recordStore)
+
     def merge_tempFiles(self, session):
         return self.indexStore.merge_tempFiles(session, self)
 
@@ -1134,6 +1414,8 @@ class SingleRecordStoreIndex(SimpleIndex):
     files.
     """
 
+    canExtractColumns = 0
+
     def serialize_term(self, session, termId, data, nRecs=0, nOccs=0):
         """Return a string serialization representing the term.
 
@@ -1206,6 +1488,7 @@ class ProximityIndex(SimpleIndex):
     """
 
     canExtractSection = 0
+    canExtractColumns = 0
     _possibleSettings = {
         'nProxInts': {
             'docs': ("Number of integers per occurence in this index for "
@@ -1250,78 +1533,61 @@ class ProximityIndex(SimpleIndex):
                    op="replace", nRecs=0, nOccs=0):
         # in: struct: deserialised, new: flag
         # out: flat
-
+        # Postings are in (docid, storeid) order, see SimpleIndex.merge_term
         (termid, oldTotalRecs, oldTotalOccs) = currentData[0:3]
-        currentData = list(currentData[3:])
-
-        if op == 'add':
-            # flatten
-            terms = []
-            for t in currentData:
-                terms.extend(t)
-            terms.extend(newData)
-            currentData = terms
-            if nRecs != 0:
-                trecs = oldTotalRecs + nRecs
-                toccs = oldTotalOccs + nOccs
-            else:
-                # ...
-                trecs = oldTotalRecs + len(newData)
-                toccs = oldTotalOccs
-                for t in newData:
-                    toccs = toccs + t[2]
-                raise ValueError("FIXME:  mergeTerms needs recs/occs params")
-
-        elif op == 'replace':
-            recs = [(x[0], x[1]) for x in currentData]
-            newOccs = 0
-            idx = 0
-            while idx < len(newData):
-                end = idx + 3 + (newData[idx + 2] * self.nProxInts)
-                new = list(newData[idx:end])
-                idx = end
-                docid = new[0]
-                storeid = new[1]
-                if (docid, storeid) in recs:
-                    loc = recs.index((docid, storeid))
-                    # subtract old occs
-                    occs = currentData[loc][2]
-                    newOccs -= occs
-                    currentData[loc] = new
+        currentData = currentData[3:]
+        newPostings = []
+        idx = 0
+        while idx < len(newData):
+            end = idx + 3 + (newData[idx + 2] * self.nProxInts)
+            newPostings.append(list(newData[idx:end]))
+            idx = end
+        newPostings.sort()
+
+        merged = []
+        newOccs = 0
+        start = 0
+        end = len(currentData)
+        for posting in newPostings:
+            key = (posting[0], posting[1])
+            # Find first remaining current posting not less than key
+            lo = start
+            hi = end
+            while lo < hi:
+                mid = (lo + hi) / 2
+                if (currentData[mid][0], currentData[mid][1]) < key:
+                    lo = mid + 1
                 else:
-                    currentData.append(new)
-                newOccs += new[2]
-            trecs = len(currentData)
+                    hi = mid
+            merged.extend(currentData[start:lo])
+            start = lo
+            found = (lo < end and
+                     currentData[lo][0] == key[0] and
+                     currentData[lo][1] == key[1])
+            if op != 'add' and found:
+                # Drop current posting, subtract its occs
+                newOccs -= currentData[lo][2]
+                start = lo + 1
+            if op != 'delete':
+                merged.append(posting)
+                newOccs += posting[2]
+        merged.extend(currentData[start:])
+
+        if op == 'add' and nRecs != 0:
+            trecs = oldTotalRecs + nRecs
+            toccs = oldTotalOccs + nOccs
+        elif op == 'add':
+            trecs = oldTotalRecs + len(newPostings)
+            toccs = oldTotalOccs + newOccs
+        else:
+            trecs = len(merged)
             toccs = oldTotalOccs + newOccs
-            # now flatten currentData
-            n = []
-            for s in currentData:
-                n.extend(s)
-            currentData = n
 
-        elif op == 'delete':
-            delOccs = 0
-            idx = 0
-            while idx < len(newData):
-                doc = list(newData[idx:idx + 3])
-                idx = idx + 3 + (doc[2] * self.nProxInts)
-                for x in range(len(currentData)):
-                    old = currentData[x]
-                    if old[0] == doc[0] and old[1] == doc[1]:
-                        delOccs = delOccs + old[2]
-                        del currentData[x]
-                        break
-            trecs = len(currentData) - 3
-            toccs = oldTotalOccs - delOccs
-            # now flatten
-            terms = []
-            for t in currentData:
-                terms.extend(t)
-            currentData = terms
-
-        merged = [termid, trecs, toccs]
-        merged.extend(currentData)
-        return merged
+        # now flatten
+        flat = [termid, trecs, toccs]
+        for posting in merged:
+            flat.extend(posting)
+        return flat
 
     def construct_resultSetItem(self, session, term, rsiType=""):
         # in: single triple
@@ -1371,6 +1637,182 @@ class ProximityIndex(SimpleIndex):
         return s
 
 
+class CompressedIndex(SimpleIndex):
+    """Index that stores compressed postings.
+
+    Record identifiers are gap encoded and stored, with recordStore
+    identifiers and occurrences, as variable length integers. Postings are
+    grouped into blocks with a table of skip pointers, allowing sections to
+    be read without decompressing the whole term. Sections are aligned to
+    block boundaries.
+    """
+
+    canExtractColumns = 0
+    hasSkipTable = 1
+    _possibleSettings = {
+        'skipBlockSize': {
+            'docs': ("Number of records per block of postings, each of which "
+                     "has a skip pointer (default: 128). The index must be "
+                     "rebuilt if this is changed."),
+            'type': int
+        }
+    }
+
+    def __init__(self, session, config, parent):
+        SimpleIndex.__init__(self, session, config, parent)
+        self.skipBlockSize = self.get_setting(session, 'skipBlockSize', 128)
+
+    def _calc_nBlocks(self, nRecs):
+        # Number of skip pointers, none for terms that fit in a single block
+        if nRecs <= self.skipBlockSize:
+            return 0
+        return (nRecs + self.skipBlockSize - 1) / self.skipBlockSize
+
+    def _pack_postings(self, data):
+        # Return list of (base docid, packed block)
+        blocks = []
+        prev = 0
+        step = self.skipBlockSize * 3
+        for b in range(0, len(data), step):
+            base = prev
+            ints = []
+            for x in range(b, min(b + step, len(data)), 3):
+                ints.extend((data[x] - prev, data[x + 1], data[x + 2]))
+                prev = data[x]
+            blocks.append((base, packVarInts(ints)))
+        return blocks
+
+    def serialize_term(self, session, termId, data, nRecs=0, nOccs=0):
+        # Always use actual number of records, as skip table depends on it
+        nRecs = len(data) / 3
+        if not nOccs:
+            nOccs = sum(data[2::3])
+        recIds = data[0::3]
+        if any(imap(operator.gt, recIds, islice(recIds, 1, None))):
+            # Postings not in docid order, gaps must not be negative
+            postings = [data[x:x + 3] for x in range(0, len(data), 3)]
+            postings.sort()
+            data = []
+            for posting in postings:
+                data.extend(posting)
+        blocks = self._pack_postings(data)
+        vals = [struct.pack('<lll', termId, nRecs, nOccs)]
+        nBlocks = self._calc_nBlocks(nRecs)
+        if nBlocks:
+            skips = []
+            offset = 0
+            for (base, packed) in blocks:
+                skips.extend((base, offset))
+                offset += len(packed)
+            vals.append(struct.pack('<' + 'LL' * nBlocks, *skips))
+        vals.extend([packed for (base, packed) in blocks])
+        return ''.join(vals)
+
+    def deserialize_term(self, session, data, nRecs=-1, prox=1):
+        out = list(struct.unpack('<lll', data[:12]))
+        if len(data) <= 12:
+            return out
+        nBlocks = self._calc_nBlocks(out[1])
+        start = 12 + (8 * nBlocks)
+        if nBlocks:
+            bases = struct.unpack('<' + 'LL' * nBlocks, data[12:start])[::2]
+        else:
+            bases = [0]
+        if nRecs == -1:
+            nRecs = out[1]
+        (ints, end) = unpackVarInts(data, nRecs * 3, start)
+        # Undo gap encoding, starting from base of each block
+        step = self.skipBlockSize * 3
+        for (b, base) in enumerate(bases):
+            prev = base
+            for x in range(b * step, min((b + 1) * step, len(ints)), 3):
+                prev += ints[x]
+                ints[x] = prev
+        out.extend(ints)
+        return out
+
+    def calc_skipTableLength(self, session, data):
+        """Return length of the skip table following the term summary.
+
+        data := summary of the term (first 3 longs)
+        """
+        (termid, nRecs, nOccs) = struct.unpack('<lll', data[:12])
+        return 8 * self._calc_nBlocks(nRecs)
+
+    def calc_sectionOffsets(self, session, start, nRecs, dataLen=0,
+                            skipTable=''):
+        nBlocks = len(skipTable) / 8
+        headLen = 12 + len(skipTable)
+        if not nBlocks:
+            # Single block
+            return [(headLen, dataLen - headLen)]
+        skips = struct.unpack('<' + 'LL' * nBlocks, skipTable)
+        (bases, offsets) = (skips[::2], skips[1::2])
+        first = min(start / self.skipBlockSize, nBlocks - 1)
+        if nRecs:
+            last = min((start + nRecs - 1) / self.skipBlockSize, nBlocks - 1)
+        else:
+            last = nBlocks - 1
+        a = headLen + offsets[first]
+        if last + 1 < nBlocks:
+            b = offsets[last + 1] - offsets[first]
+        else:
+            b = dataLen - a
+        # Prefix a skip table that makes the section decodable on its own
+        prefix = []
+        for base in bases[first:]:
+            prefix.extend((base, 0))
+        prefix.extend([0] * (2 * first))
+        return [(a, b, struct.pack('<' + 'LL' * nBlocks, *prefix))]
+
+
+class CompressedProximityIndex(ProximityIndex):
+    """ProximityIndex that stores compressed postings.
+
+    Record identifiers are gap encoded, and proximity information is delta
+    encoded within each record, and stored as variable length integers.
+    """
+
+    def serialize_term(self, session, termId, data, nRecs=0, nOccs=0):
+        # in: flat list of longs
+        ints = []
+        prev = 0
+        n = self.nProxInts
+        idx = 0
+        while idx < len(data):
+            (docid, storeid, occs) = data[idx:idx + 3]
+            ints.extend((zigzagEncode(docid - prev), storeid, occs))
+            prev = docid
+            last = [0] * n
+            end = idx + 3 + (occs * n)
+            for x in range(idx + 3, end, n):
+                for y in range(n):
+                    ints.append(zigzagEncode(data[x + y] - last[y]))
+                    last[y] = data[x + y]
+            idx = end
+        return struct.pack('<lll', termId, nRecs, nOccs) + packVarInts(ints)
+
+    def deserialize_term(self, session, data, nRecs=-1, prox=1):
+        docs = list(struct.unpack('<lll', data[:12]))
+        (ints, end) = unpackVarInts(data, -1, 12)
+        prev = 0
+        n = self.nProxInts
+        idx = 0
+        while idx < len(ints) and nRecs != len(docs) - 3:
+            prev += zigzagDecode(ints[idx])
+            occs = ints[idx + 2]
+            doc = [prev, ints[idx + 1], occs]
+            if prox:
+                last = [0] * n
+                for x in range(idx + 3, idx + 3 + (occs * n), n):
+                    for y in range(n):
+                        last[y] += zigzagDecode(ints[x + y])
+                    doc.extend(last)
+            idx += 3 + (occs * n)
+            docs.append(doc)
+        return docs
+
+
 class XmlIndex(SimpleIndex):
     """Index to store terms as XML structure.
 
@@ -1382,6 +1824,8 @@ class XmlIndex(SimpleIndex):
 
     """
 
+    canExtractColumns = 0
+
     def __init__(self, session, config, parent):
         SimpleIndex.__init__(self, session, config, parent)
         # ping etree to initialize
@@ -1630,6 +2074,8 @@ class RangeIndex(SimpleIndex):
                 raise QueryException(msg, 24)
             matches.extend([self.construct_resultSet(session, t[1])
                             for t in termList])
+            if len(matches) > 1 and not clause.relation.modifiers:
+                return self._merge_resultSets(session, matches)
             base = self.resultSetClass(session, [],
                                        recordStore=self.recordStore)
             base.recordStoreSizes = self.recordStoreSizes
@@ -1645,6 +2091,7 @@ class BitmapIndex(SimpleIndex):
     # store as hex -- fast to generate, 1 byte per 4 bits.
     # eval to go from hex to long for bit manipulation
 
+    canExtractColumns = 0
     _possiblePaths = {
         'recordStore': {
             "docs": ("The recordStore in which the records are kept "
@@ -1669,9 +2116,7 @@ class BitmapIndex(SimpleIndex):
             # HACK.  Accept bitfield from mergeTerms
             bf = data[0]
         else:
-            bf = SimpleBitfield()
-            for item in data[::3]:
-                bf[item] = 1
+            bf = SimpleBitfield.fromTrueItems(data[::3])
         pack = struct.pack('<lll', termId, nRecs, nOccs)
         val = pack + str(bf)
         return val
@@ -2056,6 +2501,10 @@ class PassThroughIndex(SimpleIndex):
         session.database = currDb
         return sv
 
+    def fetch_sortKeys(self, session, recordStore):
+        # Sort values are in the remote database
+        return None
+
     # No need to do anything during indexing
     def begin_indexing(self, session):
         pass
@@ -2063,6 +2512,9 @@ class PassThroughIndex(SimpleIndex):
     def commit_indexing(self, session):
         pass
 
+    def commit_parallelIndexing(self, session):
+        pass
+
     def index_record(self, session, rec):
         return rec
 
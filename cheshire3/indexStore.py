@@ -8,7 +8,14 @@ import time
 import glob
 import re
 import random
-import fileinput
+import shutil
+import heapq
+import itertools
+import threading
+import atexit
+import weakref
+
+from array import array
 
 try:
     # Python 2.3 vs 2.2
@@ -24,13 +31,46 @@ from cheshire3.exceptions import FileDoesNotExistException,\
     FileAlreadyExistsException, PermissionException
 from cheshire3.resultSet import SimpleResultSetItem
 from cheshire3.index import *
-from cheshire3.baseStore import SwitchingBdbConnection
+from cheshire3.baseStore import SwitchingBdbConnection, BdbEnvironmentMixin
 from cheshire3.utils import getShellResult
 
 
 nonTextToken = "\x00\t"
 NumTypes = [types.IntType, types.LongType]
 
+# Header identifying a binary temporary or run file
+runFileMagic = "\x00C3RUN\x01\n"
+# Per entry header for binary files: length of term, number of integers
+runEntryStruct = struct.Struct('<LL')
+# Entry in a table of record lengths
+recordLengthStruct = struct.Struct('<l')
+# Marks the start and end of a term in its k-grams
+termGramBoundary = "\x00"
+
+
+def packEntry(term, ints):
+    """Return a binary file entry for term and list of integers."""
+    return (runEntryStruct.pack(len(term), len(ints)) +
+            term +
+            struct.pack('<%dl' % len(ints), *ints))
+
+
+# IndexStores holding buffered updates, keyed by id
+bufferedIndexStores = weakref.WeakValueDictionary()
+bufferedIndexStoresLock = threading.Lock()
+
+
+def flush_indexStoreBuffers():
+    """Store the updates still buffered by all IndexStores."""
+    with bufferedIndexStoresLock:
+        stores = bufferedIndexStores.values()
+        bufferedIndexStores.clear()
+    for store in stores:
+        store._flushBuffers(store.session)
+
+
+atexit.register(flush_indexStoreBuffers)
+
 
 class IndexStoreIter(object):
     # step through our indexes!
@@ -67,7 +107,17 @@ class IndexStoreIter(object):
         return self.next()
 
 
-class BdbIndexStore(IndexStore):
+class BdbIndexStore(IndexStore, BdbEnvironmentMixin):
+    """IndexStore keeping each Index in BerkeleyDB databases.
+
+    The read path (fetching terms, scanning and fetching record identifiers,
+    lengths and sort values) may be used by several threads at once: database
+    handles are opened lazily under a lock and kept open, cursors are created
+    per call, and the term cache has its own lock. Writes to the store, and
+    allocating internal record identifiers, are serialized by the same lock
+    as opening handles. Handles are opened with DB_THREAD, so that they may
+    be shared between threads.
+    """
 
     indexing = 0
     outFiles = {}
@@ -80,6 +130,7 @@ class BdbIndexStore(IndexStore):
     vectorCxn = {}
     proxVectorCxn = {}
     termIdCxn = {}
+    termGramCxn = {}
 
     reservedLongs = 3
 
@@ -95,7 +146,7 @@ class BdbIndexStore(IndexStore):
         },
         'sortPath': {
             'docs': ("Path to the 'sort' utility used for sorting temporary "
-                     "files")
+                     "files when sortMode is 'shell'")
         }
     }
 
@@ -136,9 +187,62 @@ class BdbIndexStore(IndexStore):
             'docs': "Create a sub-directory for each index, yes or no?",
             'type': int,
             'options': '0|1'
+        },
+        'sortMode': {
+            'docs': ("How to sort temporary files when committing batch mode "
+                     "indexing. 'native' (default) uses an in-process "
+                     "external merge sort, 'shell' uses the utility "
+                     "configured in sortPath."),
+            'options': 'native|shell'
+        },
+        'tempFileFormat': {
+            'docs': ("Format of temporary files written during batch mode "
+                     "indexing. 'text' (default) or 'binary' (more compact "
+                     "and faster to commit, requires sortMode 'native')"),
+            'options': 'text|binary'
+        },
+        'updateBufferSize': {
+            'docs': ("Number of records for which to buffer terms in memory "
+                     "when storing outside of batch mode indexing, before "
+                     "merging them into the index. 0 (default) merges the "
+                     "terms of each record immediately."),
+            'type': int
+        },
+        'updateBufferTime': {
+            'docs': ("Number of seconds after which terms buffered when "
+                     "updateBufferSize is set are merged into the index, the "
+                     "next time that terms are stored. Terms still buffered "
+                     "are merged by commit_indexing, or when the process "
+                     "exits."),
+            'type': int
+        },
+        'sortBufferSize': {
+            'docs': ("Number of term entries to sort in memory before "
+                     "spilling a sorted run to disk when sortMode is 'native'"
+                     " (default: 500000)"),
+            'type': int
+        },
+        'recordLengths': {
+            'docs': ("Maintain a table of the lengths (word counts) of "
+                     "indexed records, for use in relevance ranking instead "
+                     "of fetching each from its recordStore."),
+            'type': int,
+            'options': '0|1'
+        },
+        'termCacheSize': {
+            'docs': ("Number of bytes of term data to keep in memory for "
+                     "repeatedly searched terms. The least recently used "
+                     "terms are discarded first. Default 0 (no caching)"),
+            'type': int
         }
     }
 
+    # Maximum number of run files to merge at once in the native sort
+    maxMergeFiles = 128
+    # Maximum number of record lengths to hold in memory outside of batch
+    # mode indexing before writing them
+    maxPendingLengths = 1000
+
     def __init__(self, session, config, parent):
         IndexStore.__init__(self, session, config, parent)
         self.session = session
@@ -146,6 +250,21 @@ class BdbIndexStore(IndexStore):
 
         # Temporary, small, necessarily single, or don't care dbs/files
         self.outFiles = {}          # batch loading file
+        # Incremental update buffers
+        self.updateBuffers = {}     # term -> (docid, storeid) -> posting
+        self.updateBufferRecs = {}  # (storeid, docid) of buffered records
+        self.updateBufferTimes = {}  # time of first buffered record
+        # Record lengths
+        self.recordLengths = {}     # recordStore -> docid -> word count
+        self.recordLengthTables = {}  # recordStore -> (stat, array)
+        # Tables of ranks of sort values
+        self.sortKeyTables = {}     # (index, recordStore) -> (stat, array)
+        # Term data cache
+        self.termCache = {}         # index -> term -> [data, last used]
+        self.termCacheStamps = {}   # index -> stat of index file
+        self.termCacheStats = {}    # index -> hits, misses, evictions
+        self.termCacheBytes = 0
+        self.termCacheClock = 0
         self.metadataCxn = None     # indexStore level metadata
         self.identifierMapCxn = {}  # str recid <--> long recid
 
@@ -171,10 +290,15 @@ class BdbIndexStore(IndexStore):
         self.vectorCxn = {}         # recid -> term vector
         self.proxVectorCxn = {}     # recid -> term prox vector
         self.termFreqCxn = {}       # rank -> term
+        self.termGramCxn = {}       # k-gram -> terms
 
         self.createArgs = {}
+        # Serializes opening and closing of database handles, and writes
+        self.cxnLock = threading.RLock()
+        self.termCacheLock = threading.RLock()
 
         self.storeHash = {}
+        self.storeHashReverse = {}
         rsh = self.get_path(session, 'recordStoreHash')
         if rsh:
             wds = rsh.split()
@@ -202,11 +326,8 @@ class BdbIndexStore(IndexStore):
             if (f[:fnlen] == fnbase):
                 recstore = f[fnlen:-4]
                 dbp = os.path.join(dfp, f)
-                cxn = bdb.db.DB()
-                if session.environment == "apache":
-                    cxn.open(dbp, flags=bdb.db.DB_NOMMAP)
-                else:
-                    cxn.open(dbp)
+                cxn = self._newDb(session)
+                cxn.open(dbp, flags=self._get_openFlags(session))
                 self.identifierMapCxn[recstore] = cxn
 
     def __iter__(self):
@@ -215,40 +336,53 @@ class BdbIndexStore(IndexStore):
     def _openMetadata(self, session):
         if self.metadataCxn is not None:
             return self.metadataCxn
-        else:
+        with self.cxnLock:
+            if self.metadataCxn is not None:
+                return self.metadataCxn
             mp = self.get_path(session, 'metadataPath')
             if not mp:
                 dfp = self.get_path(session, 'defaultPath')
                 mp = os.path.join(dfp, 'metadata.bdb')
 
             if not os.path.exists(mp):
-                oxn = bdb.db.DB()
+                oxn = self._newDb(session)
                 oxn.open(mp, dbtype=bdb.db.DB_BTREE,
                          flags=bdb.db.DB_CREATE, mode=0660)
                 oxn.close()
 
-            cxn = bdb.db.DB()
-            if session.environment == "apache":
-                cxn.open(mp, flags=bdb.db.DB_NOMMAP)
-            else:
-                cxn.open(mp)
+            cxn = self._newDb(session)
+            cxn.open(mp, flags=self._get_openFlags(session))
             self.metadataCxn = cxn
             return cxn
 
     def _closeMetadata(self, session):
-        if self.metadataCxn is not None:
-            self.metadataCxn.close()
-            self.metadataCxn = None
+        with self.cxnLock:
+            if self.metadataCxn is not None:
+                self.metadataCxn.close()
+                self.metadataCxn = None
 
     def _closeIndex(self, session, index):
-        if index in self.indexCxn:
-            self.indexCxn[index].close()
-            del self.indexCxn[index]
+        with self.cxnLock:
+            if index in self.indexCxn:
+                self.indexCxn[index].close()
+                del self.indexCxn[index]
+
+    def _syncIndex(self, session, index):
+        # Flush writes to index to disk, keeping the handle open as it may
+        # be in use by searching threads
+        with self.cxnLock:
+            if index in self.indexCxn:
+                self.indexCxn[index].sync()
 
     def _openIndex(self, session, index):
-        if index in self.indexCxn:
+        try:
             return self.indexCxn[index]
-        else:
+        except KeyError:
+            pass
+        with self.cxnLock:
+            if index in self.indexCxn:
+                # Opened by another thread
+                return self.indexCxn[index]
             dfp = self.get_path(session, 'defaultPath')
             basename = self._generateFilename(index)
             dbp = os.path.join(dfp, basename)
@@ -266,12 +400,9 @@ class BdbIndexStore(IndexStore):
                 else:
                     cxn = self.switchingClass(session, self, dbp)
             else:
-                cxn = bdb.db.DB()
+                cxn = self._newDb(session)
 
-            if session.environment == "apache":
-                cxn.open(dbp, flags=bdb.db.DB_NOMMAP)
-            else:
-                cxn.open(dbp)
+            cxn.open(dbp, flags=self._get_openFlags(session))
             self.indexCxn[index] = cxn
             return cxn
 
@@ -287,65 +418,55 @@ class BdbIndexStore(IndexStore):
         return glob.glob(os.path.join(dfp, name + '*'))
 
     def _get_internalId(self, session, rec):
-        if rec.recordStore in self.identifierMapCxn:
-            cxn = self.identifierMapCxn[rec.recordStore]
-        else:
-            fn = "recordIdentifiers_{0}_{1}.bdb".format(self.id,
-                                                        rec.recordStore)
-            dfp = self.get_path(session, "defaultPath")
-            dbp = os.path.join(dfp, fn)
-            if not os.path.exists(dbp):
-                cxn = bdb.db.DB()
-                cxn.open(dbp, dbtype=bdb.db.DB_BTREE,
-                         flags=bdb.db.DB_CREATE, mode=0660)
-                cxn.close()
-            cxn = bdb.db.DB()
-            if session.environment == "apache":
-                cxn.open(dbp, flags=bdb.db.DB_NOMMAP)
+        # Allocating identifiers is a write
+        with self.cxnLock:
+            if rec.recordStore in self.identifierMapCxn:
+                cxn = self.identifierMapCxn[rec.recordStore]
             else:
-                cxn.open(dbp)
-            self.identifierMapCxn[rec.recordStore] = cxn
-        # Now we have cxn, check it rec exists
-        recid = rec.id
-        if type(recid) == unicode:
+                fn = "recordIdentifiers_{0}_{1}.bdb".format(self.id,
+                                                            rec.recordStore)
+                dfp = self.get_path(session, "defaultPath")
+                dbp = os.path.join(dfp, fn)
+                if not os.path.exists(dbp):
+                    cxn = self._newDb(session)
+                    cxn.open(dbp, dbtype=bdb.db.DB_BTREE,
+                             flags=bdb.db.DB_CREATE, mode=0660)
+                    cxn.close()
+                cxn = self._newDb(session)
+                cxn.open(dbp, flags=self._get_openFlags(session))
+                self.identifierMapCxn[rec.recordStore] = cxn
+            # Now we have cxn, check it rec exists
+            recid = rec.id
+            if type(recid) == unicode:
+                try:
+                    recid = rec.id.encode('utf-8')
+                except:
+                    recid = rec.id.encode('utf-16')
             try:
-                recid = rec.id.encode('utf-8')
+                data = cxn.get(recid)
+                if data:
+                    return long(data)
             except:
-                recid = rec.id.encode('utf-16')
-        try:
-            data = cxn.get(recid)
-            if data:
-                return long(data)
-        except:
-            pass
-        # Doesn't exist, write
-        c = cxn.cursor()
-        c.set_range("__i2s_999999999999999")
-        data = c.prev()
-        if (data and data[0][:6] == "__i2s_"):
-            max = long(data[0][6:])
-            intid = "%015d" % (max + 1)
-        else:
-            intid = "000000000000000"
-        cxn.put(recid, intid)
-        cxn.put("__i2s_%s" % intid, recid)
-        return long(intid)
+                pass
+            # Doesn't exist, write
+            c = cxn.cursor()
+            c.set_range("__i2s_999999999999999")
+            data = c.prev()
+            if (data and data[0][:6] == "__i2s_"):
+                max = long(data[0][6:])
+                intid = "%015d" % (max + 1)
+            else:
+                intid = "000000000000000"
+            cxn.put(recid, intid)
+            cxn.put("__i2s_%s" % intid, recid)
+            return long(intid)
 
     def _get_externalId(self, session, recordStore, identifier):
-        if recordStore in self.identifierMapCxn:
+        try:
             cxn = self.identifierMapCxn[recordStore]
-        else:
-            fn = "recordIdentifiers_" + self.id + "_" + recordStore + ".bdb"
-            dfp = self.get_path(session, "defaultPath")
-            dbp = os.path.join(dfp, fn)
-            if not os.path.exists(dbp):
-                raise FileDoesNotExistException(dbp)
-            cxn = bdb.db.DB()
-            if session.environment == "apache":
-                cxn.open(dbp, flags=bdb.db.DB_NOMMAP)
-            else:
-                cxn.open(dbp)
-            self.identifierMapCxn[recordStore] = cxn
+        except KeyError:
+            with self.cxnLock:
+                cxn = self._openIdentifierMap(session, recordStore)
         identifier = "%015d" % identifier
         data = cxn.get("__i2s_%s" % identifier)
         if data:
@@ -360,6 +481,20 @@ class BdbIndexStore(IndexStore):
             msg = "%s/%s" % (recordStore, identifier)
             raise FileDoesNotExistException(msg)
 
+    def _openIdentifierMap(self, session, recordStore):
+        # Open existing map of identifiers for recordStore; call with lock
+        if recordStore in self.identifierMapCxn:
+            return self.identifierMapCxn[recordStore]
+        fn = "recordIdentifiers_" + self.id + "_" + recordStore + ".bdb"
+        dfp = self.get_path(session, "defaultPath")
+        dbp = os.path.join(dfp, fn)
+        if not os.path.exists(dbp):
+            raise FileDoesNotExistException(dbp)
+        cxn = self._newDb(session)
+        cxn.open(dbp, flags=self._get_openFlags(session))
+        self.identifierMapCxn[recordStore] = cxn
+        return cxn
+
     def fetch_summary(self, session, index):
         # Fetch summary data for all terms in index
         # eg for sorting, then iterating
@@ -379,8 +514,6 @@ class BdbIndexStore(IndexStore):
                 (term, val) = cursor.next(doff=0, dlen=dataLen)
             except:
                 val = 0
-
-        self._closeIndex(session, index)
         return terms
 
     def begin_indexing(self, session, index):
@@ -405,8 +538,10 @@ class BdbIndexStore(IndexStore):
             try:
                 os.mkdir(temp)
             except OSError:
-                msg = 'TempPath does not exist and is not creatable.'
-                raise ConfigFileException(msg)
+                # May have been created by another task in the meantime
+                if not os.path.isdir(temp):
+                    msg = 'TempPath does not exist and is not creatable.'
+                    raise ConfigFileException(msg)
         elif (not os.path.isdir(temp)):
             raise(ConfigFileException('TempPath is not a directory.'))
 
@@ -430,16 +565,29 @@ class BdbIndexStore(IndexStore):
 
         # In case we're called twice
         if (not index in self.outFiles):
-            self.outFiles[index] = codecs.open(basename + "_TEMP",
-                                               'a',
-                                               'utf-8',
-                                               'xmlcharrefreplace')
+            if self.get_setting(session, 'tempFileFormat', 'text') == 'binary':
+                fn = basename + "_TEMP"
+                new = not os.path.exists(fn) or not os.path.getsize(fn)
+                self.outFiles[index] = open(fn, 'ab')
+                if new:
+                    self.outFiles[index].write(runFileMagic)
+            else:
+                self.outFiles[index] = codecs.open(basename + "_TEMP",
+                                                   'a',
+                                                   'utf-8',
+                                                   'xmlcharrefreplace')
             if (index.get_setting(session, "sortStore")):
                 # Store in db for faster sorting
                 dfp = self.get_path(session, "defaultPath")
                 name = self._generateFilename(index) + "_VALUES"
 
                 fullname = os.path.join(dfp, name)
+                if getattr(session, 'task', None):
+                    # Separate store per task, merged by
+                    # commit_parallelIndexing
+                    fullname += str(session.task)
+                    if not os.path.exists(fullname):
+                        self._create(session, fullname, vectorType=0)
 
                 if self.vectorSwitching:
                     vbt = self.get_setting(session,
@@ -459,7 +607,7 @@ class BdbIndexStore(IndexStore):
                         bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
                     )
                 else:
-                    cxn = bdb.db.DB()
+                    cxn = self._newDb(session)
                 if session.environment == "apache" or session.task:
                     # Do not memory map in multiprocess environments
                     cxn.open(fullname, flags=bdb.db.DB_NOMMAP)
@@ -482,6 +630,12 @@ class BdbIndexStore(IndexStore):
                 msg = "Permission required to add to indexStore %s" % self.id
                 raise PermissionException(msg)
 
+        self._commitRecordLengths(session)
+        if index in self.updateBuffers:
+            self._flushUpdateBuffer(session, index)
+            if (not index in self.outFiles):
+                return None
+
         temp = self.get_path(session, 'tempPath')
         dfp = self.get_path(session, 'defaultPath')
         if not os.path.isabs(temp):
@@ -495,10 +649,16 @@ class BdbIndexStore(IndexStore):
 
         if (not index in self.outFiles):
             raise FileDoesNotExistException(index.id)
-        sort = self.get_path(session, 'sortPath')
-        if (not os.path.exists(sort)):
-            msg = "Sort executable for %s does not exist" % self.id
-            raise ConfigFileException(msg)
+        native = self.get_setting(session, 'sortMode', 'native') != 'shell'
+        if not native:
+            if self.get_setting(session, 'tempFileFormat', 'text') != 'text':
+                msg = ("sortMode 'shell' cannot sort binary temporary files "
+                       "for %s" % self.id)
+                raise ConfigFileException(msg)
+            sort = self.get_path(session, 'sortPath')
+            if (not sort or not os.path.exists(sort)):
+                msg = "Sort executable for %s does not exist" % self.id
+                raise ConfigFileException(msg)
 
         fh = self.outFiles[index]
         fh.flush()
@@ -516,6 +676,29 @@ class BdbIndexStore(IndexStore):
         basename = os.path.join(temp, basename)
         tempfile = basename + "_TEMP"
         sorted = basename + "_SORT"
+        central = not ((hasattr(session, 'task') and session.task) or
+                       (hasattr(session, 'phase') and
+                        session.phase == 'commit_indexing1'))
+        if native:
+            # Sort in memory sized runs, then merge them
+            runs = self._sortRuns(session, index, tempfile, basename)
+            if not index.get_setting(session, 'vectors'):
+                os.remove(tempfile)
+            try:
+                if central:
+                    # Merge runs directly into the index
+                    return self._commitSortedTerms(session,
+                                                   index,
+                                                   self._mergeRuns(session,
+                                                                   runs),
+                                                   tempfile)
+                # Merge runs into a single file to be merged centrally
+                self._writeRun(session, sorted, self._mergeRuns(session, runs))
+            finally:
+                for fn in runs:
+                    os.remove(fn)
+            return sorted
+
         cmd = "%s %s -T %s -o %s" % (sort, tempfile, temp, sorted)
         getShellResult(cmd)
         # Sorting might fail.
@@ -525,15 +708,124 @@ class BdbIndexStore(IndexStore):
             raise ValueError(msg)
         if not index.get_setting(session, 'vectors'):
             os.remove(tempfile)
-        if ((hasattr(session, 'task') and session.task) or
-            (hasattr(session, 'phase') and
-             session.phase == 'commit_indexing1')):
+        if not central:
             return sorted
         # Original terms from data
         return self.commit_centralIndexing(session, index, sorted)
 
+    def _parseTempLine(self, session, line):
+        # Parse a line of a temporary file into (term, [docid, storeid,
+        # occurences, positions...])
+        data = line.split(nonTextToken)
+        fullinfo = []
+        for x in data[1:]:
+            try:
+                fullinfo.append(long(x))
+            except ValueError:
+                # Some unexpected data in the index :(
+                self.log_debug(session,
+                               'Unexpected value in raw index, '
+                               'attempting to recover...')
+                # Attempt to recover
+                # Find the first thing that could be a long but not
+                # entirely composed of 0s
+                try:
+                    mylong = long(re.search('\d*[1-9]\d*', x).group(0))
+                except AttributeError:
+                    # No match - nothing we can do
+                    self.log_error(session,
+                                   'Unexpected value in raw index data, '
+                                   'skipping entry')
+                    continue
+                else:
+                    fullinfo.append(mylong)
+                    self.log_debug(session,
+                                   'Recovered value: {0}'.format(mylong))
+        return (data[0], fullinfo)
+
+    def _sortRuns(self, session, index, filePath, basename):
+        # Read temporary file, sorting it in chunks of sortBufferSize entries
+        # into binary run files. Return list of run filenames
+        bufferSize = self.get_setting(session, 'sortBufferSize', 500000)
+        runs = []
+        buff = []
+        for entry in self._readEntries(session, filePath):
+            buff.append(entry)
+            if len(buff) >= bufferSize:
+                buff.sort()
+                runs.append("%s_RUN%d" % (basename, len(runs)))
+                self._writeRun(session, runs[-1], buff)
+                buff = []
+        if buff or not runs:
+            buff.sort()
+            runs.append("%s_RUN%d" % (basename, len(runs)))
+            self._writeRun(session, runs[-1], buff)
+        return runs
+
+    def _writeRun(self, session, filePath, entries):
+        # Write iterable of sorted (term, [integers]) to a binary run file
+        fh = open(filePath, 'wb')
+        try:
+            write = fh.write
+            write(runFileMagic)
+            for (term, ints) in entries:
+                write(packEntry(term, ints))
+        finally:
+            fh.close()
+
+    def _readEntries(self, session, filePath):
+        # Generator of (term, [integers]) from a temporary, run or sorted
+        # file, in either binary or text format. Terms are UTF-8 encoded
+        fh = open(filePath, 'rb')
+        try:
+            if fh.read(len(runFileMagic)) == runFileMagic:
+                read = fh.read
+                unpack = runEntryStruct.unpack
+                headSize = runEntryStruct.size
+                while True:
+                    head = read(headSize)
+                    if len(head) < headSize:
+                        break
+                    (termLen, nInts) = unpack(head)
+                    term = read(termLen)
+                    ints = struct.unpack('<%dl' % nInts, read(4 * nInts))
+                    yield (term, list(ints))
+            else:
+                fh.seek(0)
+                for line in fh:
+                    if line[-1:] == "\n":
+                        line = line[:-1]
+                    (term, fullinfo) = self._parseTempLine(session, line)
+                    if len(fullinfo) >= 3:
+                        yield (term, fullinfo)
+        finally:
+            fh.close()
+
+    def _mergeRuns(self, session, filePaths):
+        # Generator of (term, [integers]) merged from sorted files
+        filePaths = list(filePaths)
+        intermediates = []
+        try:
+            # Merge in passes, to avoid having too many files open at once
+            while len(filePaths) > self.maxMergeFiles:
+                batch = filePaths[:self.maxMergeFiles]
+                filePaths = filePaths[self.maxMergeFiles:]
+                fn = "%s_MERGE%d" % (batch[0], len(intermediates))
+                self._writeRun(session,
+                               fn,
+                               heapq.merge(*[self._readEntries(session, x)
+                                             for x in batch]))
+                intermediates.append(fn)
+                filePaths.append(fn)
+            for entry in heapq.merge(*[self._readEntries(session, x)
+                                       for x in filePaths]):
+                yield entry
+        finally:
+            for fn in intermediates:
+                os.remove(fn)
+
     def commit_parallelIndexing(self, session, index):
-        sort = self.get_path(session, 'sortPath')
+        native = self.get_setting(session, 'sortMode', 'native') != 'shell'
         temp = self.get_path(session, 'tempPath')
         dfp = self.get_path(session, 'defaultPath')
         if not os.path.isabs(temp):
@@ -543,38 +835,93 @@ class BdbIndexStore(IndexStore):
                        "Merging parallel sort files for {0}"
                        "".format(index.id)
                        )
-        if (not os.path.exists(sort)):
-            msg = "Sort executable for %s does not exist" % self.id
-            raise ConfigFileException(msg)
         basename = self._generateFilename(index)
         baseGlob = os.path.join(temp, "%s*SORT" % basename)
         sortFileList = glob.glob(baseGlob)
-        sortFiles = " ".join(sortFileList)
         sorted = os.path.join(temp, "%s_SORT" % basename)
-        cmd = "%s -m -T %s -o %s %s" % (sort, temp, sorted, sortFiles)
-        out = getShellResult(cmd)
-        if not os.path.exists(sorted):
-            msg = "Didn't sort %s" % index.id
-            self.log_error(session, msg)
-            raise ValueError(msg)
-        # Merge multiple _TEMP files into a single _TEMP file
-        baseGlob = os.path.join(temp, "%s*_TEMP" % basename)
-        tempFileList = glob.glob(baseGlob)
-        self.log_debug(session,
-                       "Concatenating {0} parallel _TEMP files for {1}"
-                       "".format(len(tempFileList), index.id)
-                       )
+        if not native:
+            sort = self.get_path(session, 'sortPath')
+            if (not sort or not os.path.exists(sort)):
+                msg = "Sort executable for %s does not exist" % self.id
+                raise ConfigFileException(msg)
+            sortFiles = " ".join(sortFileList)
+            cmd = "%s -m -T %s -o %s %s" % (sort, temp, sorted, sortFiles)
+            out = getShellResult(cmd)
+            if not os.path.exists(sorted):
+                msg = "Didn't sort %s" % index.id
+                self.log_error(session, msg)
+                raise ValueError(msg)
         mergedFn = os.path.join(temp, "%s_TEMP" % basename)
-        # Merge natively in Python. This takes longer than using `cat` but is
-        # more reliable and should work cross-platform
-        with open(mergedFn, 'wb') as outfh:
-            for line in fileinput.input(tempFileList, mode='rb'):
-                outfh.write(line)
+        if index.get_setting(session, 'vectors'):
+            # Merge multiple _TEMP files into a single _TEMP file from which
+            # to build vectors. Tasks remove them when not building vectors
+            baseGlob = os.path.join(temp, "%s*_TEMP" % basename)
+            tempFileList = glob.glob(baseGlob)
+            self.log_debug(session,
+                           "Concatenating {0} parallel _TEMP files for {1}"
+                           "".format(len(tempFileList), index.id)
+                           )
+            # Merge natively in Python. This takes longer than using `cat`
+            # but is more reliable and should work cross-platform
+            with open(mergedFn, 'wb') as outfh:
+                for (i, tfn) in enumerate(tempFileList):
+                    with open(tfn, 'rb') as infh:
+                        # Only keep the header of the first binary file
+                        if (i and
+                                infh.read(len(runFileMagic)) != runFileMagic):
+                            infh.seek(0)
+                        shutil.copyfileobj(infh, outfh)
+            for tsfn in tempFileList:
+                os.remove(tsfn)
+        if index.get_setting(session, 'sortStore', 0):
+            self._mergeSortValues(session, index)
+        if native:
+            # Merge sorted files directly into the index
+            try:
+                return self._commitSortedTerms(session,
+                                               index,
+                                               self._mergeRuns(session,
+                                                               sortFileList),
+                                               mergedFn)
+            finally:
+                for tsfn in sortFileList:
+                    os.remove(tsfn)
         # Clean up
-        for tsfn in sortFileList + tempFileList:
+        for tsfn in sortFileList:
             os.remove(tsfn)
         return self.commit_centralIndexing(session, index, sorted)
 
+    def _mergeSortValues(self, session, index):
+        # Merge sort values stored by each parallel task into the sort store
+        dfp = self.get_path(session, "defaultPath")
+        name = os.path.join(dfp, self._generateFilename(index) + "_VALUES")
+        taskFiles = [fn
+                     for fn
+                     in glob.glob(name + "*")
+                     if fn[len(name):].isdigit()]
+        if not taskFiles:
+            return
+        cxn = self._openSortStore(session, index)
+        for fn in taskFiles:
+            taskCxn = self._newDb(session)
+            taskCxn.open(fn, flags=self._get_openFlags(session))
+            cursor = taskCxn.cursor()
+            tup = cursor.first()
+            while tup:
+                (key, val) = tup
+                existingVal = cxn.get(key)
+                if existingVal:
+                    sortVals = existingVal.split('\0') + val.split('\0')
+                    sortVals.sort()
+                    val = sortVals[0] + '\0' + sortVals[-1]
+                cxn.put(key, val)
+                tup = cursor.next()
+            taskCxn.close()
+            os.remove(fn)
+        with self.cxnLock:
+            cxn.close()
+            del self.sortStoreCxn[index]
+
     def commit_centralIndexing(self, session, index, filePath):
         p = self.permissionHandlers.get('info:srw/operation/2/index', None)
         if p:
@@ -594,6 +941,17 @@ class BdbIndexStore(IndexStore):
             basename = self._generateFilename(index)
             filePath = os.path.join(temp, basename + "_SORT")
 
+        result = self._commitSortedTerms(session,
+                                         index,
+                                         self._readEntries(session,
+                                                           filePath),
+                                         filePath[:-4] + "TEMP")
+        os.remove(filePath)
+        return result
+
+    def _commitSortedTerms(self, session, index, entries, tempFilePath):
+        # Finalize iterable of sorted (term, [integers]) into Index file(s)
+        # tempFilePath is the unsorted temporary file, used to build vectors
         cxn = self._openIndex(session, index)
         cursor = cxn.cursor()
         try:
@@ -634,7 +992,6 @@ class BdbIndexStore(IndexStore):
 
         currTerm = None
         currData = []
-        l = 1
 
         s2t = index.deserialize_term
         mt = index.merge_term
@@ -659,42 +1016,13 @@ class BdbIndexStore(IndexStore):
         maxNRecs = 0
         maxNOccs = 0
 
-        # Finalize sorted data in _SORT into Index file(s)
-        f = file(filePath)
-        while(l):
-            l = f.readline()[:-1]
-            data = l.split(nonTextToken)
-            term = data[0]
-            fullinfo = []
-            for x in data[1:]:
-                try:
-                    fullinfo.append(long(x))
-                except ValueError:
-                    # Some unexpected data in the index :(
-                    self.log_debug(session,
-                                   'Unexpected value in raw index, '
-                                   'attempting to recover...')
-                    # Attempt to recover
-                    # Find the first thing that could be a long but not
-                    # entirely composed of 0s
-                    try:
-                        mylong = long(re.search('\d*[1-9]\d*', x).group(0))
-                    except AttributeError:
-                        # No match - nothing we can do
-                        self.log_error(session,
-                                       'Unexpected value in raw index data, '
-                                       'skipping entry')
-                        continue
-                    else:
-                        fullinfo.append(mylong)
-                        self.log_debug(session,
-                                       'Recovered value: {0}'.format(mylong))
-            if term == currTerm:
+        # Sentinel entry to store the final term
+        for (term, fullinfo) in itertools.chain(entries, [(None, None)]):
+            if fullinfo is not None and term == currTerm:
                 # Accumulate
-                if fullinfo:
-                    totalRecs += 1
-                    totalOccs += fullinfo[2]
-                    currData.extend(fullinfo)
+                totalRecs += 1
+                totalOccs += fullinfo[2]
+                currData.extend(fullinfo)
             else:
                 # Store
                 if currData:
@@ -736,19 +1064,17 @@ class BdbIndexStore(IndexStore):
                     else:
                         # cheat and undo our term increment
                         termid -= 1
-                try:
+                if fullinfo is not None:
                     totalOccs = fullinfo[2]
                     termid += 1
                     currTerm = term
                     currData = fullinfo
                     totalRecs = 1
-                except:
-                    pass
 
-        self._closeIndex(session, index)
-        os.remove(filePath)
+        self._syncIndex(session, index)
+        self._clearTermCache(session, index)
 
-        if metadataCxn:
+        if metadataCxn is not None:
             # LLLLLL:  nTerms, nRecs, nOccs, maxRecs, maxOccs, totalChars
             val = struct.pack("<LLLLLL", nTerms, nRecs, nOccs,
                               maxNRecs, maxNOccs, totalChars)
@@ -761,7 +1087,7 @@ class BdbIndexStore(IndexStore):
             del tidcxn
 
         if vectors:
-            self._buildVectors(session, index, filePath[:-4] + "TEMP")
+            self._buildVectors(session, index, tempFilePath)
 
         fl = index.get_setting(session, 'freqList', "")
         if fl:
@@ -803,7 +1129,12 @@ class BdbIndexStore(IndexStore):
             except TypeError:
                 # no data in index
                 pass
-            self._closeIndex(session, index)
+
+        if index.get_setting(session, 'sortStore', 0):
+            self._buildSortKeys(session, index)
+
+        if index.get_setting(session, 'termGrams', 0):
+            self._buildTermGrams(session, index)
 
         return None
 
@@ -838,10 +1169,9 @@ class BdbIndexStore(IndexStore):
 
         # Temp filepath
         base = filePath
-        fh = codecs.open(base, 'r', 'utf-8', 'xmlcharrefreplace')
-        # Read in each line, look up
-        currDoc = "000000000000"
-        currStore = "0"
+        # Read in each entry, look up
+        currDoc = 0
+        currStore = 0
         docArray = []
         proxHash = {}
 
@@ -854,15 +1184,8 @@ class BdbIndexStore(IndexStore):
 
         totalTerms = 0
         totalFreq = 0
-        while True:
-            try:
-                l = fh.readline()[:-1]
-                bits = l.split(nonTextToken)
-            except:
-                break
-            if len(bits) < 4:
-                break
-            (term, docid, storeid, freq) = bits[:4]
+        for (term, bits) in self._readEntries(session, base):
+            (docid, storeid, freq) = bits[:3]
             if docArray and (docid != currDoc or currStore != storeid):
                 # store previous
                 docArray.sort()
@@ -870,17 +1193,16 @@ class BdbIndexStore(IndexStore):
                 [flat.extend(x) for x in docArray]
                 fmt = '<' + "L" * len(flat)
                 packed = struct.pack(fmt, *flat)
-                cxn.put(str("%s|%s" % (currStore, currDoc.encode('utf8'))),
-                        packed)
+                cxn.put("%d|%012d" % (currStore, currDoc), packed)
                 docArray = []
                 if proxVectors:
-                    pdocid = long(currDoc)
+                    pdocid = currDoc
                     for (elem, parr) in proxHash.iteritems():
                         proxKey = struct.pack('<LL', pdocid, elem)
                         if elem < 0 or elem > 4294967295:
                             raise ValueError(elem)
 
-                        proxKey = "%s|%s" % (currStore.encode('utf8'), proxKey)
+                        proxKey = "%d|%s" % (currStore, proxKey)
                         parr.sort()
                         flat = []
                         [flat.extend(x) for x in parr]
@@ -926,12 +1248,12 @@ class BdbIndexStore(IndexStore):
                 (minLocalFreq == -1 or tfreq >= minLocalFreq) and
                 (maxLocalFreq == -1 or tfreq <= maxLocalFreq)
             ):
-                docArray.append([tid, long(freq)])
+                docArray.append([tid, freq])
                 totalTerms += 1
-                totalFreq += long(freq)
+                totalFreq += freq
             if proxVectors:
                 nProxInts = index.get_setting(session, 'nProxInts', 2)
-                proxInfo = [long(x) for x in bits[4:]]
+                proxInfo = bits[3:]
                 tups = [proxInfo[x:x + nProxInts]
                         for x
                         in range(0, len(proxInfo), nProxInts)
@@ -952,12 +1274,12 @@ class BdbIndexStore(IndexStore):
             [flat.extend(x) for x in docArray]
             fmt = '<' + "L" * len(flat)
             packed = struct.pack(fmt, *flat)
-            cxn.put(str("%s|%s" % (storeid, docid.encode('utf8'))), packed)
+            cxn.put("%d|%012d" % (storeid, docid), packed)
             if proxVectors:
-                pdocid = long(currDoc)
+                pdocid = currDoc
                 for (elem, parr) in proxHash.iteritems():
                     proxKey = struct.pack('<LL', pdocid, elem)
-                    proxKey = "%s|%s" % (storeid.encode('utf8'), proxKey)
+                    proxKey = "%d|%s" % (storeid, proxKey)
                     parr.sort()
                     flat = []
                     [flat.extend(x) for x in parr]
@@ -966,62 +1288,69 @@ class BdbIndexStore(IndexStore):
                 proxCxn.close()
                 self.proxVectorCxn[index] = None
                 del proxCxn
-        fh.close()
         cxn.close()
         os.remove(base)
 
     def _closeVectors(self, session, index):
-        for cxnx in [self.termIdCxn, self.vectorCxn, self.proxVectorCxn]:
-            try:
-                cxnx[index].close()
-            except KeyError:
-                continue
+        with self.cxnLock:
+            for cxnx in [self.termIdCxn, self.vectorCxn, self.proxVectorCxn]:
+                try:
+                    cxnx[index].close()
+                except KeyError:
+                    continue
 
-            del cxnx[index]
+                del cxnx[index]
 
     def _openVectors(self, session, index):
+        with self.cxnLock:
+            if self.termIdCxn.get(index, None) is not None:
+                # Opened by another thread
+                return
+            dfp = self.get_path(session, 'defaultPath')
+            basename = self._generateFilename(index)
+            dbname = os.path.join(dfp, basename)
 
-        dfp = self.get_path(session, 'defaultPath')
-        basename = self._generateFilename(index)
-        dbname = os.path.join(dfp, basename)
-
-        dbp = dbname + "_TERMIDS"
-        if self.vectorSwitching:
-            vbt = self.get_setting(session, 'vectorBucketType', '')
-            vmb = self.get_setting(session, 'vectorMaxBuckets', 0)
-            vmi = self.get_setting(session, 'vectorMaxItemsPerBucket', 0)
-            cxn = self.vectorSwitchingClass(
-                session, self, dbp,
-                bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
-            )
-        else:
-            cxn = bdb.db.DB()
-
-        cxn.open(dbp)
-        self.termIdCxn[index] = cxn
-
-        if index.get_setting(session, 'vectors'):
-            dbp = dbname + "_VECTORS"
+            dbp = dbname + "_TERMIDS"
             if self.vectorSwitching:
+                vbt = self.get_setting(session, 'vectorBucketType', '')
+                vmb = self.get_setting(session, 'vectorMaxBuckets', 0)
+                vmi = self.get_setting(session, 'vectorMaxItemsPerBucket', 0)
                 cxn = self.vectorSwitchingClass(
                     session, self, dbp,
                     bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
                 )
             else:
-                cxn = bdb.db.DB()
-            cxn.open(dbp)
-            self.vectorCxn[index] = cxn
+                cxn = self._newDb(session)
 
-        if index.get_setting(session, 'proxVectors'):
-            dbp = dbname + "_PROXVECTORS"
-            if self.vectorSwitching:
-                cxn = self.vectorSwitchingClass(session, self, dbp,
-                                                bucketType=vbt, maxBuckets=vmb,
-                                                maxItemsPerBucket=vmi)
-            else:
-                cxn = bdb.db.DB()
-            cxn.open(dbp)
-            self.proxVectorCxn[index] = cxn
+            cxn.open(dbp, flags=self._get_openFlags(session))
+            tidcxn = cxn
+
+            if index.get_setting(session, 'vectors'):
+                dbp = dbname + "_VECTORS"
+                if self.vectorSwitching:
+                    cxn = self.vectorSwitchingClass(
+                        session, self, dbp,
+                        bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
+                    )
+                else:
+                    cxn = self._newDb(session)
+                cxn.open(dbp, flags=self._get_openFlags(session))
+                self.vectorCxn[index] = cxn
+
+            if index.get_setting(session, 'proxVectors'):
+                dbp = dbname + "_PROXVECTORS"
+                if self.vectorSwitching:
+                    cxn = self.vectorSwitchingClass(
+                        session, self, dbp,
+                        bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
+                    )
+                else:
+                    cxn = self._newDb(session)
+                cxn.open(dbp, flags=self._get_openFlags(session))
+                self.proxVectorCxn[index] = cxn
+            # Other threads take an open term identifier database to mean that
+            # all are open
+            self.termIdCxn[index] = tidcxn
 
     def fetch_vector(self, session, index, rec, summary=False):
         # rec can be resultSetItem or record
@@ -1137,15 +1466,16 @@ class BdbIndexStore(IndexStore):
             return data
 
     def _closeTermFreq(self, session, index, which):
-        try:
-            cxns = self.termFreqCxn[index]
-        except KeyError:
-            return
-        try:
-            cxns[which].close()
-        except KeyError:
-            return
-        del self.termFreqCxn[index][which]
+        with self.cxnLock:
+            try:
+                cxns = self.termFreqCxn[index]
+            except KeyError:
+                return
+            try:
+                cxns[which].close()
+            except KeyError:
+                return
+            del self.termFreqCxn[index][which]
 
     def _openTermFreq(self, session, index, which):
         fl = index.get_setting(session, "freqList", "")
@@ -1157,34 +1487,125 @@ class BdbIndexStore(IndexStore):
         if tfcxn is not None:
             return tfcxn
 
-        dfp = self.get_path(session, 'defaultPath')
-        basename = self._generateFilename(index)
-        dbname = os.path.join(dfp, basename)
-        dbp = dbname + "_FREQ_" + which.upper()
+        with self.cxnLock:
+            cxns = self.termFreqCxn.get(index, {})
+            tfcxn = cxns.get(which, None)
+            if tfcxn is not None:
+                # Opened by another thread
+                return tfcxn
 
-        if self.vectorSwitching:
-            vbt = self.get_setting(session, 'vectorBucketType', '')
-            vmb = self.get_setting(session, 'vectorMaxBuckets', 0)
-            vmi = self.get_setting(session, 'vectorMaxItemsPerBucket', 0)
-            tfcxn = self.vectorSwitchingClass(
-                session, self, dbp,
-                bucketType=vbt, maxBuckets=vmb, vectorMaxItemsPerBucket=vmi
-            )
-        else:
-            tfcxn = bdb.db.DB()
-        if which == 'rec':
-            tfcxn.open(dbp)
-            if cxns == {}:
-                self.termFreqCxn[index] = {'rec': tfcxn}
-            else:
-                self.termFreqCxn[index]['rec'] = tfcxn
-        elif which == 'occ':
-            tfcxn.open(dbp)
-            if cxns == {}:
-                self.termFreqCxn[index] = {'occ': tfcxn}
+            dfp = self.get_path(session, 'defaultPath')
+            basename = self._generateFilename(index)
+            dbname = os.path.join(dfp, basename)
+            dbp = dbname + "_FREQ_" + which.upper()
+
+            if self.vectorSwitching:
+                vbt = self.get_setting(session, 'vectorBucketType', '')
+                vmb = self.get_setting(session, 'vectorMaxBuckets', 0)
+                vmi = self.get_setting(session, 'vectorMaxItemsPerBucket', 0)
+                tfcxn = self.vectorSwitchingClass(
+                    session, self, dbp,
+                    bucketType=vbt, maxBuckets=vmb, vectorMaxItemsPerBucket=vmi
+                )
             else:
-                self.termFreqCxn[index]['occ'] = tfcxn
-        return tfcxn
+                tfcxn = self._newDb(session)
+            if which == 'rec':
+                tfcxn.open(dbp, flags=self._get_openFlags(session))
+                if cxns == {}:
+                    self.termFreqCxn[index] = {'rec': tfcxn}
+                else:
+                    self.termFreqCxn[index]['rec'] = tfcxn
+            elif which == 'occ':
+                tfcxn.open(dbp, flags=self._get_openFlags(session))
+                if cxns == {}:
+                    self.termFreqCxn[index] = {'occ': tfcxn}
+                else:
+                    self.termFreqCxn[index]['occ'] = tfcxn
+            return tfcxn
+
+    def _closeTermGrams(self, session, index):
+        with self.cxnLock:
+            try:
+                self.termGramCxn[index].close()
+                del self.termGramCxn[index]
+            except KeyError:
+                pass
+
+    def _openTermGrams(self, session, index):
+        if not index.get_setting(session, 'termGrams', 0):
+            return None
+        cxn = self.termGramCxn.get(index, None)
+        if cxn is not None:
+            return cxn
+
+        with self.cxnLock:
+            cxn = self.termGramCxn.get(index, None)
+            if cxn is not None:
+                # Opened by another thread
+                return cxn
+            dfp = self.get_path(session, 'defaultPath')
+            name = self._generateFilename(index) + "_GRAMS"
+            fullname = os.path.join(dfp, name)
+            if not os.path.exists(fullname):
+                # Index created before k-grams were configured
+                return None
+            cxn = self._newDb(session)
+            cxn.open(fullname, flags=self._get_openFlags(session))
+            self.termGramCxn[index] = cxn
+            return cxn
+
+    def _termGrams(self, term, n, start=True, end=True):
+        # Return set of k-grams of length n in utf-8 encoded term
+        # start and end mark whether term is bounded by the term start or end
+        if start:
+            term = termGramBoundary + term
+        if end:
+            term = term + termGramBoundary
+        grams = set()
+        for i in range(len(term) - n + 1):
+            grams.add(term[i:i + n])
+        return grams
+
+    def _storeTermGrams(self, session, index, terms, rebuild=False):
+        # Add utf-8 encoded terms to the k-gram dictionary for index
+        # If rebuild, terms are all of the terms in the index
+        cxn = self._openTermGrams(session, index)
+        if cxn is None:
+            return
+        n = index.get_setting(session, 'termGrams', 0)
+        gramTerms = {}
+        for term in terms:
+            for gram in self._termGrams(term, n):
+                try:
+                    gramTerms[gram].add(term)
+                except KeyError:
+                    gramTerms[gram] = set([term])
+        with self.cxnLock:
+            if rebuild:
+                cxn.truncate()
+            for gram in sorted(gramTerms):
+                gterms = gramTerms[gram]
+                if not rebuild:
+                    val = cxn.get(gram)
+                    if val:
+                        gterms.update(val.split(termGramBoundary))
+                cxn.put(gram, termGramBoundary.join(sorted(gterms)))
+            cxn.sync()
+
+    def _buildTermGrams(self, session, index):
+        # Rebuild the k-gram dictionary from all terms in index
+        cxn = self._openIndex(session, index)
+        cursor = cxn.cursor()
+        terms = []
+        try:
+            tup = cursor.first(doff=0, dlen=0)
+        except TypeError:
+            # Index is empty
+            tup = None
+        while tup:
+            terms.append(tup[0])
+            tup = cursor.next(doff=0, dlen=0)
+        self._storeTermGrams(session, index, terms, rebuild=True)
 
     def fetch_termFrequencies(self, session, index, mType='occ',
                               start=0, nTerms=100, direction=">"):
@@ -1270,7 +1691,7 @@ class BdbIndexStore(IndexStore):
                 bucketType=vbt, maxBuckets=vmb, maxItemsPerBucket=vmi
             )
         else:
-            cxn = bdb.db.DB()
+            cxn = self._newDb(session)
 
         for f in flags:
             cxn.set_flags(f)
@@ -1359,13 +1780,22 @@ class BdbIndexStore(IndexStore):
                 except FileAlreadyExistsException:
                     pass
 
+        if index.get_setting(session, "termGrams", 0):
+            try:
+                self._create(session, fullname + "_GRAMS")
+            except FileAlreadyExistsException:
+                pass
+
         return 1
 
     def clear_index(self, session, index):
+        self._discardUpdateBuffer(session, index)
         self._closeIndex(session, index)
+        self._clearTermCache(session, index)
         self._closeVectors(session, index)
         self._closeTermFreq(session, index, 'rec')
         self._closeTermFreq(session, index, 'occ')
+        self._closeTermGrams(session, index)
         for dbname in self._listExistingFiles(session, index):
             cxn = bdb.db.DB()
             cxn.remove(dbname)
@@ -1385,6 +1815,10 @@ class BdbIndexStore(IndexStore):
                 msg = "Permission required to delete index from %s" % self.id
                 raise PermissionException(msg)
 
+        self._discardUpdateBuffer(session, index)
+        self._closeIndex(session, index)
+        self._clearTermCache(session, index)
+        self._closeTermGrams(session, index)
         for dbname in self._listExistingFiles(session, index):
             os.remove(dbname)
 
@@ -1397,19 +1831,22 @@ class BdbIndexStore(IndexStore):
         if cxn:
             return cxn
 
-        dfp = self.get_path(session, "defaultPath")
-        name = self._generateFilename(index) + "_VALUES"
-        fullname = os.path.join(dfp, name)
-        if self.vectorSwitching:
-            pass
-        else:
-            cxn = bdb.db.DB()
-        if session.environment == "apache":
-            cxn.open(fullname, flags=bdb.db.DB_NOMMAP)
-        else:
-            cxn.open(fullname)
-        self.sortStoreCxn[index] = cxn
-        return cxn
+        with self.cxnLock:
+            cxn = self.sortStoreCxn.get(index, None)
+            if cxn:
+                # Opened by another thread
+                return cxn
+
+            dfp = self.get_path(session, "defaultPath")
+            name = self._generateFilename(index) + "_VALUES"
+            fullname = os.path.join(dfp, name)
+            if self.vectorSwitching:
+                pass
+            else:
+                cxn = self._newDb(session)
+            cxn.open(fullname, flags=self._get_openFlags(session))
+            self.sortStoreCxn[index] = cxn
+            return cxn
 
     def fetch_sortValue(self, session, index, rec, lowest=True):
         try:
@@ -1430,6 +1867,98 @@ class BdbIndexStore(IndexStore):
         else:
             return values[-1]
 
+    def _generateSortKeysFilename(self, session, index, recordStore):
+        dfp = self.get_path(session, "defaultPath")
+        name = self._generateFilename(index)
+        return os.path.join(dfp, "%s_SORTKEYS_%s" % (name, recordStore))
+
+    def _buildSortKeys(self, session, index):
+        # Write tables of the ranks of the lowest and highest sort values of
+        # each record, so that records can be sorted by comparing integers.
+        # Ranks are in the order of the values across all recordStores, -1
+        # if there is no value. Each table is an array of [number of ranks,
+        # 0] followed by [lowest, highest] for each internal record id
+        cxn = self._openSortStore(session, index)
+        values = set()
+        storeRecs = {}
+        cursor = cxn.cursor()
+        tup = cursor.first()
+        while tup:
+            (key, val) = tup
+            (recordStore, docid) = key.rsplit('/', 1)
+            if docid.isdigit():
+                if recordStore.isdigit():
+                    recordStore = self.storeHash.get(int(recordStore),
+                                                     recordStore)
+                vals = val.split('\0')
+                storeRecs.setdefault(recordStore, []).append((long(docid),
+                                                              vals[0],
+                                                              vals[-1]))
+                values.update([vals[0], vals[-1]])
+            tup = cursor.next()
+        with self.cxnLock:
+            cxn.close()
+            del self.sortStoreCxn[index]
+        # Empty values sort as missing
+        values.discard('')
+        ranks = dict([(v, r) for (r, v) in enumerate(sorted(values))])
+        del values
+        for (recordStore, recs) in storeRecs.iteritems():
+            fn = self._generateSortKeysFilename(session, index, recordStore)
+            maxId = max([r[0] for r in recs])
+            if maxId > (4 * len(recs)) + 1024:
+                # Too sparse to address by record id
+                if os.path.exists(fn):
+                    os.remove(fn)
+                continue
+            table = array('i', [-1]) * (2 * (maxId + 2))
+            table[0] = len(ranks)
+            table[1] = 0
+            for (docid, low, high) in recs:
+                table[2 * docid + 2] = ranks.get(low, -1)
+                table[2 * docid + 3] = ranks.get(high, -1)
+            if sys.byteorder == 'big':
+                table.byteswap()
+            with open(fn + "_TEMP", 'wb') as fh:
+                table.tofile(fh)
+            os.rename(fn + "_TEMP", fn)
+
+    def fetch_sortKeys(self, session, index, recordStore):
+        """Return the table of ranks of sort values for records in recordStore.
+
+        Return an array in which the ranks of the lowest and highest sort
+        value of a record, in the order of all sort values of index, are at
+        positions 2 * (internal record identifier + 1) and the next. -1
+        means that the record has no value, and the number of distinct
+        values is at position 0. Return None if there is no table, which is
+        built when indexing is committed for Indexes with a sortStore.
+        """
+        if not index.get_setting(session, 'sortStore', 0):
+            return None
+        if not isinstance(recordStore, basestring):
+            recordStore = self.storeHash.get(recordStore, str(recordStore))
+        fn = self._generateSortKeysFilename(session, index, recordStore)
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        # Tables are replaced, rather than rewritten, so include the inode
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+        try:
+            (cachedStamp, table) = self.sortKeyTables[(index, recordStore)]
+        except KeyError:
+            pass
+        else:
+            if cachedStamp == stamp:
+                return table
+        table = array('i')
+        with open(fn, 'rb') as fh:
+            table.fromstring(fh.read())
+        if sys.byteorder == 'big':
+            table.byteswap()
+        self.sortKeyTables[(index, recordStore)] = (stamp, table)
+        return table
+
     def store_terms(self, session, index, terms, rec):
         # Store terms from hash
         # Need to store:
@@ -1477,6 +2006,18 @@ class BdbIndexStore(IndexStore):
             # Unstored record
             raise ValueError(str(rec))
 
+        if self.get_setting(session, 'recordLengths', 0):
+            recordStore = self.storeHash.get(storeid, str(storeid))
+            lengths = self.recordLengths.setdefault(recordStore, {})
+            lengths[docid] = rec.wordCount
+            if index not in self.outFiles:
+                # Not batch loading. Lengths are written together, rather
+                # than once per record for each index
+                with bufferedIndexStoresLock:
+                    bufferedIndexStores[id(self)] = self
+                if len(lengths) >= self.maxPendingLengths:
+                    self._commitRecordLengths(session)
+
         if index in self.outFiles:
             # Batch loading
             if (index in self.sortStoreCxn):
@@ -1511,6 +2052,8 @@ class BdbIndexStore(IndexStore):
             valueHash = terms.values()[0]
             value = valueHash['text']
             prox = 'positions' in terms[value]
+            binary = (self.get_setting(session, 'tempFileFormat', 'text') ==
+                      'binary')
             for k in terms.values():
                 kw = k['text']
                 if type(kw) != unicode:
@@ -1525,6 +2068,13 @@ class BdbIndexStore(IndexStore):
                         msg = u"%s failed to decode %s" % (self.id, repr(kw))
                         self.log_critical(session, msg.encode('utf-8'))
                         raise
+                if binary:
+                    ints = [docid, storeid, k['occurences']]
+                    if prox:
+                        ints.extend(k['positions'])
+                    self.outFiles[index].write(packEntry(kw.encode('utf-8'),
+                                                         ints))
+                    continue
                 self.outFiles[index].write(kw)
                 # ensure that docids are sorted to numeric order
                 lineList = ["",
@@ -1537,59 +2087,210 @@ class BdbIndexStore(IndexStore):
                 self.outFiles[index].write(nonTextToken.join(lineList) + "\n")
         else:
 
-            # Directly insert into index
-            cxn = self._openIndex(session, index)
-
-            # This is going to be ... slow ... with lots of i/o
-            # Use commit method unless only doing very small amounts of work.
-
+            postings = {}
             for k in terms.values():
-                key = k['text']
                 stuff = [docid, storeid, k['occurences']]
                 try:
                     stuff.extend(k['positions'])
                 except:
                     pass
-                val = cxn.get(key.encode('utf-8'))
-                if (val is not None):
-                    current = index.deserialize_term(session, val)
-                    unpacked = index.merge_term(session, current, stuff,
-                                                op="replace", nRecs=1,
-                                                nOccs=k['occurences'])
-                    (termid, totalRecs, totalOccs) = unpacked[:3]
-                    unpacked = unpacked[3:]
-                else:
-                    vecs = index.get_setting(session, "vectors")
-                    tids = index.get_setting(session, "termIds")
-                    tidcxn = None
-                    if vecs or tids:
-                        tidcxn = self.termIdCxn.get(index, None)
-                        if tidcxn is None:
-                            self._openVectors(session, index)
-                            tidcxn = self.termIdCxn.get(index, None)
+                postings[k['text'].encode('utf-8')] = stuff
+
+            if not self.get_setting(session, 'updateBufferSize', 0):
+                # Directly insert into index
+                # This is going to be ... slow ... with lots of i/o
+                # Use commit method unless only doing very small amounts of
+                # work, or configure an updateBufferSize
+                data = {}
+                for (key, stuff) in postings.iteritems():
+                    data[key] = (stuff, 1, stuff[2])
+                self._storeTermData(session, index, data)
+                return
+
+            # Buffer terms in memory, replacing any buffered for this record
+            buff = self.updateBuffers.setdefault(index, {})
+            for (key, stuff) in postings.iteritems():
+                try:
+                    buff[key][(docid, storeid)] = stuff
+                except KeyError:
+                    buff[key] = {(docid, storeid): stuff}
+            self.updateBufferRecs.setdefault(index, set()).add((storeid,
+                                                                docid))
+            self.updateBufferTimes.setdefault(index, time.time())
+            with bufferedIndexStoresLock:
+                bufferedIndexStores[id(self)] = self
+            self._checkUpdateBuffer(session, index)
+
+    def _generateRecordLengthsFilename(self, session, recordStore):
+        dfp = self.get_path(session, "defaultPath")
+        return os.path.join(dfp, "recordLengths_%s_%s.lengths" % (self.id,
+                                                                 recordStore))
+
+    def _commitRecordLengths(self, session):
+        # Write pending record lengths into tables. Each is stored in place
+        # at an offset determined by docid; missing entries read as 0
+        for recordStore, lengths in self.recordLengths.iteritems():
+            if not lengths:
+                continue
+            fn = self._generateRecordLengthsFilename(session, recordStore)
+            # Never truncate, parallel tasks may be writing the lengths of
+            # their records into the same file at once
+            fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                for docid in sorted(lengths):
+                    os.lseek(fd, docid * recordLengthStruct.size, os.SEEK_SET)
+                    os.write(fd, recordLengthStruct.pack(lengths[docid]))
+            finally:
+                os.close(fd)
+        self.recordLengths = {}
+
+    def fetch_recordLengths(self, session, recordStore):
+        """Return the table of lengths of records in recordStore.
+
+        Return an array of record lengths (word counts), indexed by internal
+        (numeric) record identifier, in which 0 means that the length is not
+        known, or None if the recordLengths setting is not enabled.
+        """
+        if not self.get_setting(session, 'recordLengths', 0):
+            return None
+        if not isinstance(recordStore, basestring):
+            recordStore = self.storeHash.get(recordStore, str(recordStore))
+        if self.recordLengths.get(recordStore):
+            # Write pending lengths first
+            self._commitRecordLengths(session)
+        fn = self._generateRecordLengthsFilename(session, recordStore)
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return array('i')
+        stamp = (st.st_mtime, st.st_size)
+        try:
+            (cachedStamp, lengths) = self.recordLengthTables[recordStore]
+        except KeyError:
+            pass
+        else:
+            if cachedStamp == stamp:
+                return lengths
+        lengths = array('i')
+        with open(fn, 'rb') as fh:
+            lengths.fromstring(fh.read())
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+        self.recordLengthTables[recordStore] = (stamp, lengths)
+        return lengths
+
+    def _checkUpdateBuffer(self, session, index):
+        # Flush update buffer for index if it is full, and those of all
+        # indexes if too old
+        maxRecs = self.get_setting(session, 'updateBufferSize', 0)
+        maxTime = self.get_setting(session, 'updateBufferTime', 0)
+        if len(self.updateBufferRecs.get(index, [])) >= maxRecs:
+            self._flushUpdateBuffer(session, index)
+        if maxTime:
+            now = time.time()
+            for (idx, started) in self.updateBufferTimes.items():
+                if now - started >= maxTime:
+                    self._flushUpdateBuffer(session, idx)
+
+    def _flushBuffers(self, session):
+        # Store all buffered updates, e.g. before the process exits
+        for index in self.updateBuffers.keys():
+            self._flushUpdateBuffer(session, index)
+        self._commitRecordLengths(session)
+
+    def _discardUpdateBuffer(self, session, index):
+        # Throw away buffered terms for index without storing them
+        for buffers in [self.updateBuffers,
+                        self.updateBufferRecs,
+                        self.updateBufferTimes]:
+            try:
+                del buffers[index]
+            except KeyError:
+                pass
+
+    def _flushUpdateBuffer(self, session, index):
+        # Merge buffered terms for index into the index
+        buff = self.updateBuffers.get(index, {})
+        self._discardUpdateBuffer(session, index)
+        self._commitRecordLengths(session)
+        if not buff:
+            return
+        data = {}
+        for (key, recs) in buff.iteritems():
+            stuff = []
+            nOccs = 0
+            # Keep postings in docid order
+            for rec in sorted(recs):
+                stuff.extend(recs[rec])
+                nOccs += recs[rec][2]
+            data[key] = (stuff, len(recs), nOccs)
+        self._storeTermData(session, index, data)
+
+    def _storeTermData(self, session, index, data):
+        # Merge {term: (flat postings list, nRecs, nOccs)} into index,
+        # opening the index only once
+        cxn = self._openIndex(session, index)
+        last = None
+        tidcxn = None
+        vecs = index.get_setting(session, "vectors")
+        tids = index.get_setting(session, "termIds")
+        if vecs or tids:
+            tidcxn = self.termIdCxn.get(index, None)
+            if tidcxn is None:
+                self._openVectors(session, index)
+                tidcxn = self.termIdCxn.get(index, None)
+
+        newTerms = []
+        # Store in key order for better locality of writes
+        for key in sorted(data):
+            (stuff, nRecs, nOccs) = data[key]
+            val = cxn.get(key)
+            if (val is not None):
+                current = index.deserialize_term(session, val)
+                unpacked = index.merge_term(session, current, stuff,
+                                            op="replace", nRecs=nRecs,
+                                            nOccs=nOccs)
+                (termid, totalRecs, totalOccs) = unpacked[:3]
+                unpacked = unpacked[3:]
+            else:
+                if last is None:
                     if tidcxn is None:
                         # Okay, no termid hash. hope for best with final set
                         # of terms from regular index
                         cursor = cxn.cursor()
-                        (term, value) = cursor.last(
+                        lastEntry = cursor.last(
                             doff=0,
                             dlen=(3 * index.longStructSize)
                         )
-                        (last, x, y) = index.deserialize_term(session, value)
+                        if lastEntry:
+                            (last, x, y) = index.deserialize_term(
+                                session,
+                                lastEntry[1]
+                            )
                     else:
                         tidcursor = tidcxn.cursor()
-                        (finaltid, term) = tidcursor.last()
-                        last = long(finaltid)
-
-                    termid = last + 1
-                    unpacked = stuff
-                    totalRecs = 1
-                    totalOccs = k['occurences']
-
-                packed = index.serialize_term(session, termid, unpacked,
-                                              nRecs=totalRecs, nOccs=totalOccs)
-                cxn.put(key.encode('utf-8'), packed)
-            self._closeIndex(session, index)
+                        lastEntry = tidcursor.last()
+                        if lastEntry:
+                            last = long(lastEntry[0])
+                    if last is None:
+                        # Empty index
+                        last = 0
+                last += 1
+                termid = last
+                if tidcxn is not None:
+                    tidcxn.put("%012d" % termid, key)
+                newTerms.append(key)
+                unpacked = stuff
+                totalRecs = nRecs
+                totalOccs = nOccs
+
+            packed = index.serialize_term(session, termid, unpacked,
+                                          nRecs=totalRecs, nOccs=totalOccs)
+            cxn.put(key, packed)
+        self._syncIndex(session, index)
+        self._clearTermCache(session, index)
+        if newTerms:
+            self._storeTermGrams(session, index, newTerms)
 
     def delete_terms(self, session, index, terms, rec):
         p = self.permissionHandlers.get('info:srw/operation/2/unindex', None)
@@ -1605,6 +2306,9 @@ class BdbIndexStore(IndexStore):
                 raise PermissionException(msg)
         if not terms:
             return
+        if index in self.updateBuffers:
+            # Ensure buffered terms are stored before deleting
+            self._flushUpdateBuffer(session, index)
 
         docid = rec.id
         # Hash
@@ -1647,7 +2351,8 @@ class BdbIndexStore(IndexStore):
                         packed = index.serialize_term(session, current[0],
                                                       unpacked[3:])
                         cxn.put(k.encode('utf-8'), packed)
-            self._closeIndex(session, index)
+            self._syncIndex(session, index)
+            self._clearTermCache(session, index)
 
     # NB:  c.set_range('a', dlen=12, doff=0)
     # --> (key, 12bytestring)
@@ -1699,11 +2404,8 @@ class BdbIndexStore(IndexStore):
                     cxn = self.switchingClass(session, self, fullname)
 
             else:
-                cxn = bdb.db.DB()
-            if session.environment == "apache":
-                cxn.open(fullname, flags=bdb.db.DB_NOMMAP)
-            else:
-                cxn.open(fullname)
+                cxn = self._newDb(session)
+            cxn.open(fullname, flags=self._get_openFlags(session))
         else:
             cxn = self._openIndex(session, index)
 
@@ -1799,6 +2501,68 @@ class BdbIndexStore(IndexStore):
 
         return tlist
 
+    def fetch_gramTermList(self, session, index, fragments,
+                           start=True, end=True):
+        """Return list of candidate terms containing all of fragments.
+
+        Look up the k-grams of the literal fragments of a masked term in the
+        index's k-gram dictionary (see the termGrams setting of the Index).
+        start and end indicate whether the first fragment begins, and the
+        last fragment ends, the term. Return a list of [term, data] in term
+        order, as fetch_termList, which the caller must still filter to
+        terms matching the mask. Return None if there is no k-gram
+        dictionary, or the fragments are too short to narrow the candidates.
+        """
+        p = self.permissionHandlers.get('info:srw/operation/2/scan', None)
+        if p:
+            if not session.user:
+                msg = ("Authenticated user required to scan indexStore "
+                       "%s" % self.id)
+                raise PermissionException(msg)
+            okay = p.hasPermission(session, session.user)
+            if not okay:
+                msg = "Permission required to scan indexStore %s" % self.id
+                raise PermissionException(msg)
+
+        cxn = self._openTermGrams(session, index)
+        if cxn is None:
+            return None
+        n = index.get_setting(session, 'termGrams', 0)
+        grams = set()
+        last = len(fragments) - 1
+        for (i, frag) in enumerate(fragments):
+            if type(frag) == unicode:
+                frag = frag.encode('utf-8')
+            grams.update(self._termGrams(frag, n,
+                                         start and i == 0,
+                                         end and i == last))
+        if not grams:
+            return None
+        termLists = []
+        for gram in grams:
+            val = cxn.get(gram)
+            if not val:
+                # No term contains gram
+                return []
+            termLists.append(val.split(termGramBoundary))
+        # Intersect from the rarest gram
+        termLists.sort(key=len)
+        candidates = set(termLists[0])
+        for terms in termLists[1:]:
+            candidates.intersection_update(terms)
+            if not candidates:
+                return []
+
+        tlist = []
+        for term in sorted(candidates):
+            val = self._fetch_packed(session, index, term)
+            if val is None:
+                # Term deleted since k-grams were built
+                continue
+            tlist.append([term.decode('utf-8'),
+                          index.deserialize_term(session, val)])
+        return tlist
+
     def construct_resultSetItem(self, session, recId, recStoreId, nOccs,
                                 rsiType="SimpleResultSetItem"):
         recStore = self.storeHash[recStoreId]
@@ -1821,7 +2585,7 @@ class BdbIndexStore(IndexStore):
         else:
             raise NotImplementedError(rsiType)
 
-    def fetch_term(self, session, index, term, summary=False, prox=True):
+    def _check_searchPermission(self, session):
         p = self.permissionHandlers.get('info:srw/operation/2/search', None)
         if p:
             if not session.user:
@@ -1832,6 +2596,9 @@ class BdbIndexStore(IndexStore):
             if not okay:
                 msg = "Permission required to search indexStore %s" % self.id
                 raise PermissionException(msg)
+
+    def fetch_term(self, session, index, term, summary=False, prox=True):
+        self._check_searchPermission(session)
         unpacked = []
         val = self._fetch_packed(session, index, term, summary)
         if (val is not None):
@@ -1845,12 +2612,56 @@ class BdbIndexStore(IndexStore):
                 raise
         return unpacked
 
+    def fetch_packedTerm(self, session, index, term):
+        """Return the serialized data for term, or None if not present.
+
+        As fetch_term, but leaves deserialization to the caller, which may
+        be able to avoid unpacking all of the data.
+        """
+        self._check_searchPermission(session)
+        return self._fetch_packed(session, index, term)
+
+    def fetch_packedTermList(self, session, index):
+        """Return an iterator of (term, serialized data) for all terms.
+
+        Terms are generated in term order, straight from a cursor over the
+        index, so the whole index is never held in memory at once.
+        """
+        p = self.permissionHandlers.get('info:srw/operation/2/scan', None)
+        if p:
+            if not session.user:
+                msg = ("Authenticated user required to scan indexStore "
+                       "%s" % self.id)
+                raise PermissionException(msg)
+            okay = p.hasPermission(session, session.user)
+            if not okay:
+                msg = "Permission required to scan indexStore %s" % self.id
+                raise PermissionException(msg)
+        return self._iterPackedTerms(session, index)
+
+    def _iterPackedTerms(self, session, index):
+        cursor = self._openIndex(session, index).cursor()
+        try:
+            tup = cursor.first()
+        except TypeError:
+            # Index is empty
+            tup = None
+        while tup:
+            yield tup
+            tup = cursor.next()
+
     def _fetch_packed(self, session, index, term,
                       summary=False, numReq=0, start=0):
         try:
             term = term.encode('utf-8')
         except:
             pass
+        if (
+            not summary and
+            not ((start != 0 or numReq != 0) and index.canExtractSection) and
+            self.get_setting(session, 'termCacheSize', 0)
+        ):
+            return self._fetch_cachedTerm(session, index, term)
         cxn = self._openIndex(session, index)
         if summary:
             dataLen = index.longStructSize * self.reservedLongs
@@ -1859,17 +2670,22 @@ class BdbIndexStore(IndexStore):
         elif (start != 0 or numReq != 0) and index.canExtractSection:
             # try to extract only section...
             fulllen = cxn.get_size(term)
-            offsets = index.calc_sectionOffsets(session, start,
-                                                numReq, fulllen)
-            if not numReq:
-                numReq = 100
-
             # XXX this should be on index somewhere!!
             # first get summary
             vals = []
             dataLen = index.longStructSize * self.reservedLongs
             val = cxn.get(term, doff=0, dlen=dataLen)
             vals.append(val)
+            if getattr(index, 'hasSkipTable', 0):
+                # Offsets are calculated from the skip table
+                skipLen = index.calc_skipTableLength(session, val)
+                skipTable = cxn.get(term, doff=dataLen, dlen=skipLen)
+                offsets = index.calc_sectionOffsets(session, start,
+                                                    numReq, fulllen,
+                                                    skipTable)
+            else:
+                offsets = index.calc_sectionOffsets(session, start,
+                                                    numReq, fulllen)
             # now step through offsets, prolly only 1
             for o in offsets:
                 val = cxn.get(term, doff=o[0], dlen=o[1])
@@ -1882,3 +2698,105 @@ class BdbIndexStore(IndexStore):
         else:
             val = cxn.get(term)
         return val
+
+    def fetch_indexStamp(self, session, index):
+        """Return the latest modification time and total size of index.
+
+        The stamp is taken from all of the files of index, including its
+        buckets when split over multiple files, and changes whenever terms
+        are stored in index, by this or another process. Return None if
+        index has not been created.
+        """
+        mtime = None
+        size = 0
+        for fn in self._listExistingFiles(session, index):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                # Removed in the meantime
+                continue
+            mtime = max(mtime, st.st_mtime)
+            size += st.st_size
+        if mtime is None:
+            return None
+        return (mtime, size)
+
+    def _fetch_cachedTerm(self, session, index, term):
+        # Return serialized data for term, from the term cache if possible
+        stamp = self.fetch_indexStamp(session, index)
+        with self.termCacheLock:
+            try:
+                stats = self.termCacheStats[index]
+            except KeyError:
+                stats = self.termCacheStats[index] = {'hits': 0,
+                                                      'misses': 0,
+                                                      'evictions': 0}
+            if self.termCacheStamps.get(index) != stamp:
+                # Index may have been changed by another process
+                self._clearTermCache(session, index)
+                self.termCacheStamps[index] = stamp
+            terms = self.termCache.setdefault(index, {})
+            self.termCacheClock += 1
+            try:
+                entry = terms[term]
+            except KeyError:
+                stats['misses'] += 1
+            else:
+                stats['hits'] += 1
+                entry[1] = self.termCacheClock
+                return entry[0]
+        # Read outside of the lock so that other threads are not held up
+        val = self._openIndex(session, index).get(term)
+        with self.termCacheLock:
+            if self.termCache.get(index) is not terms or term in terms:
+                # Cleared, or fetched by another thread, in the meantime
+                return val
+            # Also cache absence of term
+            terms[term] = [val, self.termCacheClock]
+            self.termCacheBytes += len(term) + len(val or '')
+            maxBytes = self.get_setting(session, 'termCacheSize', 0)
+            if self.termCacheBytes > maxBytes:
+                self._evictTermCache(session)
+        return val
+
+    def _evictTermCache(self, session):
+        # Discard least recently used terms to within 3/4 of the size limit
+        # Call with termCacheLock held
+        limit = self.get_setting(session, 'termCacheSize', 0) * 3 / 4
+        entries = []
+        for (index, terms) in self.termCache.iteritems():
+            entries.extend([(e[1], index, t) for (t, e) in terms.iteritems()])
+        entries.sort()
+        for (used, index, term) in entries:
+            if self.termCacheBytes <= limit:
+                break
+            val = self.termCache[index].pop(term)[0]
+            self.termCacheBytes -= len(term) + len(val or '')
+            self.termCacheStats[index]['evictions'] += 1
+
+    def _clearTermCache(self, session, index):
+        # Discard cached term data for index
+        with self.termCacheLock:
+            terms = self.termCache.pop(index, {})
+            for (term, (val, used)) in terms.iteritems():
+                self.termCacheBytes -= len(term) + len(val or '')
+            self.termCacheStamps.pop(index, None)
+
+    def fetch_termCacheStatistics(self, session, index):
+        """Return statistics of the term cache for index.
+
+        Return a dictionary of the number of 'hits', 'misses' and
+        'evictions' of the term cache, and the number of 'terms' and 'bytes'
+        of data currently cached, for index.
+        """
+        with self.termCacheLock:
+            stats = self.termCacheStats.get(index, {'hits': 0,
+                                                    'misses': 0,
+                                                    'evictions': 0})
+            terms = self.termCache.get(index, {})
+            stats = dict(stats)
+            stats['terms'] = len(terms)
+            stats['bytes'] = sum([len(t) + len(e[0] or '')
+                                  for (t, e)
+                                  in terms.iteritems()])
+        return stats
@@ -1,10 +1,18 @@
 
 import sys
 import time
+import select
 import traceback
 
 import multiprocessing as mp
 
+try:
+    from multiprocessing.connection import wait as wait_connections
+except ImportError:
+    # Python 2; Connections have a file descriptor to select on
+    def wait_connections(connections, timeout=None):
+        return select.select(connections, [], [], timeout)[0]
+
 from cheshire3.configParser import C3Object
 from cheshire3.baseObjects import Session, Record
 
@@ -42,6 +50,28 @@ class RemoteTask(mp.Process):
                 logtmpl = "[{0!s}:-->0]: {1!r}\n"
             lgr.log(self.session, logtmpl.format(self.name, data))
 
+    def _call(self, target, objid, fn, args, kw):
+        # Call fn of target, return value or formatted traceback
+        try:
+            if (hasattr(target, fn)):
+                code = getattr(target, fn)
+                val = code(self.session, *args, **kw)
+            else:
+                val = (target, objid, fn)
+            if isinstance(val, Record):
+                val = "%s/%s" % (val.recordStore, val.id)
+        except Exception, e:
+            val = traceback.format_tb(sys.exc_info()[2])
+        return val
+
+    def _error(self, batch):
+        # Return formatted traceback of the exception being handled, marked
+        # as the failure of a whole chunk when replying to a BATCH
+        val = traceback.format_tb(sys.exc_info()[2])
+        if batch:
+            return ("ERROR", val)
+        return val
+
     def run(self):
         # Listen to pipe and evaluate
         while True:
@@ -51,6 +81,7 @@ class RemoteTask(mp.Process):
             except:
                 continue
             self.log('in', msg)
+            batch = False
             try:
                 if msg == "SHUTDOWN":
                     self.inPipe.send(-1)
@@ -58,35 +89,37 @@ class RemoteTask(mp.Process):
                 elif msg == "PING":
                     self.inPipe.send(-100)
                     continue
+                batch = msg[0] == "BATCH"
                 try:
-                    (objid, fn, args, kw) = msg
-                    args = list(args)
-                    target = self.database.get_object(self.session, objid)
-                    if (hasattr(target, fn)):
-                        code = getattr(target, fn)
-                        val = code(self.session, *args, **kw)
+                    if batch:
+                        # Call for each item of a chunk, reply with all values
+                        (objid, fn, items, args, kw) = msg[1:]
+                        target = self.database.get_object(self.session, objid)
+                        val = ("OK", [self._call(target, objid, fn,
+                                                 [item] + list(args), kw)
+                                      for item in items])
                     else:
-                        val = (target, objid, fn)
-                    if isinstance(val, Record):
-                        val = "%s/%s" % (val.recordStore, val.id)
-
+                        (objid, fn, args, kw) = msg
+                        args = list(args)
+                        target = self.database.get_object(self.session, objid)
+                        val = self._call(target, objid, fn, args, kw)
                 except Exception, e:
-                    val = traceback.format_tb(sys.exc_info()[2])
+                    val = self._error(batch)
 
                 try:
                     self.inPipe.send(val)
                     self.log('out', val)
                 except Exception, e:
                     # We have an exception object
-                    val2 = traceback.format_tb(sys.exc_info()[2])
+                    val2 = self._error(batch)
                     self.inPipe.send(val2)
                 except:
                     # Something was raised, but it ain't an exception
-                    val = traceback.format_tb(sys.exc_info()[2])
+                    val = self._error(batch)
                     self.inPipe.send(val)
             except Exception, e:
                 # Something seriously wrong, need to reply SOMETHING
-                val = traceback.format_tb(sys.exc_info()[2])
+                val = self._error(batch)
                 self.inPipe.send(val)
 
 
@@ -97,12 +130,17 @@ class Task(object):
     debug = 0
     process = None
     outPipe = None
+    nItems = 0
+    busyTime = 0.0
 
     def __init__(self, session, name, manager=None, debug=0):
         self.name = name
         self.session = session
         self.debug = debug
         self.manager = manager
+        # Items of chunks completed, and seconds spent on them
+        self.nItems = 0
+        self.busyTime = 0.0
         self.process = RemoteTask(session=session, name=name,
                                   manager=manager, debug=debug)
         par, chld = mp.Pipe(duplex=True)
@@ -134,6 +172,16 @@ class Task(object):
     def call(self, o, fn, *args, **kw):
         self.send([o.id, fn, args, kw])
 
+    def call_each(self, o, fn, items, *args, **kw):
+        # Reply is ("OK", [value of each item]) or ("ERROR", traceback)
+        self.send(["BATCH", o.id, fn, items, args, kw])
+
+    def throughput(self):
+        """Return items completed per second, or None if not yet known."""
+        if not self.busyTime:
+            return None
+        return self.nItems / self.busyTime
+
 
 class ProcessTaskManager(C3Object):
     """Configurable Cheshire3 object to manage parallel processing."""
@@ -165,6 +213,12 @@ each task.)"""
         'maxChunkWordCount': {
             'docs': "Max number of words that each chunk should represent.",
             'type': int
+        },
+        'chunkTime': {
+            'docs': ("Number of seconds of work to send to a task in each "
+                     "chunk of call_each, judged by the throughput of the "
+                     "task so far. Default 1"),
+            'type': float
         }
     }
 
@@ -192,13 +246,15 @@ each task.)"""
         return data
 
     def recv_any(self):
-        """Receive from any."""
-        while True:
-            time.sleep(0.1)
-            for task in self.tasks.values():
-                if not task.name in self.idle_tasks and task.poll():
-                    data = self.recv(task)
-                    return (task, data)
+        """Receive from any busy Task, blocking until one replies."""
+        busy = {}
+        for task in self.tasks.itervalues():
+            if task not in self.idle_tasks:
+                busy[task.outPipe] = task
+        ready = wait_connections(busy.keys())
+        task = busy[ready[0]]
+        data = self.recv(task)
+        return (task, data)
 
     def recv_all(self):
         """Receive from all."""
@@ -249,13 +305,67 @@ each task.)"""
 
     def call_all_wait(self, session, o, fn, *args, **kw):
         """Call a function in all Tasks, return when all have completed."""
-        self.call_all(o, fn, *args, **kw)
+        self.call_all(session, o, fn, *args, **kw)
         return self.recv_all()
 
     def call(self, session, o, fn, *args, **kw):
         """Call a function in any available Task."""
         self.send_any([o.id, fn, args, kw])
 
+    def call_each(self, session, o, fn, items, *args, **kw):
+        """Call a function for each of items, distributed between Tasks.
+
+        Each item is passed as the first argument after session. Items are
+        sent in chunks, one message per chunk, to whichever Task is idle,
+        fastest first. The size of each chunk is judged from the throughput
+        of the Task so that it takes about chunkTime seconds, but is never
+        more than maxChunkSize, nor more than a share of the items still to
+        be sent, so that slow Tasks do not hold up the end. Return a list of
+        the results in the order of items.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        maxChunk = self.get_setting(session, 'maxChunkSize', 0)
+        chunkTime = self.get_setting(session, 'chunkTime', 1.0)
+        # Task -> (start of chunk, end of chunk, time sent)
+        chunks = {}
+        start = 0
+        while start < len(items) or chunks:
+            while start < len(items) and self.idle_tasks:
+                task = max(self.idle_tasks, key=lambda t: t.throughput())
+                remaining = len(items) - start
+                size = max(1, remaining // (2 * len(self.tasks)))
+                rate = task.throughput()
+                if rate is None:
+                    # Measure throughput on a single item
+                    size = 1
+                else:
+                    size = min(size, max(1, int(rate * chunkTime)))
+                if maxChunk:
+                    size = min(size, maxChunk)
+                end = start + size
+                self.send(task, ["BATCH", o.id, fn, items[start:end],
+                                 args, kw])
+                chunks[task] = (start, end, time.time())
+                start = end
+            (task, data) = self.recv_any()
+            try:
+                (chunkStart, chunkEnd, sent) = chunks.pop(task)
+            except KeyError:
+                # Reply to an earlier call
+                continue
+            task.nItems += chunkEnd - chunkStart
+            task.busyTime += time.time() - sent
+            if isinstance(data, tuple) and data[0] == "OK":
+                data = data[1]
+            else:
+                # Whole chunk failed, the traceback is the result of each
+                if isinstance(data, tuple) and data[0] == "ERROR":
+                    data = data[1]
+                data = [data] * (chunkEnd - chunkStart)
+            results[chunkStart:chunkEnd] = data
+        return results
+
     def claim(self, session):
         """Claim a Task from the TaskManager.
 
@@ -1,15 +1,19 @@
 import sys
+import copy
 import types
 import math
 import operator
 import time
+import heapq
+import bisect
 import cStringIO as StringIO
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from itertools import combinations
+from array import array
+from itertools import combinations, izip
 from xml.sax.saxutils import escape, unescape
 from lxml import etree
 
@@ -104,7 +108,11 @@ class RankedResultSet(ResultSet):
 
 
 class SimpleResultSet(RankedResultSet):
-    _list = []
+    _items = []
+    _columns = None
+    _itemCache = {}
+    _itemFactory = None
+    _session = None
 
     id = ""
     termid = -1
@@ -127,6 +135,13 @@ class SimpleResultSet(RankedResultSet):
     recordStoreSizes = 0
     termIdHash = {}
     fromStore = 0
+    # Filter by a bitmap by probing it once per item when the number of items
+    # times the length of the bitmap is below this, otherwise intersect it
+    # with a bitmap of the items
+    bitmapProbeLimit = 2 ** 24
+    # Intersect columns by binary searching for each item of the shorter
+    # when it is at least this many times shorter, otherwise by hashing
+    gallopRatio = 8
 
     def __init__(self, session, data=None, id="", recordStore=""):
         self.rsiConstructor = SimpleResultSetItem
@@ -179,15 +194,86 @@ class SimpleResultSet(RankedResultSet):
         self.termIdHash = {}
         self.fromStore = 0
 
+    def _get_list(self):
+        if self._columns is not None:
+            # Materialize all items
+            self._list = [self._get_columnItem(x) for x in xrange(len(self))]
+        return self._items
+
+    def _set_list(self, items):
+        self._items = items
+        self._columns = None
+        self._itemCache = {}
+
+    _list = property(_get_list, _set_list)
+
+    def _get_columnItem(self, k):
+        try:
+            return self._itemCache[k]
+        except KeyError:
+            (recIds, storeIds, occs) = self._columns
+            item = self._itemFactory(self._session,
+                                     recIds[k],
+                                     storeIds[k],
+                                     occs[k])
+            item.resultSet = self
+            item.resultSetPosition = k
+            self._itemCache[k] = item
+            return item
+
     def __getitem__(self, k):
-        return self._list[k]
+        if self._columns is None:
+            return self._items[k]
+        if isinstance(k, slice):
+            return [self._get_columnItem(x)
+                    for x
+                    in xrange(*k.indices(len(self)))
+                    ]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        return self._get_columnItem(k)
 
     def __len__(self):
-        return len(self._list)
+        if self._columns is None:
+            return len(self._items)
+        return len(self._columns[0])
+
+    def __copy__(self):
+        # Copy that can be reordered, or its items modified, without
+        # affecting self
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        if self._columns is None:
+            items = []
+            for item in self._items:
+                item = copy.copy(item)
+                item.proxInfo = list(item.proxInfo)
+                item.resultSet = new
+                items.append(item)
+            new._list = items
+        else:
+            # Items are constructed for the copy when accessed
+            new._itemCache = {}
+        return new
 
     def fromList(self, data):
         self._list = data
 
+    def fromColumns(self, session, recIds, storeIds, occs, itemFactory):
+        """Populate from columns of record ids, store ids and occurrences.
+
+        ResultSetItems are only constructed, by calling
+        ``itemFactory(session, recId, storeId, occs)``, when they are
+        accessed, so populating a ResultSet with many hits costs little more
+        than the arrays themselves.
+        """
+        self._list = []
+        self._columns = (recIds, storeIds, occs)
+        self._itemFactory = itemFactory
+        self._session = session
+
     def serialise(self, session, pickleOk=1):
         """Serialize and this ResultSet as XML, return a string (utf-8).
 
@@ -414,10 +500,8 @@ class SimpleResultSet(RankedResultSet):
                 elif nitem < items[0]:
                     if all:
                         # skip until equal or greater
-                        positions[o] += 1
-                        while (positions[o] < lens[o] and
-                               others[o][positions[o]] < items[0]):
-                            positions[o] += 1
+                        positions[o] = self._skipTo(others[o], items[0],
+                                                    positions[o], lens[o])
 
                     else:
                         items = [nitem]
@@ -479,6 +563,37 @@ class SimpleResultSet(RankedResultSet):
         self.relevancy = 1
         return 1
 
+    def _fetch_recordSize(self, session, rs, item, recStore, lengthTables):
+        """Return the size (word count) of the Record for item in rs.
+
+        Use the table of record lengths maintained by the IndexStore of the
+        Index that rs is from if there is one, otherwise fetch from recStore.
+        """
+        key = (rs.index, item.recordStore)
+        try:
+            lengths = lengthTables[key]
+        except KeyError:
+            try:
+                fetch = rs.index.indexStore.fetch_recordLengths
+            except AttributeError:
+                lengths = None
+            else:
+                lengths = fetch(session, item.recordStore)
+            lengthTables[key] = lengths
+        if lengths:
+            if item.numericId is not None:
+                docid = item.numericId
+            else:
+                docid = item.id
+            try:
+                size = lengths[docid]
+            except (IndexError, TypeError):
+                pass
+            else:
+                if size:
+                    return size
+        return recStore.fetch_recordMetadata(session, item.id, 'wordCount')
+
     def _coriAssign(self, session, others, clause, cql, db):
         """Assign CORI weighting to each item in each resultSet in others."""
         if (db):
@@ -496,6 +611,7 @@ class SimpleResultSet(RankedResultSet):
         recStoreSizes = {}
 
         recStores = {}
+        lengthTables = {}
         for rs in others:
             matches = float(len(rs))
             if not matches:
@@ -513,9 +629,8 @@ class SimpleResultSet(RankedResultSet):
                 if not recStore:
                     recStore = db.get_object(session, item.recordStore)
                     recStores[item.recordStore] = recStore
-                size = recStore.fetch_recordMetadata(session,
-                                                     item.id,
-                                                     'wordCount')
+                size = self._fetch_recordSize(session, rs, item, recStore,
+                                              lengthTables)
                 if rsizes:
                     avgSize = recStore.meanWordCount
 
@@ -604,6 +719,7 @@ class SimpleResultSet(RankedResultSet):
 
         recStoreSizes = {}
         recStores = {}
+        lengthTables = {}
         b, k1, k3 = constants
         for rs in others:
             matches = float(len(rs))
@@ -627,9 +743,8 @@ class SimpleResultSet(RankedResultSet):
                 if recStore is None:
                     recStore = db.get_object(session, item.recordStore)
                     recStores[item.recordStore] = recStore
-                size = recStore.fetch_recordMetadata(session,
-                                                     item.id,
-                                                     'wordCount')
+                size = self._fetch_recordSize(session, rs, item, recStore,
+                                              lengthTables)
 
                 if rsizes:
                     avgSize = recStore.meanWordCount
@@ -714,6 +829,15 @@ class SimpleResultSet(RankedResultSet):
                 if finish:
                     return self
 
+        nBitmaps = len([o for o in others if hasattr(o, 'bitfield')])
+        if (
+            not pi and
+            cql.value in ['all', 'and', 'not', 'any', 'or'] and
+            0 < nBitmaps < len(others)
+        ):
+            # Mixture of bitmap and other resultSets
+            others = self._combineBitmaps(session, others, cql.value)
+
         if len(others) == 1 and len(others[0].queryPositions) < 2:
             if relevancy:
                 # Just adding relevance to items?
@@ -746,6 +870,12 @@ class SimpleResultSet(RankedResultSet):
         elif nors == 2 and cql.value in ['or', 'any'] and 0 in lens:
             # A or (empty) == A
             return others[int(lens[0] == 0)]
+        elif (
+            not relevancy and not pi and
+            (cql.value in ['all', 'and', 'not'] or not all) and
+            self._combineColumns(session, others, cql.value)
+        ):
+            return self
 
         positions = [0] * nors
         cmpHash = {'<': [-1],
@@ -791,53 +921,62 @@ class SimpleResultSet(RankedResultSet):
             raise NotImplementedError()
         hasGetItemList = [hasattr(o, 'get_item') for o in others]
         cont = 1
+        if not all and cql.value != 'not' and True not in hasGetItemList:
+            # Union, merge with a heap rather than comparing the current item
+            # of every one of others at each step
+            groups = self._mergeItems(others)
+        else:
+            groups = None
 
         while cont:
-            items = [others[0][positions[0]]]
-            rspos = [0]
-            for o in oidxs:
-                if o != -1:
-                    if hasGetItemList[o]:
-                        nitem = others[o].get_item(items[0])
-                        if not nitem:
-                            continue
-                    else:
-                        try:
-                            nitem = others[o][positions[o]]
-                        except IndexError:
-                            oidxs[o - 1] = -1
-                            continue
-                        if nitem < items[0]:
-                            if all or cql.value == 'not':
-                                # skip until equal or greater
-                                while True:
-                                    positions[o] += 1
-                                    if (
-                                        positions[o] >= lens[o] or
-                                        others[o][positions[o]] >= items[0]
-                                    ):
-                                        break
-                                if positions[o] != lens[o]:
-                                    nitem = others[o][positions[o]]
-                            else:
-                                items = [nitem]
-                                rspos = [o]
+            if groups is not None:
+                try:
+                    items = groups.next()
+                except StopIteration:
+                    break
+            else:
+                items = [others[0][positions[0]]]
+                rspos = [0]
+                for o in oidxs:
+                    if o != -1:
+                        if hasGetItemList[o]:
+                            nitem = others[o].get_item(items[0])
+                            if not nitem:
                                 continue
-                    if nitem == items[0]:
-                        items.append(nitem)
-                        rspos.append(o)
-            for r in rspos:
-                positions[r] += 1
-
-            while others and positions[0] > len(others[0]) - 1:
-                others.pop(0)
-                positions.pop(0)
-                lens.pop(0)
-            if (
-                not others or
-                ((cql.value == 'not' or all) and len(others) != nors)
-            ):
-                cont = 0
+                        else:
+                            try:
+                                nitem = others[o][positions[o]]
+                            except IndexError:
+                                oidxs[o - 1] = -1
+                                continue
+                            if nitem < items[0]:
+                                if all or cql.value == 'not':
+                                    # skip until equal or greater
+                                    positions[o] = self._skipTo(others[o],
+                                                                items[0],
+                                                                positions[o],
+                                                                lens[o])
+                                    if positions[o] != lens[o]:
+                                        nitem = others[o][positions[o]]
+                                else:
+                                    items = [nitem]
+                                    rspos = [o]
+                                    continue
+                        if nitem == items[0]:
+                            items.append(nitem)
+                            rspos.append(o)
+                for r in rspos:
+                    positions[r] += 1
+
+                while others and positions[0] > len(others[0]) - 1:
+                    others.pop(0)
+                    positions.pop(0)
+                    lens.pop(0)
+                if (
+                    not others or
+                    ((cql.value == 'not' or all) and len(others) != nors)
+                ):
+                    cont = 0
             if (all and len(items) < nors):
                 continue
             elif cql.value == 'not' and len(items) != 1:
@@ -885,11 +1024,19 @@ class SimpleResultSet(RankedResultSet):
                     ritem = items.pop(0)
                     rtermid = ritem.resultSet.termid
                     matchlocs = []
+                    lproxInfo = litem.proxInfo
+                    lproxIndex = self._proxIndex(lproxInfo, proxtype)
                     for rpiFull in ritem.proxInfo:
-                        rpi = list(rpiFull[-1])
+                        rpi = rpiFull[-1]
                         (relem, rwpos) = rpi[:2]
-                        for lpiFull in litem.proxInfo:
-                            lpi = list(lpiFull[-1])
+                        # Only those of left that may be in distance
+                        for x in self._proxCandidates(lproxIndex,
+                                                      len(lproxInfo),
+                                                      rpi, proxtype,
+                                                      distance, comparison,
+                                                      ordered):
+                            lpiFull = lproxInfo[x]
+                            lpi = lpiFull[-1]
                             (lelem, lwpos) = lpi[:2]
                             if lelem == relem:
                                 if proxtype == 2:
@@ -1019,8 +1166,375 @@ class SimpleResultSet(RankedResultSet):
             self.maxWeight = maxWeight
         return self
 
-    def order(self, session, spec,
-              ascending=None, missing=None, case=None, accents=None):
+    def merge(self, session, others, proxInfo=False):
+        """Merge resultSets of terms expanded from a single term into self.
+
+        As combine with 'any', but the occurrences of each record are summed
+        over all of others, and if proxInfo is true, the proxInfo of every
+        item is kept. Intended for the many resultSets of the terms matching
+        a masked term or a range. Items are merged in a single pass using a
+        heap of the current position in each of others. Return self.
+        """
+        others = [o for o in others if len(o)]
+        for o in others:
+            self.termIdHash[o.termid] = o.queryTerm
+            if o.fromStore:
+                # Re-sort before merging as likely out of order
+                if o[0].numericId is not None:
+                    o.order(session, 'numericId')
+                else:
+                    o.order(session, 'id')
+        if not others:
+            return self
+        itemFactory = others[0]._itemFactory
+        for o in others:
+            if (
+                getattr(o, '_columns', None) is None or
+                o._itemCache or
+                o._itemFactory != itemFactory
+            ):
+                break
+        else:
+            # Sum occurrences by record in a hash, which is faster than a heap
+            # when there are no items to construct
+            m = max([max(o._columns[1]) for o in others]) + 1
+            occHash = {}
+            get = occHash.get
+            for o in others:
+                (recIds, storeIds, occs) = o._columns
+                for (recId, storeId, occ) in izip(recIds, storeIds, occs):
+                    k = (recId * m) + storeId
+                    occHash[k] = get(k, 0) + occ
+            self._fromOccHash(session, occHash, m, itemFactory)
+            return self
+        tmplist = []
+        for items in self._mergeItems(others):
+            item = items[0]
+            if len(items) > 1:
+                item.occurences = sum([i.occurences for i in items])
+                if proxInfo:
+                    hits = []
+                    for i in items:
+                        hits.extend(i.proxInfo)
+                    hits.sort()
+                    item.proxInfo = hits
+            item.resultSet = self
+            tmplist.append(item)
+        self._list = tmplist
+        return self
+
+    def _mergeItems(self, others):
+        """Merge items of resultSets in others, generate lists of equal items.
+
+        An n-way merge using a heap of the current position in each of
+        others, so that each item is compared with O(log n) others rather
+        than with the current item of every one. Each list of equal items is
+        in the order of others.
+        """
+        heap = [(o[0], x, 0) for (x, o) in enumerate(others) if len(o)]
+        heapq.heapify(heap)
+        while heap:
+            item = heap[0][0]
+            items = []
+            while heap and heap[0][0] == item:
+                (nitem, x, p) = heap[0]
+                items.append(nitem)
+                p += 1
+                if p < len(others[x]):
+                    heapq.heapreplace(heap, (others[x][p], x, p))
+                else:
+                    heapq.heappop(heap)
+            yield items
+
+    def _proxIndex(self, proxInfo, proxtype):
+        """Index proxInfo matches by element and position, return dict.
+
+        Return a dictionary of element to (positions, indexes), the sorted
+        positions of the last location of each match in that element and
+        the indexes of the matches in proxInfo. Positions are word
+        positions, or character offsets for proxtype 3. Return None if
+        proxInfo does not have the offsets needed.
+        """
+        if proxtype == 3:
+            posn = 2
+        else:
+            posn = 1
+        byElem = {}
+        try:
+            for (x, piFull) in enumerate(proxInfo):
+                pi = piFull[-1]
+                byElem.setdefault(pi[0], []).append((pi[posn], x))
+        except IndexError:
+            return None
+        for (elem, entries) in byElem.iteritems():
+            entries.sort()
+            byElem[elem] = ([e[0] for e in entries], [e[1] for e in entries])
+        return byElem
+
+    def _proxCandidates(self, proxIndex, n, pi, proxtype, distance,
+                        comparison, ordered):
+        """Return indexes of matches which may be in distance of pi.
+
+        Return, in ascending order, the indexes of the n matches indexed
+        by _proxIndex whose last location is in the same element as
+        location pi, and for a maximum distance, within it. Matches must
+        still be checked, but others need not be.
+        """
+        if proxIndex is None:
+            return xrange(n)
+        try:
+            (posns, idxs) = proxIndex[pi[0]]
+        except KeyError:
+            return []
+        if proxtype == 2 or comparison not in ['<', '<=', '=']:
+            return sorted(idxs)
+        try:
+            if proxtype == 3:
+                pos = pi[2]
+            else:
+                pos = pi[1]
+        except IndexError:
+            return sorted(idxs)
+        lo = bisect.bisect_left(posns, pos - distance)
+        if ordered:
+            hi = bisect.bisect_right(posns, pos)
+        else:
+            hi = bisect.bisect_right(posns, pos + distance)
+        return sorted(idxs[lo:hi])
+
+    def _skipTo(self, rs, item, lo, hi):
+        """Return position of the first item of rs not less than item.
+
+        Search positions after lo and before hi, where rs[lo] is less than
+        item. Gallop ahead in doubling steps, then binary search the last
+        step, so that skipping n items takes O(log n) comparisons.
+        """
+        step = 1
+        while lo + step < hi and rs[lo + step] < item:
+            lo += step
+            step *= 2
+        hi = min(lo + step, hi)
+        lo += 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rs[mid] < item:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _matchColumns(self, columns, posns, otherColumns):
+        """Return which of posns in columns are also in otherColumns.
+
+        Return a list of True/False for each of posns (ascending positions
+        in columns), according to whether the record at that position is
+        also in otherColumns, which must be in record order.
+        """
+        (recIds, storeIds) = columns[:2]
+        (oRecIds, oStoreIds) = otherColumns[:2]
+        n = len(oRecIds)
+        if len(posns) * self.gallopRatio > n:
+            others = set(izip(oRecIds, oStoreIds))
+            return [(recIds[p], storeIds[p]) in others for p in posns]
+        # Binary search for each, from the last found
+        found = []
+        lo = 0
+        for p in posns:
+            recId = recIds[p]
+            lo = bisect.bisect_left(oRecIds, recId, lo)
+            x = lo
+            while x < n and oRecIds[x] == recId:
+                if oStoreIds[x] == storeIds[p]:
+                    break
+                x += 1
+            found.append(x < n and oRecIds[x] == recId)
+        return found
+
+    def _combineColumns(self, session, others, op):
+        """Combine columns of resultSets in others into self.
+
+        Boolean combination of resultSets populated by ``fromColumns``,
+        using set operations on the columns rather than merging items.
+        Return False without combining if any of others has no columns, or
+        has had items constructed that may have been modified.
+        """
+        itemFactory = others[0]._itemFactory
+        for o in others:
+            if (
+                getattr(o, '_columns', None) is None or
+                o._itemCache or
+                o._itemFactory != itemFactory
+            ):
+                return False
+        if op in ['all', 'and', 'not']:
+            # Items of the first (for and, the shortest) which are in all,
+            # or none, of the rest. The rest may be far longer, so items are
+            # looked up in them rather than merged
+            keep = op != 'not'
+            columns = others[0]._columns
+            posns = range(len(columns[0]))
+            for o in others[1:]:
+                if posns:
+                    found = self._matchColumns(columns, posns, o._columns)
+                    posns = [p for (p, f) in izip(posns, found) if f == keep]
+            for o in others:
+                self.termIdHash[o.termid] = o.queryTerm
+            (recIds, storeIds, occs) = [array(c.typecode, [c[p]
+                                                           for p
+                                                           in posns])
+                                        for c
+                                        in columns]
+            self.fromColumns(session, recIds, storeIds, occs, itemFactory)
+            return True
+        # Combine (recordId, storeId) into a single integer key
+        m = max([max(o._columns[1]) for o in others if len(o)] or [0]) + 1
+        keyLists = []
+        for o in others:
+            (recIds, storeIds, occs) = o._columns
+            if m == 1:
+                keys = recIds
+            else:
+                keys = [(d * m) + s for (d, s) in izip(recIds, storeIds)]
+            keyLists.append((keys, occs))
+            self.termIdHash[o.termid] = o.queryTerm
+        # Items in any, occurrences from the first containing item
+        occHash = {}
+        for (keys, occs) in reversed(keyLists):
+            occHash.update(izip(keys, occs))
+        self._fromOccHash(session, occHash, m, itemFactory)
+        return True
+
+    def _fromOccHash(self, session, occHash, m, itemFactory):
+        # Populate columns from hash of (recordId * m) + storeId to
+        # occurrences
+        keys = sorted(occHash)
+        occs = array('l', [occHash[k] for k in keys])
+        if m == 1:
+            recIds = array('l', keys)
+            storeIds = array('l', [0]) * len(keys)
+        else:
+            recIds = array('l', [k // m for k in keys])
+            storeIds = array('l', [k % m for k in keys])
+        self.fromColumns(session, recIds, storeIds, occs, itemFactory)
+
+    def _combineBitmaps(self, session, others, op):
+        """Combine bitmap resultSets in others, return list to merge.
+
+        Bitmap resultSets are combined with each other as bitfields, then
+        used to filter the first of the other resultSets for and/not, or
+        converted to items for or. Return a list of resultSets that remain
+        to be merged.
+        """
+        bitmaps = [o for o in others if hasattr(o, 'bitfield')]
+        rest = [o for o in others if not hasattr(o, 'bitfield')]
+        if op == 'not':
+            # Bitmaps to be removed from the first resultSet
+            bitmaps = [o for o in bitmaps if o is not others[0]]
+        # Combine bitfields for each recordStore
+        fields = {}
+        for b in bitmaps:
+            if b.recordStore not in fields:
+                fields[b.recordStore] = SimpleBitfield(int(b.bitfield))
+            elif op in ['all', 'and']:
+                fields[b.recordStore].intersection(b.bitfield)
+            else:
+                fields[b.recordStore].union(b.bitfield)
+        if op in ['all', 'and']:
+            if len(fields) > 1:
+                # No record can be in more than one recordStore
+                fields = {}
+            return [self._filterBitmaps(session, rest[0], fields, 1)
+                    ] + rest[1:]
+        elif op in ['any', 'or']:
+            for (store, bf) in fields.iteritems():
+                rs = SimpleResultSet(session, [], recordStore=store)
+                rs._list = [SimpleResultSetItem(None, x, store, 1, resultSet=rs)
+                            for x
+                            in bf.trueItems()
+                            ]
+                rest.append(rs)
+            return rest
+        elif hasattr(others[0], 'bitfield'):
+            # Remove items of the rest from a copy of the first bitmap
+            store = others[0].recordStore
+            bf = SimpleBitfield(int(others[0].bitfield))
+            if store in fields:
+                bf.difference(fields[store])
+            for o in rest:
+                docids = [self._itemDocid(i)
+                          for i
+                          in o
+                          if i.recordStore == store
+                          ]
+                bf.difference(SimpleBitfield.fromTrueItems(docids))
+            return [BitmapResultSet(session, bf, recordStore=store)]
+        else:
+            return [self._filterBitmaps(session, rest[0], fields, 0)
+                    ] + rest[1:]
+
+    def _itemDocid(self, item):
+        # Docid of item, as used as a position in a bitmap
+        if item.numericId is not None:
+            return item.numericId
+        return item.id
+
+    def _filterBitmaps(self, session, rs, fields, keep):
+        """Return a resultSet with items of rs filtered by bitfields.
+
+        fields maps recordStore identifiers to SimpleBitfields. Items are
+        kept if their presence in the bitfield for their recordStore
+        matches keep.
+        """
+        if rs._columns is not None and not rs._itemCache:
+            (recIds, storeIds, occs) = rs._columns
+            docids = recIds
+            # Find recordStore identifier for each storeId
+            storeNames = {}
+            for (k, s) in enumerate(storeIds):
+                if s not in storeNames:
+                    storeNames[s] = rs[k].recordStore
+            stores = [storeNames[s] for s in storeIds]
+        else:
+            docids = [self._itemDocid(i) for i in rs]
+            stores = [i.recordStore for i in rs]
+        present = [0] * len(docids)
+        for (store, bf) in fields.iteritems():
+            posns = [k for (k, s) in enumerate(stores) if s == store]
+            if len(posns) * len(bf) < self.bitmapProbeLimit:
+                # Shift to each docid in the bitmap
+                d = int(bf)
+                for k in posns:
+                    present[k] = (d >> docids[k]) & 1
+            else:
+                # Intersect bitmaps, then test membership
+                found = SimpleBitfield.fromTrueItems([docids[k]
+                                                      for k
+                                                      in posns
+                                                      ])
+                found.intersection(bf)
+                found = set(found.trueItems())
+                for k in posns:
+                    present[k] = docids[k] in found
+        new = SimpleResultSet(session, [], recordStore=rs.recordStore)
+        for a in ['termid', 'totalOccs', 'totalRecs', 'index', 'queryTerm',
+                  'queryFreq', 'queryPositions', 'relevancy', 'maxWeight',
+                  'minWeight', 'termWeight', 'recordStoreSizes']:
+            setattr(new, a, getattr(rs, a))
+        keep = bool(keep)
+        if rs._columns is not None and not rs._itemCache:
+            posns = [k for (k, p) in enumerate(present) if bool(p) == keep]
+            new.fromColumns(session,
+                            array(recIds.typecode, [recIds[k] for k in posns]),
+                            array(storeIds.typecode,
+                                  [storeIds[k] for k in posns]),
+                            array(occs.typecode, [occs[k] for k in posns]),
+                            rs._itemFactory)
+        else:
+            new._list = [i for (i, p) in izip(rs, present) if bool(p) == keep]
+        return new
+
+    def order(self, session, spec, ascending=None, missing=None,
+              case=None, accents=None, topK=0):
         """Re-order based on the given specification and arguments.
 
         :param spec: specification on which to order the ResultSet
@@ -1033,6 +1547,8 @@ class SimpleResultSet(RankedResultSet):
         :type case: True or False
         :param accents: exclude accented characters
         :type accents: True or False
+        :param topK: only order the first topK items (all by default)
+        :type topK: int
         :rtype: None
 
         Not handling yet:
@@ -1043,10 +1559,16 @@ class SimpleResultSet(RankedResultSet):
         Clause is a CQL clause with sort attributes on the relation
         """
 
-        l = self._list
-        if not l:
+        if not len(self):
             # don't try to sort empty set
             return
+        keys = self._sortKeys(session, spec, ascending, missing, case,
+                              accents)
+        if keys is not None:
+            # Sort integers rather than values
+            self._orderByKeys(session, keys[0], topK)
+            return
+        l = self._list
         if (
             isinstance(spec, Index) and
             spec.get_setting(session, 'sortStore')
@@ -1132,9 +1654,155 @@ class SimpleResultSet(RankedResultSet):
             # due to spec later...
             ascending = True
 
-        tmplist.sort(reverse=not(ascending))
+        if topK and topK < len(tmplist):
+            # Select the first topK with a bounded heap, leaving the rest
+            # in their current order
+            if ascending:
+                top = heapq.nsmallest(topK, tmplist)
+            else:
+                top = heapq.nlargest(topK, tmplist)
+            topIds = set([id(x) for x in top])
+            top.extend([x for x in tmplist if id(x) not in topIds])
+            tmplist = top
+        else:
+            tmplist.sort(reverse=not(ascending))
         self._list = [x for (key, x) in tmplist]
 
+    def order_multiple(self, session, specs):
+        """Re-order based on several specifications, most significant first.
+
+        :param specs: tuples of (spec, ascending, missing, case, accents),
+        as the arguments of order
+        :type specs: list
+        :rtype: None
+
+        If every spec is an Index with a table of ranks of sort values, the
+        items are sorted once on a composite integer key. Otherwise they are
+        ordered by each spec in turn, from the least significant.
+        """
+        if not len(self) or not specs:
+            return
+        composite = None
+        for (spec, ascending, missing, case, accents) in specs:
+            keys = self._sortKeys(session, spec, ascending, missing, case,
+                                  accents)
+            if keys is None:
+                break
+            if composite is None:
+                composite = keys[0]
+            else:
+                (keys, width) = keys
+                composite = [None if (c is None or k is None) else
+                             (c * width) + k
+                             for (c, k)
+                             in izip(composite, keys)]
+        else:
+            self._orderByKeys(session, composite)
+            return
+        for spec in reversed(specs):
+            self.order(session, *spec)
+
+    def _sortKeys(self, session, spec, ascending, missing, case, accents):
+        """Return integer sort keys for items, from ranks of sort values.
+
+        Look up the rank, in the order of all sort values of Index spec, of
+        the lowest (or unless ascending, highest) sort value of each item in
+        the table built by the IndexStore. Keys are from 0 up to but not
+        including a width, in the order in which items are to be sorted, or
+        None for items to omit. Return tuple of (list of keys, width), or
+        None if spec has no table for the items, or the arguments require
+        sort values.
+        """
+        if (
+            not isinstance(spec, Index) or
+            not spec.get_setting(session, 'sortStore') or
+            not hasattr(spec, 'fetch_sortKeys') or
+            (case is not None and not case) or
+            (accents is not None and not accents) or
+            missing not in [None, -1, 0, 1]
+        ):
+            return None
+        if self._columns is not None:
+            docs = izip(*self._columns[:2])
+        else:
+            docs = []
+            for x in self._items:
+                if x.numericId is not None:
+                    docid = x.numericId
+                else:
+                    docid = x.id
+                if isinstance(docid, basestring) and docid.isdigit():
+                    docid = long(docid)
+                elif type(docid) not in [int, long]:
+                    return None
+                docs.append((docid, x.recordStore))
+        if ascending:
+            offset = 2
+        else:
+            offset = 3
+        tables = {}
+        ranks = []
+        append = ranks.append
+        for (docid, store) in docs:
+            try:
+                table = tables[store]
+            except KeyError:
+                table = spec.fetch_sortKeys(session, store)
+                if table is None:
+                    return None
+                tables[store] = table
+            try:
+                append(table[(2 * docid) + offset])
+            except IndexError:
+                append(-1)
+        nRanks = table[0]
+        # Missing values rank -1, or nRanks to sort high
+        if missing == 0:
+            ranks = [None if r == -1 else r for r in ranks]
+        elif missing == 1:
+            ranks = [nRanks if r == -1 else r for r in ranks]
+        if ascending is None or ascending:
+            keys = [None if r is None else r + 1 for r in ranks]
+        else:
+            keys = [None if r is None else nRanks - r for r in ranks]
+        return (keys, nRanks + 2)
+
+    def _orderByKeys(self, session, keys, topK=0):
+        # Re-order items by keys, omitting those whose key is None. Items
+        # with equal keys stay in their current order
+        if None in keys:
+            posns = [p for (p, k) in enumerate(keys) if k is not None]
+        else:
+            posns = range(len(keys))
+        if topK and topK < len(posns):
+            # Select the first topK, leaving the rest in their current order
+            top = heapq.nsmallest(topK, posns, key=keys.__getitem__)
+            topPosns = set(top)
+            top.extend([p for p in posns if p not in topPosns])
+            posns = top
+        else:
+            posns.sort(key=keys.__getitem__)
+        if self._columns is None:
+            items = self._items
+            self._list = [items[p] for p in posns]
+            return
+        cache = self._itemCache
+        (recIds, storeIds, occs) = [array(c.typecode, [c[p] for p in posns])
+                                    for c
+                                    in self._columns]
+        self.fromColumns(session, recIds, storeIds, occs, self._itemFactory)
+        if cache:
+            # Keep items that have already been constructed
+            newPosns = dict([(p, x) for (x, p) in enumerate(posns)])
+            for (p, item) in cache.iteritems():
+                try:
+                    x = newPosns[p]
+                except KeyError:
+                    # Omitted
+                    continue
+                item.resultSetPosition = x
+                self._itemCache[x] = item
+
     def reverse(self, session):
         self._list.reverse()
 
@@ -1309,6 +1977,11 @@ class BitmapResultSet(ResultSet):
     def __getitem__(self, k):
         if self.currItems is None:
             self.currItems = self.bitfield.trueItems()
+        if isinstance(k, slice):
+            return [SimpleResultSetItem(None, x, self.recordStore, 1)
+                    for x
+                    in self.currItems[k]
+                    ]
         return SimpleResultSetItem(None,
                                    self.currItems[k],
                                    self.recordStore,
@@ -1317,6 +1990,13 @@ class BitmapResultSet(ResultSet):
     def __len__(self):
         return self.bitfield.lenTrueItems()
 
+    def __copy__(self):
+        # Copy that can be combined into without affecting self
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.bitfield = SimpleBitfield(int(self.bitfield))
+        return new
+
     def serialise(self, session):
         return self.serialize(session)
 
@@ -1374,8 +2054,9 @@ class BitmapResultSet(ResultSet):
                 raise NotImplementedError()
             self.bitfield = s
         else:
-            # XXX Merging Bitmap with non bitmap
-            pass
+            # Merge items of non bitmaps, filtered by or including bitmaps
+            new = SimpleResultSet(session, [], recordStore=self.recordStore)
+            return new.combine(session, others, clause, db)
         return self
 
     def order(self, spec):
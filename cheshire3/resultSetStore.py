@@ -39,6 +39,11 @@ class SimpleResultSetStore(ResultSetStore):
 
     def __init__(self, session, config, parent):
         ResultSetStore.__init__(self, session, config, parent)
+        # Per store, not shared between all stores through the class
+        self.storeHash = {}
+        self.storeHashReverse = {}
+        self.databaseHash = {}
+        self.databaseHashReverse = {}
         rsh = self.get_path(session, 'recordStoreHash')
         if rsh:
             wds = rsh.split()
@@ -18,12 +18,14 @@ __all__ = ['testAll',
            'testBaseStore',
            'testConfigParser',
            'testConfigs',
+           'testDatabase',
            'testDocument',
            'testDocumentFactory',
            'testDocumentStore',
            'testDynamic',
            'testExtractor',
            'testIndex',
+           'testIndexStore',
            'testLogger',
            'testNormalizer',
            'testParser',
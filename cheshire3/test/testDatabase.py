@@ -0,0 +1,373 @@
+u"""Cheshire3 Database Unittests.
+
+Database configurations may be customized by the user. For the purposes of
+unittesting, configuration files will be ignored and Database instances will
+be instantiated using configuration data defined within this testing module,
+and tests carried out on instances.
+"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import threading
+
+from tempfile import mkdtemp
+from shutil import rmtree
+from lxml import etree
+
+from cheshire3.cqlParser import parse as cqlparse
+from cheshire3.database import SimpleDatabase, OptimisingDatabase
+from cheshire3.exceptions import PermissionException
+from cheshire3.record import LxmlRecord
+from cheshire3.resultSet import SimpleResultSet, SimpleResultSetItem
+from cheshire3.test.testConfigParser import Cheshire3ObjectTestCase
+
+
+class FakeProtocolMap(object):
+    """ProtocolMap specifically for unittesting Databases.
+
+    Resolve the index of every clause by its identifier.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def resolveIndex(self, session, query):
+        return self.db.get_object(session, query.index.value)
+
+
+class FakePermissionHandler(object):
+    """PermissionHandler specifically for unittesting Databases.
+
+    Deny permission to every user.
+    """
+
+    def hasPermission(self, session, user):
+        return False
+
+
+class SimpleDatabaseTestCase(Cheshire3ObjectTestCase):
+    """Test searching a SimpleDatabase with a single SimpleIndex."""
+
+    @classmethod
+    def _get_class(cls):
+        return SimpleDatabase
+
+    def _get_settings(self):
+        return ''
+
+    def _get_config(self):
+        return etree.XML('''\
+        <subConfig type="database" id="db_testDatabase">
+          <objectType>cheshire3.database.{0.__name__}</objectType>
+          <paths>
+              <path type="defaultPath">{1}</path>
+              <object type="indexStore" ref="indexStore"/>
+          </paths>
+          <options>
+              {2}
+          </options>
+        </subConfig>'''.format(self._get_class(),
+                               self.defaultPath,
+                               self._get_settings()))
+
+    def _get_dependencyConfigs(self):
+        yield etree.XML('''\
+        <subConfig type="indexStore" id="indexStore">
+          <objectType>cheshire3.indexStore.BdbIndexStore</objectType>
+          <paths>
+              <path type="defaultPath">{0}</path>
+              <path type="tempPath">temp</path>
+              <path type="recordStoreHash">recordStore</path>
+          </paths>
+        </subConfig>'''.format(self.defaultPath))
+        yield etree.XML('''\
+        <subConfig type="index" id="idx-title">
+          <objectType>cheshire3.index.SimpleIndex</objectType>
+          <paths>
+            <object type="indexStore" ref="indexStore"/>
+          </paths>
+          <source>
+            <xpath>title</xpath>
+            <process>
+                <object type="extractor" ref="SimpleExtractor"/>
+            </process>
+          </source>
+        </subConfig>''')
+
+    def _get_test_records(self):
+        # Every record has title 'all'. Those with ids divisible by 2, 3 and
+        # 6 also have titles 'two', 'three' and 'six' respectively
+        for x in range(12):
+            titles = ['all']
+            for (n, name) in [(2, 'two'), (3, 'three'), (6, 'six')]:
+                if not x % n:
+                    titles.append(name)
+            rec = LxmlRecord(etree.XML('<record>{0}</record>'.format(
+                ''.join(['<title>{0}</title>'.format(t) for t in titles])
+            )), docId=x)
+            rec.recordStore = 0
+            yield rec
+
+    def _search(self, cql):
+        query = cqlparse(cql)
+        return sorted([rsi.id for rsi in self.testObj.search(self.session,
+                                                             query)])
+
+    def setUp(self):
+        # Create a tempfile placeholder
+        self.defaultPath = mkdtemp(prefix=self.__class__.__name__)
+        Cheshire3ObjectTestCase.setUp(self)
+        self.session.database = self.testObj.id
+        self.server.objects[self.testObj.id] = self.testObj
+        self.testObj.paths['protocolMap'] = FakeProtocolMap(self.testObj)
+        self.index = self.testObj.get_object(self.session, 'idx-title')
+        indexStore = self.index.get_path(self.session, 'indexStore')
+        indexStore.create_index(self.session, self.index)
+        for rec in self._get_test_records():
+            self.index.index_record(self.session, rec)
+        self.queries = [
+            ('c3.idx-title = "two"', range(0, 12, 2)),
+            ('c3.idx-title = "two" and c3.idx-title = "three"', [0, 6]),
+            ('c3.idx-title = "two" or c3.idx-title = "three"',
+             [0, 2, 3, 4, 6, 8, 9, 10]),
+            ('c3.idx-title = "all" not c3.idx-title = "two"',
+             range(1, 12, 2)),
+            ('(c3.idx-title = "all" not c3.idx-title = "six") and '
+             '(c3.idx-title = "two" or c3.idx-title = "three")',
+             [2, 3, 4, 8, 9, 10]),
+            ('c3.idx-title = "none" and c3.idx-title = "two"', []),
+            ('(c3.idx-title = "none" and c3.idx-title = "two") or '
+             'c3.idx-title = "six"', [0, 6])
+        ]
+
+    def tearDown(self):
+        rmtree(self.defaultPath)
+
+    def test_search(self):
+        "Check that boolean queries are searched and combined."
+        for (cql, ids) in self.queries:
+            self.assertEqual(self._search(cql), ids, cql)
+
+    def test_search_threads(self):
+        "Check that several threads may search at once."
+        results = []
+        errors = []
+
+        def search():
+            try:
+                for x in range(5):
+                    for (cql, ids) in self.queries:
+                        results.append((self._search(cql), ids, cql))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=search) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 20 * len(self.queries))
+        for (found, ids, cql) in results:
+            self.assertEqual(found, ids, cql)
+
+
+class SearchThreadsSimpleDatabaseTestCase(SimpleDatabaseTestCase):
+    """Test a SimpleDatabase that searches clauses in a pool of threads."""
+
+    def _get_settings(self):
+        return '<setting type="searchThreads">4</setting>'
+
+    def test_get_searchPool(self):
+        "Check that clauses are searched in the pool."
+        self.assertIsNotNone(self.testObj._get_searchPool(self.session))
+        inPool = []
+
+        def function(x):
+            inPool.append(self.testObj._get_searchPool(self.session))
+            return x * 2
+
+        self.assertEqual(self.testObj.map_search(self.session,
+                                                 function,
+                                                 range(5)),
+                         range(0, 10, 2))
+        # Not nested within the pool
+        self.assertEqual(inPool, [None] * 5)
+
+
+class QueryCacheSimpleDatabaseTestCase(SimpleDatabaseTestCase):
+    """Test a SimpleDatabase that caches the ResultSets of searches."""
+
+    def _get_settings(self):
+        return '<setting type="queryCacheSize">10</setting>'
+
+    def setUp(self):
+        SimpleDatabaseTestCase.setUp(self)
+        self.testObj.indexes['idx-title'] = self.index
+
+    def test_search_cached(self):
+        "Check that repeated searches are served from the cache."
+        searched = []
+        search = self.index.search
+
+        def recordingSearch(session, query, db):
+            searched.append(query.term.value)
+            return search(session, query, db)
+
+        self.index.search = recordingSearch
+        for (cql, ids) in self.queries:
+            self.assertEqual(self._search(cql), ids, cql)
+        nSearched = len(searched)
+        for (cql, ids) in self.queries:
+            self.assertEqual(self._search(cql), ids, cql)
+        self.assertEqual(len(searched), nSearched)
+
+    def test_cache_resultSet_items(self):
+        "Check that items of cached ResultSets are not shared."
+        rs = SimpleResultSet(self.session,
+                             [SimpleResultSetItem(self.session, id=x)
+                              for x
+                              in range(2)])
+        self.testObj._cache_resultSet(self.session, 'key', rs)
+        rs[0].weight = 0.9
+        cached = self.testObj._fetch_cachedResultSet(self.session, 'key')
+        self.assertEqual([rsi.weight for rsi in cached], [0.5, 0.5])
+        cached[1].weight = 0.9
+        cached = self.testObj._fetch_cachedResultSet(self.session, 'key')
+        self.assertEqual([rsi.weight for rsi in cached], [0.5, 0.5])
+
+    def test_search_changed(self):
+        "Check that cached ResultSets are discarded when indexes change."
+        self.assertEqual(self._search('c3.idx-title = "six"'), [0, 6])
+        # Index directly, as another process would, so that the cache is
+        # not cleared by the database
+        rec = LxmlRecord(etree.XML('<record><title>six</title></record>'),
+                         docId=12)
+        rec.recordStore = 0
+        self.index.index_record(self.session, rec)
+        self.assertEqual(self._search('c3.idx-title = "six"'), [0, 6, 12])
+
+
+class OptimisingDatabaseTestCase(SimpleDatabaseTestCase):
+    """Test planning and searching queries in an OptimisingDatabase."""
+
+    @classmethod
+    def _get_class(cls):
+        return OptimisingDatabase
+
+    def _plan(self, cql):
+        # Return planned query, and the terms of its clauses to be searched
+        plan = self.testObj.plan_query(self.session, cqlparse(cql))
+        return (plan,
+                [clause.term.value
+                 for clause
+                 in self.testObj._searchClauses(plan)])
+
+    def test_plan_query_rarest(self):
+        "Check that chains of 'and' are planned rarest operand first."
+        (plan, terms) = self._plan('c3.idx-title = "all" and '
+                                   'c3.idx-title = "two" and '
+                                   'c3.idx-title = "six"')
+        self.assertEqual(terms, ['six', 'two', 'all'])
+        self.assertEqual(plan.resultCount, 2)
+        self.assertEqual(plan.leftOperand.resultCount, 2)
+        self.assertEqual(plan.rightOperand.resultCount, 12)
+
+    def test_plan_query_not(self):
+        "Check that 'not' operands of a chain of 'and' are moved to the end."
+        (plan, terms) = self._plan('(c3.idx-title = "all" not '
+                                   'c3.idx-title = "three") and '
+                                   'c3.idx-title = "two"')
+        self.assertEqual(terms, ['two', 'all', 'three'])
+        self.assertEqual(plan.boolean.value, 'not')
+        self.assertEqual(plan.leftOperand.boolean.value, 'and')
+        self.assertEqual(plan.resultCount, 6)
+
+    def test_plan_query_or(self):
+        "Check that operands of 'or' are not reordered."
+        (plan, terms) = self._plan('c3.idx-title = "all" or '
+                                   'c3.idx-title = "six"')
+        self.assertEqual(terms, ['all', 'six'])
+        self.assertEqual(plan.resultCount, 14)
+
+    def test_plan_query_empty(self):
+        "Check that subtrees that can match nothing are not searched."
+        (plan, terms) = self._plan('(c3.idx-title = "none" and '
+                                   'c3.idx-title = "two") or '
+                                   'c3.idx-title = "six"')
+        self.assertEqual(terms, ['six'])
+        self.assertEqual(plan.leftOperand.resultCount, 0)
+        (plan, terms) = self._plan('c3.idx-title = "two" and '
+                                   'c3.idx-title = "none"')
+        self.assertEqual(terms, [])
+        self.assertEqual(plan.resultCount, 0)
+
+    def test_plan_query_restricted(self):
+        "Check that terms of indexes the user may not search are not read."
+        self.index.permissionHandlers = {
+            'info:srw/operation/2/search': FakePermissionHandler()
+        }
+        (plan, terms) = self._plan('c3.idx-title = "all" and '
+                                   'c3.idx-title = "six"')
+        self.assertEqual(plan.resultCount, self.testObj.unknownResultCount)
+        self.assertEqual(plan.leftOperand.resultCount,
+                         self.testObj.unknownResultCount)
+        with self.assertRaises(PermissionException):
+            self._search('c3.idx-title = "six"')
+
+    def test_search_empty(self):
+        "Check that clauses in subtrees that can match nothing are skipped."
+        searched = []
+        search = self.index.search
+
+        def recordingSearch(session, query, db):
+            searched.append(query.term.value)
+            return search(session, query, db)
+
+        self.index.search = recordingSearch
+        self.assertEqual(self._search('(c3.idx-title = "none" and '
+                                      'c3.idx-title = "two") or '
+                                      'c3.idx-title = "six"'),
+                         [0, 6])
+        self.assertEqual(searched, ['six'])
+
+    def test_explain(self):
+        "Check that the plan is described with estimates."
+        query = cqlparse('(c3.idx-title = "none" and '
+                         'c3.idx-title = "two") or '
+                         'c3.idx-title = "all" and c3.idx-title = "six"')
+        cql = query.toCQL()
+        self.assertEqual(
+            self.testObj.explain(self.session, query).splitlines(),
+            ['and (estimate 2)',
+             '  c3.idx-title = "six" (estimate 2)',
+             '  or (estimate 12)',
+             '    and (estimate 0, not searched)',
+             '    c3.idx-title = "all" (estimate 12)'])
+        # query is not modified
+        self.assertEqual(query.toCQL(), cql)
+
+
+class SearchThreadsOptimisingDatabaseTestCase(OptimisingDatabaseTestCase):
+    """Test an OptimisingDatabase that searches clauses in a pool."""
+
+    def _get_settings(self):
+        return '<setting type="searchThreads">4</setting>'
+
+
+def load_tests(loader, tests, pattern):
+    # Alias loader.loadTestsFromTestCase for sake of line lengths
+    ltc = loader.loadTestsFromTestCase
+    suite = ltc(SimpleDatabaseTestCase)
+    suite.addTests(ltc(SearchThreadsSimpleDatabaseTestCase))
+    suite.addTests(ltc(QueryCacheSimpleDatabaseTestCase))
+    suite.addTests(ltc(OptimisingDatabaseTestCase))
+    suite.addTests(ltc(SearchThreadsOptimisingDatabaseTestCase))
+    return suite
+
+if __name__ == '__main__':
+    tr = unittest.TextTestRunner(verbosity=2)
+    tr.run(load_tests(unittest.defaultTestLoader, [], 'test*.py'))
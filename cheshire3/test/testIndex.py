@@ -18,7 +18,8 @@ from lxml import etree
 
 from cheshire3.baseObjects import Database, IndexStore
 from cheshire3.cqlParser import parse as cqlparse
-from cheshire3.index import SimpleIndex
+from cheshire3.index import SimpleIndex, ProximityIndex
+from cheshire3.index import CompressedIndex, CompressedProximityIndex
 from cheshire3.record import LxmlRecord
 from cheshire3.resultSet import SimpleResultSet, SimpleResultSetItem
 from cheshire3.test.testConfigParser import Cheshire3ObjectTestCase
@@ -335,6 +336,34 @@ class SimpleIndexTestCase(Cheshire3ObjectTestCase):
         with self.assertRaises(IndexError):
             rs[2]
 
+    def test_construct_resultSet_duplicates(self):
+        """Test that adjacent duplicate postings are filtered out."""
+        indexData = [0, 3, 6, 0, 0, 3, 1, 0, 2, 1, 0, 2, 2, 0, 1]
+        rs = self.testObj.construct_resultSet(self.session, indexData, {})
+        self.assertEqual([(rsi.id, rsi.occurences) for rsi in rs],
+                         [(0, 3), (1, 2), (2, 1)])
+
+    def test_construct_packedResultSet(self):
+        """Test ResultSet construction from serialized data."""
+        if not self.testObj.canExtractColumns:
+            self.skipTest("{0} cannot extract columns"
+                          "".format(self.testObj.__class__.__name__))
+        # Include a duplicate, which should be filtered out
+        data = self.testObj.serialize_term(self.session, 7,
+                                           [0, 0, 3, 1, 0, 2, 1, 0, 2])
+        rs = self.testObj.construct_packedResultSet(self.session, data, {})
+        self.assertIsInstance(rs, SimpleResultSet)
+        self.assertEqual(rs.termid, 7)
+        self.assertEqual(rs.totalRecs, 3)
+        self.assertEqual(rs.totalOccs, 7)
+        self.assertEqual(len(rs), 2)
+        self.assertEqual([(rsi.id, rsi.occurences) for rsi in rs],
+                         [(0, 3), (1, 2)])
+        # No data
+        rs = self.testObj.construct_packedResultSet(self.session, None, {})
+        self.assertEqual(len(rs), 0)
+        self.assertEqual(rs.totalRecs, 0)
+
     def test_search(self):
         """Test a simple search of the Index."""
         # Initialize IndexStore with some data
@@ -393,6 +422,41 @@ class SimpleIndexTestCase(Cheshire3ObjectTestCase):
         with self.assertRaises(IndexError):
             rs[2]
 
+    def test_merge_term_add(self):
+        "Test adding data to a term."
+        current = [0, 2, 5, 0, 0, 3, 4, 0, 2]
+        merged = self.testObj.merge_term(self.session, current,
+                                         [6, 0, 1, 2, 0, 1], 'add')
+        self.assertEqual(merged,
+                         [0, 4, 7, 0, 0, 3, 2, 0, 1, 4, 0, 2, 6, 0, 1])
+
+    def test_merge_term_replace(self):
+        "Test replacing data in a term."
+        current = [0, 3, 6, 0, 0, 3, 2, 0, 1, 4, 0, 2]
+        # Replace first and last, insert in the middle, append
+        merged = self.testObj.merge_term(self.session, current,
+                                         [0, 0, 1, 3, 0, 5, 4, 0, 1, 7, 0, 2],
+                                         'replace')
+        self.assertEqual(merged,
+                         [0, 5, 10,
+                          0, 0, 1, 2, 0, 1, 3, 0, 5, 4, 0, 1, 7, 0, 2])
+        # Same docid in a different recordStore is a different posting
+        merged = self.testObj.merge_term(self.session, current,
+                                         [2, 1, 4], 'replace')
+        self.assertEqual(merged,
+                         [0, 4, 10, 0, 0, 3, 2, 0, 1, 2, 1, 4, 4, 0, 2])
+
+    def test_merge_term_delete(self):
+        "Test deleting data from a term."
+        current = [0, 3, 6, 0, 0, 3, 2, 0, 1, 4, 0, 2]
+        merged = self.testObj.merge_term(self.session, current,
+                                         [0, 0, 3, 4, 0, 2, 5, 0, 1],
+                                         'delete')
+        self.assertEqual(merged, [0, 1, 1, 2, 0, 1])
+        merged = self.testObj.merge_term(self.session, merged,
+                                         [2, 0, 1], 'delete')
+        self.assertEqual(merged, [0, 0, 0])
+
 
 class SelectorSimpleIndexTestCase(SimpleIndexTestCase):
     """Test a SimpleIndex configured with a referenced Selector."""
@@ -424,11 +488,188 @@ class SelectorSimpleIndexTestCase(SimpleIndexTestCase):
         </subConfig>'''.format(self._get_class()))
 
 
+class ProximityIndexTestCase(Cheshire3ObjectTestCase):
+    """Test a ProximityIndex."""
+
+    @classmethod
+    def _get_class(cls):
+        return ProximityIndex
+
+    def _get_dependencyConfigs(self):
+        yield etree.XML('''\
+        <subConfig type="indexStore" id="indexStore">
+          <objectType>cheshire3.test.testIndex.FakeIndexStore</objectType>
+        </subConfig>''')
+
+    def _get_config(self):
+        return etree.XML('''\
+        <subConfig type="" id="{0.__name__}">
+          <objectType>{0.__module__}.{0.__name__}</objectType>
+          <paths>
+            <object type="indexStore" ref="indexStore"/>
+          </paths>
+          <source>
+            <xpath>title</xpath>
+            <process>
+                <object type="extractor" ref="ProxExtractor"/>
+                <object type="tokenizer" ref="RegexpFindTokenizer"/>
+                <object type="tokenMerger" ref="ProxTokenMerger"/>
+            </process>
+          </source>
+        </subConfig>'''.format(self._get_class()))
+
+    def _get_current(self):
+        # Deserialized form: [termId, totalRecs, totalOccs, [recId,
+        # recRecordStore, recOccs, elem, wordPos, ...], ...]
+        return [0, 3, 4,
+                [0, 0, 1, 0, 5],
+                [2, 0, 2, 0, 1, 0, 7],
+                [4, 0, 1, 0, 3]]
+
+    def test_merge_term_add(self):
+        "Test adding data to a term."
+        merged = self.testObj.merge_term(self.session, self._get_current(),
+                                         [5, 0, 1, 0, 2, 1, 0, 1, 0, 9],
+                                         'add', nRecs=2, nOccs=2)
+        self.assertEqual(merged,
+                         [0, 5, 6, 0, 0, 1, 0, 5, 1, 0, 1, 0, 9,
+                          2, 0, 2, 0, 1, 0, 7, 4, 0, 1, 0, 3, 5, 0, 1, 0, 2])
+
+    def test_merge_term_replace(self):
+        "Test replacing data in a term."
+        merged = self.testObj.merge_term(self.session, self._get_current(),
+                                         [2, 0, 1, 0, 4, 3, 0, 1, 0, 8],
+                                         'replace')
+        self.assertEqual(merged,
+                         [0, 4, 4, 0, 0, 1, 0, 5, 2, 0, 1, 0, 4,
+                          3, 0, 1, 0, 8, 4, 0, 1, 0, 3])
+
+    def test_merge_term_delete(self):
+        "Test deleting data from a term."
+        merged = self.testObj.merge_term(self.session, self._get_current(),
+                                         [2, 0, 2], 'delete')
+        self.assertEqual(merged, [0, 2, 2, 0, 0, 1, 0, 5, 4, 0, 1, 0, 3])
+
+    def test_construct_resultSetItem(self):
+        "Test that items keep the proximity information of the posting."
+        item = self.testObj.construct_resultSetItem(self.session,
+                                                    [2, 0, 2, 0, 1, 0, 7])
+        self.assertEqual(item.id, 2)
+        self.assertEqual(item.occurences, 2)
+        self.assertEqual(item.proxInfo, [0, 1, 0, 7])
+
+
+class CompressedIndexTestCase(SimpleIndexTestCase):
+    """Test a CompressedIndex with small blocks of postings."""
+
+    @classmethod
+    def _get_class(cls):
+        return CompressedIndex
+
+    def _get_config(self):
+        return etree.XML('''\
+        <subConfig type="" id="{0.__name__}">
+          <objectType>{0.__module__}.{0.__name__}</objectType>
+          <paths>
+            <object type="indexStore" ref="indexStore"/>
+          </paths>
+          <source>
+            <xpath>title</xpath>
+            <process>
+                <object type="extractor" ref="SimpleExtractor"/>
+            </process>
+          </source>
+          <options>
+            <setting type="skipBlockSize">2</setting>
+          </options>
+        </subConfig>'''.format(self._get_class()))
+
+    def _get_postings(self):
+        return [1, 0, 1, 3, 0, 2, 4, 1, 1, 200, 0, 5, 70000, 0, 1]
+
+    def test_serialize_term(self):
+        "Test that serialized postings deserialize unchanged."
+        data = self._get_postings()
+        packed = self.testObj.serialize_term(self.session, 7, data)
+        self.assertEqual(self.testObj.deserialize_term(self.session, packed),
+                         [7, 5, 10] + data)
+        # Summary only
+        self.assertEqual(self.testObj.deserialize_term(self.session,
+                                                       packed[:12]),
+                         [7, 5, 10])
+
+    def test_serialize_term_unsorted(self):
+        "Test that unsorted postings are sorted when serialized."
+        data = [4, 1, 1, 1, 0, 1, 3, 0, 2]
+        packed = self.testObj.serialize_term(self.session, 7, data)
+        self.assertEqual(self.testObj.deserialize_term(self.session, packed),
+                         [7, 3, 4, 1, 0, 1, 3, 0, 2, 4, 1, 1])
+
+    def test_calc_sectionOffsets(self):
+        "Test that sections of postings can be extracted."
+        data = self._get_postings()
+        packed = self.testObj.serialize_term(self.session, 7, data)
+        skipLen = self.testObj.calc_skipTableLength(self.session, packed[:12])
+        self.assertEqual(skipLen, 24)
+        skipTable = packed[12:12 + skipLen]
+        for (start, nRecs, expected) in [(0, 1, data[:6]),
+                                         (2, 2, data[6:12]),
+                                         (3, 0, data[6:])]:
+            vals = [packed[:12]]
+            for o in self.testObj.calc_sectionOffsets(self.session, start,
+                                                      nRecs, len(packed),
+                                                      skipTable):
+                vals.append(o[2] + packed[o[0]:o[0] + o[1]])
+            unpacked = self.testObj.deserialize_term(self.session,
+                                                     ''.join(vals))
+            self.assertEqual(unpacked, [7, 5, 10] + expected)
+
+
+class CompressedProximityIndexTestCase(ProximityIndexTestCase):
+    """Test a CompressedProximityIndex."""
+
+    @classmethod
+    def _get_class(cls):
+        return CompressedProximityIndex
+
+    def test_serialize_term(self):
+        "Test that serialized postings deserialize unchanged."
+        data = [0, 0, 1, 0, 5, 2, 0, 3, 0, 1, 0, 7, 1, 2, 300, 0, 1, 2, 0]
+        packed = self.testObj.serialize_term(self.session, 7, data, 3, 5)
+        self.assertEqual(self.testObj.deserialize_term(self.session, packed),
+                         [7, 3, 5,
+                          [0, 0, 1, 0, 5],
+                          [2, 0, 3, 0, 1, 0, 7, 1, 2],
+                          [300, 0, 1, 2, 0]])
+        # Summary only
+        self.assertEqual(self.testObj.deserialize_term(self.session,
+                                                       packed[:12]),
+                         [7, 3, 5])
+
+    def test_deserialize_term_options(self):
+        "Test that records and proximity information can be left out."
+        data = [0, 0, 1, 0, 5, 2, 0, 3, 0, 1, 0, 7, 1, 2, 300, 0, 1, 2, 0]
+        packed = self.testObj.serialize_term(self.session, 7, data, 3, 5)
+        self.assertEqual(self.testObj.deserialize_term(self.session,
+                                                       packed,
+                                                       nRecs=2),
+                         [7, 3, 5,
+                          [0, 0, 1, 0, 5],
+                          [2, 0, 3, 0, 1, 0, 7, 1, 2]])
+        self.assertEqual(self.testObj.deserialize_term(self.session,
+                                                       packed,
+                                                       prox=0),
+                         [7, 3, 5, [0, 0, 1], [2, 0, 3], [300, 0, 1]])
+
+
 def load_tests(loader, tests, pattern):
     # Alias loader.loadTestsFromTestCase for sake of line lengths
     ltc = loader.loadTestsFromTestCase 
     suite = ltc(SimpleIndexTestCase)
     suite.addTests(ltc(SelectorSimpleIndexTestCase))
+    suite.addTests(ltc(ProximityIndexTestCase))
+    suite.addTests(ltc(CompressedIndexTestCase))
+    suite.addTests(ltc(CompressedProximityIndexTestCase))
     return suite
 
 
@@ -10,8 +10,11 @@ from which they were created. This module creates some simple toy example
 ResultSets in order to test the fundamental operations of merging  etc.
 """
 
+import copy
 import math
 
+from array import array
+
 try:
     import unittest2 as unittest
 except ImportError:
@@ -19,9 +22,12 @@ except ImportError:
 
 from lxml import etree
 
-from cheshire3.baseObjects import Session, Database, RecordStore, ProtocolMap
+from cheshire3.baseObjects import Session, Database, RecordStore, ProtocolMap,\
+                                   Index
 from cheshire3.cqlParser import parse as cqlparse
-from cheshire3.resultSet import SimpleResultSet, SimpleResultSetItem
+from cheshire3.resultSet import SimpleResultSet, SimpleResultSetItem,\
+                                BitmapResultSet
+from cheshire3.utils import SimpleBitfield
 
 
 class FakeDatabase(Database):
@@ -72,6 +78,26 @@ class FakeProtocolMap(ProtocolMap):
         return None
 
 
+class FakeSortIndex(Index):
+    """Index specifically for unittesting ordering by ranks of sort values.
+
+    Tables of ranks are given by recordStore on initialization.
+    """
+
+    def __init__(self, session, tables):
+        self.tables = tables
+
+    def get_setting(self, session, id, default=None):
+        if id == 'sortStore':
+            return 1
+        return default
+
+    def fetch_sortKeys(self, session, recordStore):
+        if not isinstance(recordStore, basestring):
+            recordStore = ["recordStore", "recordStore2"][recordStore]
+        return self.tables.get(recordStore, None)
+
+
 class SimpleResultSetItemTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -303,6 +329,182 @@ class SimpleResultSetTestCase(unittest.TestCase):
         self.assertNotIn(self.rsi1, rs)
         self.assertIn(self.rsi3, rs)
 
+    def testCopy(self):
+        "Test that a copy can be reordered without affecting the original"
+        rs = copy.copy(self.a)
+        self.assertIsInstance(rs, SimpleResultSet)
+        self.assertEqual(list(rs), list(self.a))
+        rs.order(self.session, 'occurences', ascending=True)
+        self.assertEqual(list(rs), [self.rsi3, self.rsi1])
+        self.assertEqual(list(self.a), [self.rsi1, self.rsi3])
+
+    def testCopyItems(self):
+        "Test that items of a copy can be modified without affecting originals"
+        rs = copy.copy(self.a)
+        rs[0].weight = 0.9
+        rs[0].proxInfo.append([0, 1])
+        self.assertEqual(self.rsi1.weight, 0.5)
+        self.assertEqual(self.rsi1.proxInfo, [])
+        self.assertIs(rs[0].resultSet, rs)
+
+    def _get_longResultSet(self, ids):
+        return SimpleResultSet(self.session,
+                               [SimpleResultSetItem(self.session,
+                                                    id=x,
+                                                    recStore="recordStore",
+                                                    occs=1)
+                                for x
+                                in ids
+                                ])
+
+    def testSkipTo(self):
+        "Test skipping ahead to the first item not less than another"
+        rs = self._get_longResultSet(range(0, 200, 2))
+        for x in range(1, 200):
+            item = SimpleResultSetItem(self.session, id=x,
+                                       recStore="recordStore")
+            for lo in [0, 10, x // 2 - 1]:
+                if lo < 0 or rs[lo] >= item:
+                    continue
+                self.assertEqual(rs._skipTo(rs, item, lo, len(rs)),
+                                 (x + 1) // 2)
+
+    def testCombineAllLong(self):
+        "Test combining a short ResultSet with a much longer one"
+        clause = cqlparse('my.index all "foo"')
+        short = self._get_longResultSet([5, 500, 999, 1500])
+        long = self._get_longResultSet(range(1000))
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [long, short], clause)
+        self.assertEqual([i.id for i in rs], [5, 500, 999])
+
+    def testCombineAnyMany(self):
+        "Test combining many ResultSets with 'any'"
+        clause = cqlparse('my.index any "foo"')
+        others = [self._get_longResultSet(range(x, 300, x + 1))
+                  for x
+                  in range(50)]
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, others, clause)
+        self.assertEqual([i.id for i in rs], range(300))
+
+    def testMerge(self):
+        "Test merging ResultSets, summing occurrences"
+        rs = SimpleResultSet(self.session)
+        rs = rs.merge(self.session, [self.a, self.b])
+        self.assertEqual([(str(i), i.occurences) for i in rs],
+                         [("recordStore/0", 8),
+                          ("recordStore2/0", 2),
+                          ("recordStore/1", 1)])
+        rs = SimpleResultSet(self.session)
+        rs = rs.merge(self.session, [SimpleResultSet(self.session)])
+        self.assertEqual(len(rs), 0)
+
+    def _get_proxResultSet(self, termid, proxInfo):
+        rs = SimpleResultSet(self.session)
+        rs.termid = termid
+        item = SimpleResultSetItem(self.session, id=0,
+                                   recStore="recordStore",
+                                   resultSet=rs)
+        item.proxInfo = proxInfo
+        rs.fromList([item])
+        return rs
+
+    def testCombineProx(self):
+        "Test combining ResultSets with 'prox'"
+        clause = cqlparse('my.index = foo prox/distance<3/unit=word '
+                          'my.index = bar')
+        left = self._get_proxResultSet(1, [[[0, x]] for x in range(0, 90, 9)])
+        right = self._get_proxResultSet(2, [[[0, 200]], [[1, 47]], [[0, 47]]])
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [left, right], clause)
+        self.assertEqual(len(rs), 1)
+        self.assertEqual(rs[0].proxInfo, [[[0, 45, 1], [0, 47, 2]]])
+        # Ordered
+        clause = cqlparse('my.index = foo prox/distance<3/unit=word/ordered '
+                          'my.index = bar')
+        left = self._get_proxResultSet(1, [[[0, 49]]])
+        right = self._get_proxResultSet(2, [[[0, 47]]])
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [left, right], clause)
+        self.assertEqual(len(rs), 0)
+
+    def testMergeProxInfo(self):
+        "Test merging ResultSets, keeping proxInfo of all items"
+        left = self._get_proxResultSet(1, [[[0, 9]], [[1, 2]]])
+        right = self._get_proxResultSet(2, [[[0, 4]]])
+        rs = SimpleResultSet(self.session)
+        rs = rs.merge(self.session, [left, right], proxInfo=True)
+        self.assertEqual(len(rs), 1)
+        self.assertEqual(rs[0].proxInfo, [[[0, 4]], [[0, 9]], [[1, 2]]])
+
+    def _get_bitmapResultSet(self):
+        bf = SimpleBitfield.fromTrueItems([1, 5])
+        return BitmapResultSet(self.session, bf, recordStore="recordStore")
+
+    def testCombineBitmapAnd(self):
+        "Test filtering a ResultSet by a BitmapResultSet with 'and'"
+        clause = cqlparse('my.index = foo and my.index = bar')
+        for limit in [SimpleResultSet.bitmapProbeLimit, 0]:
+            for order in [1, -1]:
+                rs = SimpleResultSet(self.session)
+                rs.bitmapProbeLimit = limit
+                others = [self.a, self._get_bitmapResultSet()][::order]
+                rs = rs.combine(self.session, others, clause)
+                self.assertEqual(list(rs), [self.rsi3])
+                # Items in a different recordStore are never in the bitmap
+                rs = SimpleResultSet(self.session)
+                rs.bitmapProbeLimit = limit
+                others = [self.b, self._get_bitmapResultSet()][::order]
+                rs = rs.combine(self.session, others, clause)
+                self.assertEqual(len(rs), 0)
+
+    def testCombineBitmapOr(self):
+        "Test combining a ResultSet with a BitmapResultSet with 'or'"
+        clause = cqlparse('my.index = foo or my.index = bar')
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session,
+                        [self.a, self._get_bitmapResultSet()],
+                        clause)
+        self.assertEqual([(i.id, i.recordStore) for i in rs],
+                         [(0, "recordStore"),
+                          (1, "recordStore"),
+                          (5, "recordStore")])
+
+    def testCombineBitmapNot(self):
+        "Test combining a ResultSet with a BitmapResultSet with 'not'"
+        clause = cqlparse('my.index = foo not my.index = bar')
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session,
+                        [self.a, self._get_bitmapResultSet()],
+                        clause)
+        self.assertEqual(list(rs), [self.rsi1])
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session,
+                        [self._get_bitmapResultSet(), self.a],
+                        clause)
+        self.assertIsInstance(rs, BitmapResultSet)
+        self.assertEqual([i.id for i in rs], [5])
+
+    def testBitmapCombineMixed(self):
+        "Test combining into a BitmapResultSet with a non-bitmap ResultSet"
+        clause = cqlparse('my.index = foo and my.index = bar')
+        bm = self._get_bitmapResultSet()
+        rs = BitmapResultSet(self.session, recordStore="recordStore")
+        rs = rs.combine(self.session, [bm, self.a], clause)
+        self.assertEqual(list(rs), [self.rsi3])
+        # Original bitmap unchanged
+        self.assertEqual(bm.bitfield.trueItems(), [1, 5])
+
+    def testBitmapCopy(self):
+        "Test that a copy of a BitmapResultSet has its own bitfield"
+        bm = self._get_bitmapResultSet()
+        rs = copy.copy(bm)
+        self.assertIsInstance(rs, BitmapResultSet)
+        rs.bitfield[5] = 0
+        self.assertEqual([i.id for i in rs], [1])
+        self.assertEqual([i.id for i in bm], [1, 5])
+
     def testTfidf(self):
         "Test combining with TF-IDF relevance ranking."
         # A clause / boolean is required to combine ResultSets
@@ -548,6 +750,78 @@ class SimpleResultSetTestCase(unittest.TestCase):
                              )
                          )
 
+    def _get_weightedResultSet(self):
+        weights = [0.3, 0.9, 0.1, 0.7, 0.5]
+        items = [SimpleResultSetItem(self.session,
+                                     id=x,
+                                     recStore="recordStore",
+                                     weight=w)
+                 for x, w in enumerate(weights)]
+        return SimpleResultSet(self.session, items)
+
+    def testOrderWeight(self):
+        "Test ordering a ResultSet by weight"
+        rs = self._get_weightedResultSet()
+        rs.order(self.session, "weight")
+        self.assertEqual([rsi.id for rsi in rs], [1, 3, 4, 0, 2])
+
+    def testOrderTopK(self):
+        "Test ordering only the first topK items of a ResultSet by weight"
+        rs = self._get_weightedResultSet()
+        rs.order(self.session, "weight", topK=2)
+        # Top 2 in order, remainder in original order
+        self.assertEqual([rsi.id for rsi in rs], [1, 3, 0, 2, 4])
+        rs = self._get_weightedResultSet()
+        rs.order(self.session, "weight", ascending=True, topK=2)
+        self.assertEqual([rsi.id for rsi in rs], [2, 0, 1, 3, 4])
+
+    def _get_sortIndex(self):
+        # Lowest and highest: rsi1 c and c, rsi3 a and b, rsi4 missing
+        return FakeSortIndex(self.session,
+                             {"recordStore": array('i', [3, 0,
+                                                         2, 2,
+                                                         0, 1]),
+                              "recordStore2": array('i', [3, 0])})
+
+    def _get_sortResultSet(self):
+        rs = SimpleResultSet(self.session)
+        return rs.combine(self.session, [self.a, self.b],
+                          cqlparse('my.index any "foo"'))
+
+    def testOrderSortKeys(self):
+        "Test ordering a ResultSet by ranks of sort values"
+        idx = self._get_sortIndex()
+        rs = self._get_sortResultSet()
+        rs.order(self.session, idx, ascending=True, missing=1)
+        self.assertEqual(list(rs), [self.rsi3, self.rsi1, self.rsi4])
+        rs.order(self.session, idx, ascending=False, missing=-1)
+        self.assertEqual(list(rs), [self.rsi1, self.rsi3, self.rsi4])
+        rs.order(self.session, idx, ascending=False, missing=1)
+        self.assertEqual(list(rs), [self.rsi4, self.rsi1, self.rsi3])
+        rs.order(self.session, idx, ascending=True, missing=0)
+        self.assertEqual(list(rs), [self.rsi3, self.rsi1])
+
+    def testOrderMultiple(self):
+        "Test ordering a ResultSet by several specifications at once"
+        idx = self._get_sortIndex()
+        # Ties on first key
+        ties = FakeSortIndex(self.session,
+                             {"recordStore": array('i', [1, 0,
+                                                         0, 0,
+                                                         0, 0]),
+                              "recordStore2": array('i', [1, 0,
+                                                          0, 0])})
+        rs = self._get_sortResultSet()
+        rs.order_multiple(self.session,
+                          [(ties, True, 1, None, None),
+                           (idx, False, -1, None, None)])
+        self.assertEqual(list(rs), [self.rsi1, self.rsi3, self.rsi4])
+        # Not all by ranks
+        rs.order_multiple(self.session,
+                          [(ties, True, 1, None, None),
+                           ('id', False, None, None, None)])
+        self.assertEqual([i.id for i in rs], [1, 0, 0])
+
     def testSerialize(self):
         for rs in [self.a, self.b]:
             srlzd = rs.serialize(self.session)
@@ -561,11 +835,86 @@ class SimpleResultSetTestCase(unittest.TestCase):
                 self.fail(u"ResultSet serialization is not well-formed XML")
 
 
+class ColumnSimpleResultSetTestCase(SimpleResultSetTestCase):
+    """Test SimpleResultSets populated from columns."""
+
+    def _construct_resultSetItem(self, session, recId, storeId, occs):
+        return SimpleResultSetItem(session,
+                                   id=recId,
+                                   recStore=["recordStore",
+                                             "recordStore2"][storeId],
+                                   occs=occs)
+
+    def setUp(self):
+        SimpleResultSetTestCase.setUp(self)
+        # Replace ResultSets with ones populated from equivalent columns
+        self.a = SimpleResultSet(self.session, id="a")
+        self.a.fromColumns(self.session,
+                           array('l', [0, 1]),
+                           array('l', [0, 0]),
+                           array('l', [5, 1]),
+                           self._construct_resultSetItem)
+        self.b = SimpleResultSet(self.session, id="b")
+        self.b.fromColumns(self.session,
+                           array('l', [0, 0]),
+                           array('l', [0, 1]),
+                           array('l', [3, 2]),
+                           self._construct_resultSetItem)
+
+    def testGetitem(self):
+        "Check that items are constructed once, when accessed"
+        SimpleResultSetTestCase.testGetitem(self)
+        self.assertIs(self.a[0], self.a[0])
+        self.assertIs(self.a[-1], self.a[1])
+        self.assertEqual(self.a[1].occurences, 1)
+        self.assertEqual(self.a[0:5], [self.rsi1, self.rsi3])
+        self.assertRaises(IndexError, self.a.__getitem__, 2)
+
+    def testCombineColumns(self):
+        "Test combining ResultSets without constructing items"
+        clause = cqlparse('my.index any "foo"')
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [self.a, self.b], clause)
+        self.assertIsNotNone(rs._columns)
+        self.assertEqual(list(rs._columns[0]), [0, 0, 1])
+        self.assertEqual(list(rs._columns[1]), [0, 1, 0])
+        self.assertEqual(list(rs._columns[2]), [5, 2, 1])
+        self.assertFalse(self.a._itemCache)
+        self.assertFalse(self.b._itemCache)
+
+    def testCombineColumnsLong(self):
+        "Test combining columns of a short ResultSet and a much longer one"
+        short = SimpleResultSet(self.session)
+        short.fromColumns(self.session,
+                          array('l', [5, 500, 500, 999]),
+                          array('l', [0, 0, 1, 1]),
+                          array('l', [1, 2, 3, 4]),
+                          self._construct_resultSetItem)
+        long = SimpleResultSet(self.session)
+        long.fromColumns(self.session,
+                         array('l', range(1000)),
+                         array('l', [0] * 999 + [1]),
+                         array('l', [7] * 1000),
+                         self._construct_resultSetItem)
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [long, short],
+                        cqlparse('my.index all "foo"'))
+        self.assertEqual(list(rs._columns[0]), [5, 500, 999])
+        self.assertEqual(list(rs._columns[2]), [1, 2, 4])
+        rs = SimpleResultSet(self.session)
+        rs = rs.combine(self.session, [short, long],
+                        cqlparse('my.index = foo not my.index = bar'))
+        self.assertEqual(list(rs._columns[0]), [500])
+        self.assertEqual(list(rs._columns[1]), [1])
+        self.assertFalse(long._itemCache)
+
+
 def load_tests(loader, tests, pattern):
     # Alias loader.loadTestsFromTestCase for sake of line lengths
     ltc = loader.loadTestsFromTestCase
     suite = ltc(SimpleResultSetItemTestCase)
     suite.addTests(ltc(SimpleResultSetTestCase))
+    suite.addTests(ltc(ColumnSimpleResultSetTestCase))
     return suite
 
 
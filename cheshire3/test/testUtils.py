@@ -38,27 +38,31 @@ class SimpleBitfieldTestCase(unittest.TestCase):
             field = SimpleBitfield(x)
             self.assertEqual(int(field), x)
 
-    # Expected failure - under investigation
-    @unittest.expectedFailure
     def test_len(self):
         "Test length."
         field = SimpleBitfield('101')
         self.assertEqual(len(field), 3)
+        self.assertEqual(len(SimpleBitfield()), 0)
 
-    # Expected failure inherited from failure detected by test_len
-    @unittest.expectedFailure
     def test_getitem(self):
         "Test getting individual items."
         field = SimpleBitfield(5)
         self.assertEqual(field[0], 1)
         self.assertEqual(field[1], 0)
         self.assertEqual(field[2], 1)
+        self.assertRaises(IndexError, field.__getitem__, 3)
+        self.assertEqual(list(field), [1, 0, 1])
+        self.assertEqual(list(SimpleBitfield(0)), [])
     
     def test_setitem(self):
         "Test setting individual items."
         field = SimpleBitfield('101')
         field[1] = 1
         self.assertEqual(field._d, int('111', 2))
+        field[0] = 0
+        self.assertEqual(field._d, int('110', 2))
+        field[0] = 0
+        self.assertEqual(field._d, int('110', 2))
 
     def test_union(self):
         "Test union of two SimpleBitfields."
@@ -124,6 +128,40 @@ class SimpleBitfieldTestCase(unittest.TestCase):
         self.assertListEqual(field.trueItems(),
                              [0])
 
+    def test_trueItems_multibyte(self):
+        "Test trueItems method across byte boundaries."
+        items = [0, 7, 8, 15, 16, 100, 1000]
+        field = SimpleBitfield(sum([1 << x for x in items]))
+        self.assertListEqual(field.trueItems(), items)
+        self.assertListEqual(SimpleBitfield().trueItems(), [])
+
+    def test_fromTrueItems(self):
+        "Test creation from a list of true items."
+        items = [3, 0, 9, 200]
+        field = SimpleBitfield.fromTrueItems(items)
+        self.assertEqual(field._d, sum([1 << x for x in items]))
+        self.assertListEqual(field.trueItems(), sorted(items))
+        self.assertEqual(SimpleBitfield.fromTrueItems([])._d, 0)
+
+    def test_rank(self):
+        "Test counting true items before a position."
+        field = SimpleBitfield('110011')
+        self.assertEqual(field.rank(0), 0)
+        self.assertEqual(field.rank(1), 1)
+        self.assertEqual(field.rank(4), 2)
+        self.assertEqual(field.rank(6), 4)
+        self.assertEqual(field.rank(100), 4)
+
+    def test_select(self):
+        "Test finding the position of the nth true item."
+        items = [1, 4, 9, 63, 64, 500]
+        field = SimpleBitfield.fromTrueItems(items)
+        for n, x in enumerate(items):
+            self.assertEqual(field.select(n), x)
+        self.assertEqual(field.select(-1), 500)
+        self.assertRaises(IndexError, field.select, len(items))
+        self.assertRaises(IndexError, field.select, -len(items) - 1)
+
 
 def load_tests(loader, tests, pattern):
     # Alias loader.loadTestsFromTestCase for sake of line lengths
@@ -225,13 +225,115 @@ def vectorSimilarity(vector1, vector2):
     return float(dotprod) / (el1 * el2)
 
 
+def packVarInts(ints):
+    """Pack non-negative integers into a string of variable length bytes.
+
+    Each integer is stored 7 bits per byte, least significant first, with the
+    high bit set on all but the last byte, so small integers take less space.
+
+    :param ints: non-negative integers
+    :type ints: iterable
+    :returns: packed string
+    :rtype: str
+
+    >>> packVarInts([0, 1, 127, 128, 300])
+    '\\x00\\x01\\x7f\\x80\\x01\\xac\\x02'
+    """
+    out = bytearray()
+    append = out.append
+    for i in ints:
+        while i > 0x7f:
+            append(0x80 | (i & 0x7f))
+            i >>= 7
+        append(i)
+    return str(out)
+
+
+def unpackVarInts(data, count=-1, start=0):
+    """Unpack integers packed by packVarInts.
+
+    Unpack at most count integers (all by default) from data, beginning at
+    byte offset start.
+
+    :param data: packed data
+    :type data: str or bytearray
+    :param count: maximum number of integers to unpack
+    :type count: int
+    :param start: byte offset at which to start
+    :type start: int
+    :returns: tuple of (list of integers, byte offset after last integer)
+
+    >>> unpackVarInts('\\x00\\x01\\x7f\\x80\\x01\\xac\\x02')
+    ([0, 1, 127, 128, 300], 7)
+    >>> unpackVarInts('\\x00\\x01\\x7f\\x80\\x01\\xac\\x02', 2, 1)
+    ([1, 127], 3)
+    """
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    ints = []
+    append = ints.append
+    pos = start
+    end = len(data)
+    while pos < end and count != 0:
+        b = data[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+        else:
+            val = b & 0x7f
+            shift = 7
+            while True:
+                b = data[pos]
+                pos += 1
+                val |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            append(val)
+        count -= 1
+    return (ints, pos)
+
+
+def zigzagEncode(i):
+    """Map a signed integer to a non-negative one for packVarInts.
+
+    >>> [zigzagEncode(x) for x in [0, -1, 1, -2, 2]]
+    [0, 1, 2, 3, 4]
+    """
+    if i < 0:
+        return (-i << 1) - 1
+    return i << 1
+
+
+def zigzagDecode(i):
+    """Reverse zigzagEncode.
+
+    >>> [zigzagDecode(x) for x in [0, 1, 2, 3, 4]]
+    [0, -1, 1, -2, 2]
+    """
+    if i & 1:
+        return -((i + 1) >> 1)
+    return i >> 1
+
+
 # ------------- Bitfield ---------------
 
 
 nonbinaryre = re.compile('[2-9a-f]')
+# Positions of the true bits in each possible byte value
+byteTrueItems = [tuple([b for b in range(8) if (x >> b) & 1])
+                 for x
+                 in range(256)]
 
 
 class SimpleBitfield(object):
+    """Bitfield of arbitrary length, stored in a Python long.
+
+    Boolean operations modify the bitfield in place using bitwise operations
+    on the long. Counting true items is done by the interpreter, and listing
+    or selecting them works a byte at a time. The string serialization is
+    hexadecimal.
+    """
 
     def __init__(self, value=0):
         if not value:
@@ -247,18 +349,41 @@ class SimpleBitfield(object):
                 value = int(value, 2)
         self._d = value
 
+    @classmethod
+    def fromTrueItems(cls, items):
+        """Create and return a SimpleBitfield with the given bits true."""
+        if not items:
+            return cls(0)
+        data = bytearray((max(items) >> 3) + 1)
+        for i in items:
+            data[i >> 3] |= 1 << (i & 7)
+        data.reverse()
+        return cls(int(str(data).encode('hex'), 16))
+
+    def _bytes(self):
+        # Return bytearray of the bitfield, least significant byte first
+        h = '%x' % self._d
+        if len(h) % 2:
+            h = '0' + h
+        data = bytearray(h.decode('hex'))
+        data.reverse()
+        return data
+
     def __getitem__(self, index):
         # Necessary to end for loop
         # would continue indefinitely
-        if index >= len(self):
+        if index < 0:
             raise IndexError(index)
-        return (self._d >> index) & 1
+        val = self._d >> index
+        if not val:
+            raise IndexError(index)
+        return val & 1
 
     def __setitem__(self, index, value):
         if value:
             self._d = self._d | (long(1) << index)
         else:
-            self._d = self._d ^ (long(1) << index)
+            self._d = self._d & ~(long(1) << index)
 
     def __int__(self):
         return self._d
@@ -275,13 +400,10 @@ class SimpleBitfield(object):
         return self._d != 0
 
     def __len__(self):
-        # Precision hack
-        # NB len(str(self))-3 / 4 == capacity, not actual
-        split = math.modf(math.log(self._d, 2))
-        if (split[0] > 0.9999999999):
-            return int(split[1]) + 1
-        else:
-            return int(split[1])
+        # Position of highest true bit + 1
+        if not self._d:
+            return 0
+        return len(bin(self._d)) - 2
 
     def union(self, other):
         self._d = self._d | other._d
@@ -290,69 +412,36 @@ class SimpleBitfield(object):
         self._d = self._d & other._d
 
     def difference(self, other):
-        andnot = self._d & other._d
-        self._d = self._d ^ andnot
+        self._d = self._d & ~other._d
 
     def lenTrueItems(self):
-        string = str(self)[2:]
-        string = string.replace('0', '')
-        string = string.lower()
-        l = 0
-        for quad in string:
-            if quad in ['1', '2', '4', '8']:
-                l += 1
-            elif quad in ['3', '5', '6', '9', 'a', 'c']:
-                l += 2
-            elif quad in ['7', 'b', 'd', 'e']:
-                l += 3
-            else:
-                l += 4
-        return l
+        """Return the number of true bits."""
+        return bin(self._d).count('1')
 
     def trueItems(self):
-        string = str(self)
-        posn = 0
+        """Return a list of the positions of true bits, in ascending order."""
         ids = []
-        # reverse w/o leading 0x
-        string = string[2:][::-1]
-        # string exception throwing is slower
-        string = string.lower()
-        for quad in string:
-            if quad == '0':
-                pass
-            elif quad == '1':  # 0001
-                ids.append(posn)
-            elif quad == '2':  # 0010
-                ids.append(posn + 1)
-            elif quad == '3':  # 0011
-                ids.extend([posn, posn + 1])
-            elif quad == '4':  # 0100
-                ids.append(posn + 2)
-            elif quad == '5':  # 0101
-                ids.extend([posn, posn + 2])
-            elif quad == '6':  # 0110
-                ids.extend([posn + 1, posn + 2])
-            elif quad == '7':  # 0111
-                ids.extend([posn, posn + 1, posn + 2])
-            elif quad == '8':  # 1000
-                ids.append(posn + 3)
-            elif quad == '9':  # 1001
-                ids.extend([posn, posn + 3])
-            else:
-                if quad == 'a':  # 1010
-                    ids.extend([posn + 1, posn + 3])
-                elif quad == 'b':  # 1011
-                    ids.extend([posn, posn + 1, posn + 3])
-                elif quad == 'c':  # 1100
-                    ids.extend([posn + 2, posn + 3])
-                elif quad == 'd':  # 1101
-                    ids.extend([posn, posn + 2, posn + 3])
-                elif quad == 'e':  # 1110
-                    ids.extend([posn + 1, posn + 2, posn + 3])
-                elif quad == 'f':  # 1111
-                    ids.extend([posn, posn + 1, posn + 2, posn + 3])
-                else:
-                    # WTF?
-                    raise ValueError(quad)
-            posn += 4
+        extend = ids.extend
+        for (i, byte) in enumerate(self._bytes()):
+            if byte:
+                posn = i << 3
+                extend([posn + b for b in byteTrueItems[byte]])
         return ids
+
+    def rank(self, index):
+        """Return the number of true bits before position index."""
+        return bin(self._d & ((long(1) << index) - 1)).count('1')
+
+    def select(self, n):
+        """Return the position of the nth (from 0) true bit."""
+        if n < 0:
+            n += self.lenTrueItems()
+            if n < 0:
+                raise IndexError(n)
+        for (i, byte) in enumerate(self._bytes()):
+            if byte:
+                bits = byteTrueItems[byte]
+                if n < len(bits):
+                    return (i << 3) + bits[n]
+                n -= len(bits)
+        raise IndexError(n)
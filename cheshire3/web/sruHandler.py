@@ -269,8 +269,13 @@ class SRUProtocolHandler(object):
                              'context set for each index.')
             raise d
 
+        if ttl and not rsn:
+            # ResultSet will be stored for subsequent requests, rank it all
+            topK = 0
+        else:
+            topK = startRecord + maximumRecords
         try:
-            rs = db.search(session, q)
+            rs = db.search(session, q, topK=topK)
         except c3errors.ObjectDoesNotExistException as e:
             raise self.diagnostic(16,
                                   msg='Unsupported index',
@@ -459,14 +459,17 @@ class CachingWorkflow(SimpleWorkflow):
         if not db:
             raise ValueError("ERROR: db parameter empty when loading cache "
                              "for workflow %s" % self.id)
-        self.objcache = {}
-        self.database = db
-        self.defaultLogger = db.get_path(session, 'defaultLogger')
+        objcache = {}
         for o in self.objrefs:
             obj = db.get_object(session, o)
             if not obj:
                 raise ObjectDoesNotExistException(o)
-            self.objcache[o] = obj
+            objcache[o] = obj
+        # Replace whole, so that threads already processing see either the
+        # old cache or the complete new one
+        self.database = db
+        self.defaultLogger = db.get_path(session, 'defaultLogger')
+        self.objcache = objcache
 
     def _handleGlobals(self, node):
         code = SimpleWorkflow._handleGlobals(self, node)